@@ -1,18 +1,37 @@
 import json
 import logging
-import os
+import time
 import azure.functions as func
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from azure.identity import DefaultAzureCredential
+
+from ..shared_code import replies, telemetry_store
+from ..shared_code.batch import answer_batch
+
+# Fields of a single TelemetryRequest
+REQUEST_FIELDS = ('SensorKey', 'StartDate', 'EndDate')
+
+# Optional fields asking the Pi to aggregate the window instead of returning the raw readings
+AGGREGATION_FIELDS = ('Resolution', 'MaxPoints', 'Aggregation', 'Percentiles')
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('GetTelemetry function processing a request.')
+    started = time.perf_counter()
+    try:
+        return handle(req)
+    finally:
+        # Per-invocation latency, to compare cold/warm invocations and connection reuse
+        logging.info(f'GetTelemetry invocation took {(time.perf_counter() - started) * 1000:.1f} ms')
+
 
+def handle(req: func.HttpRequest) -> func.HttpResponse:
     try:
         # Parse the request body
         req_body = req.get_json()
         
+        # A JSON array is a batch of TelemetryRequest items, each answered like a single request
+        if isinstance(req_body, list):
+            return answer_batch(req_body, REQUEST_FIELDS, "TelemetryRequest", answer, AGGREGATION_FIELDS)
+        
         # Validate required fields
         if not req_body:
             return func.HttpResponse(
@@ -37,30 +56,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             'StartDate': start_date,
             'EndDate': end_date
         }
+        telemetry_request.update(
+            {field: req_body[field] for field in AGGREGATION_FIELDS if req_body.get(field) is not None})
         
-        # Get Service Bus namespace from environment
-        service_bus_namespace = os.environ.get('ServiceBusNamespace')
-        
-        if not service_bus_namespace:
-            logging.error('ServiceBusNamespace not configured')
-            return func.HttpResponse(
-                "Service Bus namespace not configured",
-                status_code=500
-            )
-        
-        # Send message to Service Bus topic using managed identity
-        credential = DefaultAzureCredential()
-        with ServiceBusClient(service_bus_namespace, credential) as client:
-            with client.get_topic_sender(topic_name="Telemetry") as sender:
-                message = ServiceBusMessage(json.dumps(telemetry_request))
-                sender.send_messages(message)
-                logging.info(f'Sent telemetry request to Service Bus topic: {telemetry_request}')
-        
-        return func.HttpResponse(
-            json.dumps({"status": "success", "message": "Telemetry request sent"}),
-            mimetype="application/json",
-            status_code=200
-        )
+        status_code, body = answer(telemetry_request)
+        return json_response(body, status_code)
         
     except ValueError as e:
         logging.error(f'Invalid JSON in request: {str(e)}')
@@ -74,3 +74,107 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             f"Error processing request: {str(e)}",
             status_code=500
         )
+
+
+def json_response(body, status_code=200):
+    return func.HttpResponse(
+        json.dumps(body),
+        mimetype="application/json",
+        status_code=status_code
+    )
+
+
+def answer(telemetry_request):
+    """
+    Answer a validated TelemetryRequest from the telemetry store and/or the
+    Pi. Returns ``(status_code, body)``.
+    """
+    # Answer the stored part of the window without a round-trip to the Pi.
+    # The store keeps raw readings only, so aggregated requests are left to the Pi.
+    store = telemetry_store.get_store()
+    if store is not None and not any(field in telemetry_request for field in AGGREGATION_FIELDS):
+        answered = answer_from_store(store, telemetry_request)
+        if answered is not None:
+            return answered
+    
+    # An injected broker (see memory_broker.py) needs no namespace
+    if not replies.can_send():
+        logging.error('ServiceBusNamespace not configured')
+        return 500, {"status": "error", "error": "Service Bus namespace not configured"}
+    
+    status_code, body = request_from_device(telemetry_request)
+    return status_code, {**body, "source": "device"}
+
+
+def request_from_device(telemetry_request):
+    """
+    Send a telemetry request to the Pi through the Service Bus topic (the
+    credential, client and topic sender are reused across invocations) and
+    wait for its reply. Returns ``(status_code, body)``.
+    """
+    try:
+        correlation_id, reply = replies.request_reply("Telemetry", telemetry_request)
+    except replies.ReplyTimeout as e:
+        # 202: the request was sent and may still be answered, but too late for this call.
+        # Not a 5xx, so the caller does not resend it.
+        logging.warning(f'No reply to telemetry request {e.correlation_id} within {e.timeout:g}s')
+        return 202, {
+            "status": "pending",
+            "correlationId": e.correlation_id,
+            "error": f"The Raspberry Pi did not reply within {e.timeout:g} seconds",
+        }
+    logging.info(f'Telemetry request {correlation_id} answered: {telemetry_request}')
+    
+    if not isinstance(reply, dict):
+        reply = {"status": "error", "error": "The Raspberry Pi sent a reply that is not a JSON object"}
+    return 200, {**reply, "correlationId": correlation_id}
+
+
+def answer_from_store(store, telemetry_request):
+    """
+    Answer a request from the telemetry store, forwarding only the live
+    tail (after the sensor's watermark) to the Pi. Returns
+    ``(status_code, body)``, or None when the store has nothing for the
+    window, so the whole request goes to the Pi.
+    """
+    sensor_key = telemetry_request['SensorKey']
+    try:
+        start_ms = telemetry_store.parse_time(telemetry_request['StartDate'])
+        end_ms = telemetry_store.parse_time(telemetry_request['EndDate'])
+    except (TypeError, ValueError):
+        # Leave dates the store cannot interpret to the Pi
+        return None
+    watermark = store.watermark(sensor_key)
+    if watermark is None or start_ms > watermark:
+        return None
+    
+    readings = [
+        {"time": telemetry_store.format_time(time_ms), "value": value}
+        for time_ms, value in store.query(sensor_key, start_ms, min(end_ms, watermark))
+    ]
+    body = {"status": "success", **telemetry_request, "readings": readings, "source": "store"}
+    if end_ms <= watermark:
+        logging.info(f'Answered {sensor_key} telemetry from the store ({len(readings)} readings)')
+        return 200, body
+    
+    if not replies.can_send():
+        logging.error('ServiceBusNamespace not configured, returning stored telemetry only')
+        return 200, {**body, "liveTailError": "Service Bus namespace not configured"}
+    
+    tail_request = {**telemetry_request, 'StartDate': telemetry_store.format_time(watermark)}
+    _, reply = request_from_device(tail_request)
+    body["correlationId"] = reply.get("correlationId")
+    if reply.get("status") != "success":
+        # The stored history is still worth returning
+        body["liveTailError"] = reply.get("error")
+        return 200, body
+    
+    for reading in reply.get("readings") or []:
+        try:
+            if telemetry_store.parse_time(reading["time"]) > watermark:
+                readings.append(reading)
+        except (KeyError, TypeError, ValueError):
+            continue
+    body["source"] = "store+device"
+    logging.info(f'Answered {sensor_key} telemetry from the store and the live tail from the Pi')
+    return 200, body
@@ -0,0 +1,81 @@
+import json
+import logging
+import time
+import azure.functions as func
+
+from ..shared_code import telemetry_store, wire_format
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('IngestTelemetry function processing a request.')
+    started = time.perf_counter()
+    try:
+        return handle(req)
+    finally:
+        logging.info(f'IngestTelemetry invocation took {(time.perf_counter() - started) * 1000:.1f} ms')
+
+
+def parse_item(item):
+    """Return ``(sensor_key, readings, ingested_until_ms)`` for one ingest item; raises ValueError"""
+    if not isinstance(item, dict) or not item.get('SensorKey') or not isinstance(item.get('Readings'), list):
+        raise ValueError("Each item must include SensorKey and a Readings list")
+    readings = []
+    for reading in item['Readings']:
+        value = reading.get('value') if isinstance(reading, dict) else None
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError(f"Reading without a numeric value: {reading}")
+        readings.append((telemetry_store.parse_time(reading.get('time')), value))
+    ingested_until = item.get('IngestedUntil')
+    return item['SensorKey'], readings, telemetry_store.parse_time(ingested_until) if ingested_until else None
+
+
+def handle(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        # The Pi may push JSON or MessagePack (see shared_code/wire_format.py)
+        content_type = req.headers.get('Content-Type')
+        try:
+            codec = wire_format.get_codec(content_type)
+        except ValueError:
+            return func.HttpResponse(
+                f"Unsupported Content-Type: {content_type}",
+                status_code=415
+            )
+        
+        # Parse the request body: one item per sensor, or an array of them
+        req_body = codec.decode(req.get_body())
+        items = req_body if isinstance(req_body, list) else [req_body]
+        
+        store = telemetry_store.get_store()
+        if store is None:
+            logging.error('TelemetryStorePath not configured')
+            return func.HttpResponse(
+                "Telemetry store not configured",
+                status_code=500
+            )
+        
+        # Validate every item before storing any of them
+        parsed = [parse_item(item) for item in items]
+        
+        ingested = 0
+        for sensor_key, readings, ingested_until in parsed:
+            ingested += store.ingest(sensor_key, readings, ingested_until)
+        logging.info(f'Ingested {ingested} readings for {len(parsed)} sensors')
+        
+        return func.HttpResponse(
+            json.dumps({"status": "success", "ingested": ingested}),
+            mimetype="application/json",
+            status_code=200
+        )
+        
+    except ValueError as e:
+        logging.error(f'Invalid ingest request: {str(e)}')
+        return func.HttpResponse(
+            f"Invalid ingest request: {str(e)}",
+            status_code=400
+        )
+    except Exception as e:
+        logging.error(f'Error processing request: {str(e)}')
+        return func.HttpResponse(
+            f"Error processing request: {str(e)}",
+            status_code=500
+        )
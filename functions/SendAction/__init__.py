@@ -1,18 +1,34 @@
 import json
 import logging
-import os
+import time
 import azure.functions as func
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from azure.identity import DefaultAzureCredential
+
+from ..shared_code import service_bus
+from ..shared_code.batch import handle_batch
+
+# Fields of a single ActionRequest
+REQUEST_FIELDS = ('ActionType', 'ActionSpec')
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('SendAction function processing a request.')
+    started = time.perf_counter()
+    try:
+        return handle(req)
+    finally:
+        # Per-invocation latency, to compare cold/warm invocations and connection reuse
+        logging.info(f'SendAction invocation took {(time.perf_counter() - started) * 1000:.1f} ms')
 
+
+def handle(req: func.HttpRequest) -> func.HttpResponse:
     try:
         # Parse the request body
         req_body = req.get_json()
         
+        # A JSON array is a batch of ActionRequest items
+        if isinstance(req_body, list):
+            return handle_batch(req_body, REQUEST_FIELDS, "ActionRequest", "Action")
+        
         # Validate required fields
         if not req_body:
             return func.HttpResponse(
@@ -37,7 +53,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         }
         
         # Get Service Bus namespace from environment
-        service_bus_namespace = os.environ.get('ServiceBusNamespace')
+        service_bus_namespace = service_bus.get_namespace()
         
         if not service_bus_namespace:
             logging.error('ServiceBusNamespace not configured')
@@ -46,13 +62,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=500
             )
         
-        # Send message to Service Bus topic using managed identity
-        credential = DefaultAzureCredential()
-        with ServiceBusClient(service_bus_namespace, credential) as client:
-            with client.get_topic_sender(topic_name="Action") as sender:
-                message = ServiceBusMessage(json.dumps(action_request))
-                sender.send_messages(message)
-                logging.info(f'Sent action request to Service Bus topic: {action_request}')
+        # Send message to Service Bus topic using managed identity (the
+        # credential, client and topic sender are reused across invocations)
+        service_bus.send("Action", action_request)
+        logging.info(f'Sent action request to Service Bus topic: {action_request}')
         
         return func.HttpResponse(
             json.dumps({"status": "success", "message": "Action request sent"}),
@@ -0,0 +1,20 @@
+import logging
+import azure.functions as func
+
+from ..shared_code import replies, service_bus
+
+
+def main(warmupContext: func.Context) -> None:
+    logging.info('Warmup function preparing the Service Bus client.')
+
+    if not service_bus.get_namespace():
+        logging.warning('ServiceBusNamespace not configured, skipping warm-up')
+        return
+
+    try:
+        service_bus.warm_up()
+        # Accept this process's reply session before the first GetTelemetry waits on it
+        replies.get_listener()
+    except Exception as e:
+        # The first real request will retry the same steps
+        logging.error(f'Service Bus warm-up failed: {str(e)}')
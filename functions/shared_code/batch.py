@@ -0,0 +1,158 @@
+"""
+Batch mode for GetTelemetry and SendAction.
+
+A request body that is a JSON array is handled as a batch: every item is
+validated before anything is sent, and the response carries one result per
+item in request order. A fleet-wide refresh then takes one HTTP round-trip
+(and one Service Bus connection) instead of one per request.
+
+Actions are fire-and-forget, so handle_batch() sends the valid items to the
+topic in as few ServiceBusMessageBatch sends as their size allows.
+Telemetry requests wait for the Pi's readings, so answer_batch() answers
+every valid item as a single request would be answered, all at once on a
+thread pool, and each result carries that item's reply.
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+
+from . import service_bus
+
+
+def get_max_items():
+    """Largest batch accepted, from the MaxBatchItems setting"""
+    return int(os.environ.get('MaxBatchItems', 100))
+
+
+def validate_item(item, fields, optional_fields=()):
+    """
+    Return ``(message, None)`` with the required fields of a request (and the
+    optional ones it has), or ``(None, error)``
+    """
+    if not isinstance(item, dict):
+        return None, "Item must be a JSON object"
+    missing = [field for field in fields if not item.get(field)]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+    message = {field: item[field] for field in fields}
+    message.update({field: item[field] for field in optional_fields if item.get(field) is not None})
+    return message, None
+
+
+def validate_batch(items, fields, request_name, optional_fields=()):
+    """
+    Validate every item of a batch.
+
+    Returns ``(results, messages, None)``, where ``results`` has an error
+    result for each invalid item and ``messages`` is the ``(index, message)``
+    of each valid one, or ``(None, None, response)`` with the 400 response
+    for a batch that is empty, too large or without a valid item.
+    """
+    max_items = get_max_items()
+    if not items or len(items) > max_items:
+        return None, None, func.HttpResponse(
+            f"A batch must contain between 1 and {max_items} {request_name} items",
+            status_code=400
+        )
+
+    results = []
+    messages = []
+    for index, item in enumerate(items):
+        message, error = validate_item(item, fields, optional_fields)
+        if error:
+            results.append({"index": index, "status": "error", "error": error})
+        else:
+            results.append({"index": index, "status": "success"})
+            messages.append((index, message))
+
+    if not messages:
+        return None, None, func.HttpResponse(
+            json.dumps({"status": "error", "message": f"No valid {request_name} items", "results": results}),
+            mimetype="application/json",
+            status_code=400
+        )
+    return results, messages, None
+
+
+def handle_batch(items, fields, request_name, topic_name):
+    """
+    Validate and send a batch of requests; returns the HTTP response.
+
+    The response is 200 when every item was sent and 207 (with per-item
+    results) when some were not. A batch that is empty or too large, or in
+    which no item is valid, is rejected with 400.
+    """
+    results, messages, response = validate_batch(items, fields, request_name)
+    if response is not None:
+        return response
+
+    if not service_bus.get_namespace():
+        logging.error('ServiceBusNamespace not configured')
+        return func.HttpResponse(
+            "Service Bus namespace not configured",
+            status_code=500
+        )
+
+    errors = service_bus.send_batch(topic_name, [message for _, message in messages])
+    for (index, _), error in zip(messages, errors):
+        if error:
+            results[index] = {"index": index, "status": "error", "error": error}
+
+    failed = sum(1 for result in results if result["status"] == "error")
+    logging.info(f'Sent {len(items) - failed} of {len(items)} {request_name} items to Service Bus topic: {topic_name}')
+    return func.HttpResponse(
+        json.dumps({
+            "status": "success" if not failed else "partial",
+            "sent": len(items) - failed,
+            "failed": failed,
+            "results": results,
+        }),
+        mimetype="application/json",
+        status_code=200 if not failed else 207
+    )
+
+
+def answer_batch(items, fields, request_name, answer, optional_fields=()):
+    """
+    Validate a batch of requests and answer each valid item; returns the HTTP response.
+
+    ``answer(message)`` returns the ``(status_code, body)`` a single request
+    would get. The items are answered concurrently, one thread each, so the
+    batch takes as long as its slowest item rather than the sum of them.
+    Each result is the item's body with its index; the response is 200 when
+    every item was answered with "status": "success" and 207 otherwise. A
+    batch that is empty or too large, or in which no item is valid, is
+    rejected with 400.
+    """
+    results, messages, response = validate_batch(items, fields, request_name, optional_fields)
+    if response is not None:
+        return response
+
+    def answer_item(message):
+        try:
+            return answer(message)[1]
+        except Exception as e:
+            logging.error(f'Error answering {request_name} item: {str(e)}')
+            return {"status": "error", "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=len(messages), thread_name_prefix="batch") as executor:
+        bodies = list(executor.map(answer_item, [message for _, message in messages]))
+    for (index, _), body in zip(messages, bodies):
+        results[index] = {"index": index, **body}
+
+    failed = sum(1 for result in results if result.get("status") != "success")
+    logging.info(f'Answered {len(items) - failed} of {len(items)} {request_name} items')
+    return func.HttpResponse(
+        json.dumps({
+            "status": "success" if not failed else "partial",
+            "answered": len(items) - failed,
+            "failed": failed,
+            "results": results,
+        }),
+        mimetype="application/json",
+        status_code=200 if not failed else 207
+    )
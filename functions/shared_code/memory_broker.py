@@ -0,0 +1,96 @@
+"""
+In-memory stand-in for Service Bus, for local tests of the request/reply path.
+
+InMemoryBroker has the send()/receive() functions of the service_bus
+module, so replies.set_broker(InMemoryBroker()) runs GetTelemetry without a
+namespace. Topics and queues are plain FIFO queues, one per entity and
+session; a test plays the Raspberry Pi by reading requests with
+receive_messages() and answering them with reply(). Bodies are encoded with
+wire_format like real messages, in the MessageContentType format.
+"""
+
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from . import wire_format
+from .service_bus import get_content_type
+
+
+class InMemoryMessage:
+    """A message with the ServiceBusMessage properties the request/reply path uses."""
+
+    def __init__(self, body, content_type=None, message_id=None, correlation_id=None, session_id=None,
+                 reply_to=None, reply_to_session_id=None, time_to_live=None):
+        self.body = body
+        self.content_type = content_type
+        self.message_id = message_id
+        self.correlation_id = correlation_id
+        self.session_id = session_id
+        self.reply_to = reply_to
+        self.reply_to_session_id = reply_to_session_id
+        self.expires_at = time.monotonic() + time_to_live.total_seconds() if time_to_live else None
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+
+class InMemoryBroker:
+    """Topics and session queues held in process memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entities = defaultdict(queue.Queue)
+        self._counters = {"sent": 0, "received": 0, "expired": 0}
+
+    def _queue(self, entity_name, session_id=None):
+        with self._lock:
+            return self._entities[(entity_name, session_id)]
+
+    def send(self, entity_name, body, content_type=None, **properties):
+        """Send a message to a topic or (session of a) queue."""
+        data, content_type = wire_format.encode(body, content_type or get_content_type())
+        message = InMemoryMessage(data, content_type, **properties)
+        self._queue(entity_name, message.session_id).put(message)
+        with self._lock:
+            self._counters["sent"] += 1
+
+    def receive_messages(self, entity_name, session_id=None, max_wait_time=5, max_message_count=100):
+        """Return up to ``max_message_count`` unexpired messages, waiting at most ``max_wait_time`` for the first."""
+        entity = self._queue(entity_name, session_id)
+        deadline = time.monotonic() + max_wait_time
+        messages = []
+        while len(messages) < max_message_count:
+            try:
+                if messages:
+                    message = entity.get_nowait()
+                else:
+                    message = entity.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if message.expired:
+                with self._lock:
+                    self._counters["expired"] += 1
+                continue
+            messages.append(message)
+        with self._lock:
+            self._counters["received"] += len(messages)
+        return messages
+
+    def receive(self, queue_name, session_id, max_wait_time=5, max_message_count=100):
+        """Same contract as service_bus.receive(): a list of ``(correlation_id, body)``."""
+        return [(message.correlation_id, wire_format.decode_message(message))
+                for message in self.receive_messages(queue_name, session_id, max_wait_time, max_message_count)]
+
+    def reply(self, request, body):
+        """Answer a request the way the Raspberry Pi does, in the request's format."""
+        self.send(request.reply_to, body,
+                  content_type=request.content_type,
+                  session_id=request.reply_to_session_id,
+                  correlation_id=request.message_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
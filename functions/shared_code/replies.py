@@ -0,0 +1,238 @@
+"""
+Request/reply correlation for GetTelemetry.
+
+A request is sent with a fresh message id, a reply-to queue and a reply-to
+session id. The Raspberry Pi answers on that queue and session with the
+request's message id as correlation id. Every worker process owns one
+session of the session-enabled reply queue and runs one listener thread that
+receives its replies and hands each to the waiting invocation through a dict
+keyed by correlation id. However many requests are outstanding, a reply costs
+one dict lookup, and there is one receiver per process instead of one per
+request.
+
+Requests carry a time to live equal to the wait deadline, so the Pi never
+reads a request nobody is waiting for any more. A reply that arrives after
+its deadline is dropped and counted as late.
+
+The broker is the service_bus module by default; set_broker() swaps in an
+object with the same send()/receive() functions, such as the
+InMemoryBroker in memory_broker.py for local tests.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from . import service_bus
+
+# Seconds to wait for a reply when the TelemetryReplyTimeout setting is not set
+DEFAULT_REPLY_TIMEOUT = 10.0
+
+# Seconds the listener waits before reopening its receiver after an error
+LISTENER_RETRY_DELAY = 1.0
+
+_lock = threading.Lock()
+_broker = None
+_listener = None
+
+
+class ReplyTimeout(Exception):
+    """Raised when no reply arrived before the deadline."""
+
+    def __init__(self, correlation_id, timeout):
+        super().__init__(f"No reply to {correlation_id} within {timeout:g}s")
+        self.correlation_id = correlation_id
+        self.timeout = timeout
+
+
+def get_reply_queue():
+    """Session-enabled queue the Pi sends replies to, from the TelemetryReplyQueue setting"""
+    return os.environ.get('TelemetryReplyQueue', 'telemetry-replies')
+
+
+def get_reply_timeout():
+    """Seconds to wait for a reply, from the TelemetryReplyTimeout setting"""
+    return float(os.environ.get('TelemetryReplyTimeout', DEFAULT_REPLY_TIMEOUT))
+
+
+class _Waiter:
+    """An invocation waiting for the reply to one request."""
+
+    __slots__ = ("event", "body")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.body = None
+
+
+class PendingReplies:
+    """Outstanding requests of this process, keyed by correlation id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._counters = {"registered": 0, "delivered": 0, "timeouts": 0, "late": 0}
+
+    def register(self, correlation_id):
+        """Start waiting for a reply; call before the request is sent so a fast reply is not missed."""
+        waiter = _Waiter()
+        with self._lock:
+            self._waiters[correlation_id] = waiter
+            self._counters["registered"] += 1
+        return waiter
+
+    def deliver(self, correlation_id, body):
+        """Hand a reply to its waiter; returns False if nobody is waiting for it."""
+        with self._lock:
+            waiter = self._waiters.pop(correlation_id, None)
+            if waiter is None:
+                self._counters["late"] += 1
+                return False
+            self._counters["delivered"] += 1
+        waiter.body = body
+        waiter.event.set()
+        return True
+
+    def wait(self, correlation_id, waiter, timeout):
+        """Return the reply body, or raise ReplyTimeout once ``timeout`` seconds have passed."""
+        if waiter.event.wait(timeout):
+            return waiter.body
+        with self._lock:
+            if self._waiters.pop(correlation_id, None) is None:
+                # Delivered between the timeout and taking the lock
+                return waiter.body
+            self._counters["timeouts"] += 1
+        raise ReplyTimeout(correlation_id, timeout)
+
+    def discard(self, correlation_id):
+        """Stop waiting, e.g. because the request could not be sent."""
+        with self._lock:
+            self._waiters.pop(correlation_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "outstanding": len(self._waiters)}
+
+
+class ReplyListener:
+    """Receives the replies for one session in a background thread and delivers them."""
+
+    def __init__(self, broker, queue_name, session_id, pending, max_wait_time=5):
+        """
+        Initialize the ReplyListener.
+
+        Args:
+            broker: Object with a receive(queue_name, session_id, max_wait_time) function
+            queue_name: The session-enabled reply queue
+            session_id: The session owned by this process
+            pending: PendingReplies to deliver to
+            max_wait_time: Seconds one receive call waits for messages
+        """
+        self.broker = broker
+        self.queue_name = queue_name
+        self.session_id = session_id
+        self.pending = pending
+        self.max_wait_time = max_wait_time
+        self._stop = threading.Event()
+        self._thread = None
+        self._errors = 0
+
+    def start(self):
+        """Start the listener thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="reply-listener", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        logging.info(f'Listening for replies on {self.queue_name}, session {self.session_id}')
+        while not self._stop.is_set():
+            try:
+                replies = self.broker.receive(self.queue_name, self.session_id, self.max_wait_time)
+            except Exception as e:
+                self._errors += 1
+                logging.warning(f'Receiving replies from {self.queue_name} failed: {str(e)}')
+                self._stop.wait(LISTENER_RETRY_DELAY)
+                continue
+            for correlation_id, body in replies:
+                if not self.pending.deliver(correlation_id, body):
+                    logging.info(f'Dropped reply {correlation_id}: nobody is waiting for it')
+
+    def stats(self):
+        return {"session_id": self.session_id, "running": self._thread is not None and self._thread.is_alive(),
+                "receive_errors": self._errors}
+
+
+def get_broker():
+    """Return the broker requests and replies go through (the service_bus module unless set_broker() was called)"""
+    return _broker or service_bus
+
+
+def can_send():
+    """Whether requests can be sent: a broker was set, or the ServiceBusNamespace setting is configured"""
+    return _broker is not None or bool(service_bus.get_namespace())
+
+
+def set_broker(broker):
+    """Use another broker, e.g. an InMemoryBroker in tests; stops the current listener"""
+    global _broker, _listener
+    with _lock:
+        _broker = broker
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def get_listener():
+    """Return this process's reply listener, starting it on first use"""
+    global _listener
+    if _listener is None:
+        with _lock:
+            if _listener is None:
+                # One session per worker process; the suffix keeps restarted processes apart
+                session_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+                _listener = ReplyListener(get_broker(), get_reply_queue(), session_id, PendingReplies())
+                _listener.start()
+    return _listener
+
+
+def request_reply(topic_name, body, timeout=None):
+    """
+    Send a request to a topic and wait for the Pi's reply.
+
+    Returns ``(correlation_id, reply_body)``; raises ReplyTimeout when no
+    reply arrives within ``timeout`` seconds (TelemetryReplyTimeout by default).
+    """
+    timeout = get_reply_timeout() if timeout is None else timeout
+    listener = get_listener()
+    correlation_id = uuid.uuid4().hex
+    started = time.perf_counter()
+    waiter = listener.pending.register(correlation_id)
+    try:
+        get_broker().send(
+            topic_name, body,
+            message_id=correlation_id,
+            reply_to=listener.queue_name,
+            reply_to_session_id=listener.session_id,
+            time_to_live=timedelta(seconds=timeout),
+        )
+    except Exception:
+        listener.pending.discard(correlation_id)
+        raise
+    reply = listener.pending.wait(correlation_id, waiter, timeout)
+    logging.info(f'Reply to {correlation_id} received in {(time.perf_counter() - started) * 1000:.1f} ms')
+    return correlation_id, reply
+
+
+def stats():
+    """Return reply counts and the listener state for this worker process"""
+    listener = _listener
+    if listener is None:
+        return {"listening": False}
+    return {"listening": True, **listener.stats(), **listener.pending.stats()}
@@ -0,0 +1,374 @@
+"""
+Service Bus connection management shared by the functions.
+
+The credential, the ServiceBusClient and one sender per topic are created on
+first use and kept for the lifetime of the worker process, so an invocation
+only pays for the send itself instead of a token acquisition and an AMQP
+handshake. Senders are not thread-safe, so sends to a topic are serialized
+with a per-topic lock. When a send fails because the connection or its token
+went bad, the sender is rebuilt and the send retried; if that fails too, the
+client is rebuilt for a last attempt. Tokens are refreshed ahead of expiry by one thread at a
+time, and a still-valid token keeps being used if a refresh fails.
+
+receive() reads replies from one session of a session-enabled queue
+with a receiver kept open between calls; it is used by the reply listener
+(see replies.py), the only reader of that receiver.
+
+Bodies are serialized in the format named by the MessageContentType setting
+(see wire_format.py), which is also set as the message content_type; received
+bodies are decoded according to their own content_type.
+
+The SDKs are imported on first use instead of when a function module is
+loaded. warm_up() does all of this ahead of the first request (see the
+Warmup function).
+"""
+
+import logging
+import os
+import threading
+import time
+
+from . import wire_format
+
+# Token scope used by the Service Bus data plane
+SERVICE_BUS_SCOPE = "https://servicebus.azure.net/.default"
+
+# Topics the functions publish to; their senders are opened by warm_up()
+TOPICS = ("Telemetry", "Action")
+
+# Tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+_lock = threading.Lock()
+_credential = None
+_client = None
+# Bumped whenever the client is rebuilt; senders of an older client are replaced
+_client_generation = 0
+_senders = {}
+_topic_locks = {}
+# (queue, session) -> (generation, receiver, lock renewer); only used from the reply listener thread
+_receivers = {}
+_counters = {"sends": 0, "senders_created": 0, "reconnects": 0,
+             "token_refreshes": 0, "token_refresh_failures": 0,
+             "receivers_created": 0, "received": 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+class RefreshingCredential:
+    """
+    Caches tokens from another credential and refreshes them before they
+    expire, one refresh at a time. If a refresh fails while the cached
+    token is still valid, the cached token is returned.
+    """
+
+    def __init__(self, credential, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._refresh_lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        key = (scopes, kwargs.get("claims"), kwargs.get("tenant_id"))
+        token = self._tokens.get(key)
+        if token is not None and token.expires_on - time.time() > self.refresh_margin:
+            return token
+        with self._refresh_lock:
+            # Another thread may have refreshed it while we waited
+            token = self._tokens.get(key)
+            if token is not None and token.expires_on - time.time() > self.refresh_margin:
+                return token
+            try:
+                token = self.credential.get_token(*scopes, **kwargs)
+            except Exception as e:
+                _count("token_refresh_failures")
+                cached = self._tokens.get(key)
+                if cached is not None and cached.expires_on > time.time():
+                    logging.warning(f'Token refresh failed, using the cached token: {str(e)}')
+                    return cached
+                raise
+            self._tokens[key] = token
+            _count("token_refreshes")
+            return token
+
+    def close(self):
+        close = getattr(self.credential, "close", None)
+        if close:
+            close()
+
+
+def get_namespace():
+    """Fully qualified Service Bus namespace from the ServiceBusNamespace setting"""
+    return os.environ.get('ServiceBusNamespace')
+
+
+def get_credential():
+    """Return the managed identity credential, creating it on first use"""
+    global _credential
+    if _credential is None:
+        with _lock:
+            if _credential is None:
+                from azure.identity import DefaultAzureCredential
+                _credential = RefreshingCredential(DefaultAzureCredential())
+    return _credential
+
+
+def get_client():
+    """Return the Service Bus client for the configured namespace, creating it on first use"""
+    global _client
+    if _client is None:
+        credential = get_credential()
+        with _lock:
+            if _client is None:
+                from azure.servicebus import ServiceBusClient
+                _client = ServiceBusClient(get_namespace(), credential)
+    return _client
+
+
+def _topic_lock(topic_name):
+    with _lock:
+        return _topic_locks.setdefault(topic_name, threading.Lock())
+
+
+def _get_sender(topic_name):
+    """Return the cached sender for a topic (caller holds the topic lock)"""
+    entry = _senders.get(topic_name)
+    if entry is not None and entry[0] == _client_generation:
+        return entry[1]
+    if entry is not None:
+        _close_sender(topic_name)
+    client = get_client()
+    sender = client.get_topic_sender(topic_name=topic_name)
+    _senders[topic_name] = (_client_generation, sender)
+    _count("senders_created")
+    return sender
+
+
+def _close_sender(topic_name):
+    """Close and forget a topic's sender (caller holds the topic lock)"""
+    entry = _senders.pop(topic_name, None)
+    if entry is not None:
+        try:
+            entry[1].close()
+        except Exception as e:
+            logging.warning(f'Error closing the {topic_name} sender: {str(e)}')
+
+
+def _reset_client():
+    """Close the client; it is rebuilt on next use and other topics' senders with it"""
+    global _client, _client_generation
+    with _lock:
+        client, _client = _client, None
+        _client_generation += 1
+    if client is not None:
+        try:
+            client.close()
+        except Exception as e:
+            logging.warning(f'Error closing the Service Bus client: {str(e)}')
+
+
+def _reconnect_errors():
+    """Exceptions after which a sender is rebuilt rather than the send failed"""
+    from azure.servicebus.exceptions import (
+        OperationTimeoutError,
+        ServiceBusAuthenticationError,
+        ServiceBusCommunicationError,
+        ServiceBusConnectionError,
+    )
+    return (ServiceBusConnectionError, ServiceBusCommunicationError,
+            ServiceBusAuthenticationError, OperationTimeoutError)
+
+
+def _with_sender(topic_name, operation):
+    """
+    Run ``operation(sender)`` with the topic's cached sender. On a
+    connection or authentication failure the sender is rebuilt and the
+    operation retried; the client is rebuilt too if that also fails.
+    """
+    reconnect_errors = _reconnect_errors()
+    with _topic_lock(topic_name):
+        for attempt in range(3):
+            sender = _get_sender(topic_name)
+            try:
+                return operation(sender)
+            except reconnect_errors as e:
+                if attempt == 2:
+                    raise
+                logging.warning(f'Service Bus send to {topic_name} failed, reconnecting: {str(e)}')
+                _count("reconnects")
+                _close_sender(topic_name)
+                if attempt == 1:
+                    _reset_client()
+
+
+def get_content_type():
+    """Wire format of outgoing message bodies, from the MessageContentType setting"""
+    return os.environ.get('MessageContentType', wire_format.JSON)
+
+
+def _message(body, **properties):
+    from azure.servicebus import ServiceBusMessage
+
+    data, content_type = wire_format.encode(body, get_content_type())
+    return ServiceBusMessage(data, content_type=content_type, **properties)
+
+
+def send(topic_name, body, **properties):
+    """
+    Send a message to a Service Bus topic. ``properties`` are passed to
+    ServiceBusMessage (message_id, reply_to, time_to_live, ...).
+    """
+    started = time.perf_counter()
+    message = _message(body, **properties)
+    _with_sender(topic_name, lambda sender: sender.send_messages(message))
+    _count("sends")
+    logging.info(f'Sent message to {topic_name} in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+
+def send_batch(topic_name, bodies):
+    """
+    Send messages to a Service Bus topic using as few
+    ServiceBusMessageBatch sends as the batch size limit allows.
+
+    Returns one entry per body, in order: None when it was sent, otherwise
+    the error that prevented it.
+    """
+    from azure.servicebus.exceptions import MessageSizeExceededError
+
+    started = time.perf_counter()
+    reconnect_errors = _reconnect_errors()
+    messages = [_message(body) for body in bodies]
+    errors = [None] * len(bodies)
+    remaining = list(range(len(messages)))
+
+    def send_remaining(sender):
+        # Also runs again after a reconnect, resuming with the unsent messages
+        while remaining:
+            batch = sender.create_message_batch()
+            chunk = []
+            for index in remaining:
+                try:
+                    batch.add_message(messages[index])
+                except MessageSizeExceededError:
+                    if not chunk:
+                        errors[index] = f"Message exceeds the maximum size of {batch.max_size_in_bytes} bytes"
+                        remaining.remove(index)
+                    break
+                chunk.append(index)
+            if not chunk:
+                continue
+            try:
+                sender.send_messages(batch)
+                _count("sends")
+            except reconnect_errors:
+                raise
+            except Exception as e:
+                logging.error(f'Failed to send a batch of {len(chunk)} messages to {topic_name}: {str(e)}')
+                for index in chunk:
+                    errors[index] = str(e)
+            del remaining[:len(chunk)]
+
+    try:
+        _with_sender(topic_name, send_remaining)
+    except Exception as e:
+        logging.error(f'Failed to send {len(remaining)} messages to {topic_name}: {str(e)}')
+        for index in remaining:
+            errors[index] = str(e)
+    logging.info(f'Sent {len(bodies)} messages to {topic_name} in {(time.perf_counter() - started) * 1000:.1f} ms')
+    return errors
+
+
+def _close_receiver(key):
+    entry = _receivers.pop(key, None)
+    if entry is not None:
+        try:
+            entry[1].close()
+            entry[2].close()
+        except Exception as e:
+            logging.warning(f'Error closing the {key[0]} receiver: {str(e)}')
+
+
+def receive(queue_name, session_id, max_wait_time=5, max_message_count=100):
+    """
+    Receive up to ``max_message_count`` messages from one session of a queue,
+    waiting at most ``max_wait_time`` seconds for the first. Returns a list of
+    ``(correlation_id, body)``; bodies that cannot be decoded are returned as None.
+
+    Messages are removed on receipt (RECEIVE_AND_DELETE): a reply nobody is
+    waiting for any more is worthless, so there is nothing to settle. On an
+    error the receiver is closed and the error raised; the next call reopens it.
+    """
+    from azure.servicebus import AutoLockRenewer, ServiceBusReceiveMode
+
+    key = (queue_name, session_id)
+    entry = _receivers.get(key)
+    if entry is None or entry[0] != _client_generation:
+        _close_receiver(key)
+        # Keeps the session locked to this process between receives
+        renewer = AutoLockRenewer(max_lock_renewal_duration=24 * 3600)
+        receiver = get_client().get_queue_receiver(
+            queue_name=queue_name,
+            session_id=session_id,
+            receive_mode=ServiceBusReceiveMode.RECEIVE_AND_DELETE,
+            prefetch_count=max_message_count,
+            auto_lock_renewer=renewer,
+        )
+        _receivers[key] = entry = (_client_generation, receiver, renewer)
+        _count("receivers_created")
+
+    try:
+        messages = entry[1].receive_messages(max_message_count=max_message_count, max_wait_time=max_wait_time)
+    except Exception:
+        _close_receiver(key)
+        raise
+
+    replies = []
+    for message in messages:
+        try:
+            body = wire_format.decode_message(message)
+        except (TypeError, ValueError) as e:
+            logging.warning(f'Cannot decode a {message.content_type} message from {queue_name}: {str(e)}')
+            body = None
+        replies.append((message.correlation_id, body))
+    if replies:
+        with _lock:
+            _counters["received"] += len(replies)
+    return replies
+
+
+def warm_up():
+    """
+    Import the SDKs, acquire a token, create the client and open a sender
+    per topic before the first request. Returns the time spent on each step
+    in milliseconds.
+    """
+    timings = {}
+    started = time.perf_counter()
+    credential = get_credential()
+    timings['credential_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    credential.get_token(SERVICE_BUS_SCOPE)
+    timings['token_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    get_client()
+    timings['client_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    for topic_name in TOPICS:
+        # Creating a batch opens the sender's link
+        _with_sender(topic_name, lambda sender: sender.create_message_batch())
+    timings['senders_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    logging.info(f'Service Bus warm-up completed: {timings}')
+    return timings
+
+
+def stats():
+    """Return send, receive, reconnect and token refresh counts for this worker process"""
+    with _lock:
+        return {**_counters, "open_senders": len(_senders), "open_receivers": len(_receivers)}
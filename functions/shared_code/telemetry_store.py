@@ -0,0 +1,201 @@
+"""
+Cloud-side telemetry time-series store.
+
+The Raspberry Pi pushes its readings periodically (see IngestTelemetry), so
+GetTelemetry can answer the part of a window that is already stored without
+a round-trip to the device. Only the "live tail", after the newest push, is
+still forwarded to the Pi.
+
+Readings are kept in one SQLite table clustered on (sensor, time): a
+WITHOUT ROWID table whose primary key is the index, with times as integer
+milliseconds, so a range query is a single index range scan and a reading
+costs little more than its three values. Each sensor also has a watermark,
+the time up to which the Pi has pushed everything it sampled. A window that
+ends before the watermark is complete in the store, even if it holds no
+readings.
+
+The store is enabled by the TelemetryStorePath setting. SQLite keeps it on
+one instance's disk, which suits local development and single-instance
+plans.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+# Readings older than this many days are pruned, from TelemetryStoreRetentionDays
+DEFAULT_RETENTION_DAYS = 30
+
+# Seconds between two retention prunes
+PRUNE_INTERVAL = 3600
+
+_lock = threading.Lock()
+_store = None
+
+
+def parse_time(value):
+    """Return an ISO 8601 string ("Z" or offset; naive means UTC) or epoch seconds as epoch milliseconds"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value * 1000)
+    parsed = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def format_time(milliseconds):
+    """Format epoch milliseconds the way readings are returned"""
+    return datetime.fromtimestamp(milliseconds / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SQLiteTelemetryStore:
+    """Readings per sensor in SQLite, indexed on (sensor, time), with per-sensor watermarks."""
+
+    def __init__(self, db_path, retention_days=DEFAULT_RETENTION_DAYS):
+        """
+        Initialize the SQLiteTelemetryStore.
+
+        Args:
+            db_path: Path of the SQLite database file
+            retention_days: Readings older than this are pruned during ingest (0 keeps everything)
+        """
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        # sensor -> rows_written, write_seconds, queries, rows_read, query_seconds
+        self._sensor_counters = {}
+
+    def _connection(self):
+        """Return this thread's connection, opening it (and the schema) on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # WAL keeps the database consistent on a crash; only the last commits may be lost
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS readings ("
+                "sensor TEXT NOT NULL, time INTEGER NOT NULL, value REAL NOT NULL, "
+                "PRIMARY KEY (sensor, time)) WITHOUT ROWID"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (sensor TEXT PRIMARY KEY, ingested_until INTEGER NOT NULL)"
+            )
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def _record(self, sensor, rows_field, seconds_field, rows, seconds, calls_field=None):
+        with self._lock:
+            counters = self._sensor_counters.setdefault(
+                sensor, {"rows_written": 0, "write_seconds": 0.0, "queries": 0, "rows_read": 0, "query_seconds": 0.0}
+            )
+            counters[rows_field] += rows
+            counters[seconds_field] += seconds
+            if calls_field:
+                counters[calls_field] += 1
+
+    def ingest(self, sensor, readings, ingested_until=None):
+        """
+        Store ``(time_ms, value)`` readings of one sensor and advance its
+        watermark to ``ingested_until`` (default: the newest reading).
+        Readings already stored for the same time are replaced. Returns the
+        number of readings written.
+        """
+        sensor = sensor.lower()
+        readings = list(readings)
+        if ingested_until is None and readings:
+            ingested_until = max(time_ms for time_ms, _ in readings)
+        started = time.perf_counter()
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO readings (sensor, time, value) VALUES (?, ?, ?)",
+                ((sensor, time_ms, value) for time_ms, value in readings),
+            )
+            if ingested_until is not None:
+                connection.execute(
+                    "INSERT INTO watermarks (sensor, ingested_until) VALUES (?, ?) "
+                    "ON CONFLICT (sensor) DO UPDATE SET ingested_until = MAX(ingested_until, excluded.ingested_until)",
+                    (sensor, ingested_until),
+                )
+        self._record(sensor, "rows_written", "write_seconds", len(readings), time.perf_counter() - started)
+        self._maybe_prune()
+        return len(readings)
+
+    def watermark(self, sensor):
+        """Time (ms) up to which every reading of the sensor has been ingested, or None."""
+        row = self._connection().execute(
+            "SELECT ingested_until FROM watermarks WHERE sensor = ?", (sensor.lower(),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def query(self, sensor, start_ms, end_ms):
+        """Return the ``(time_ms, value)`` readings of a sensor with start <= time <= end, oldest first."""
+        sensor = sensor.lower()
+        started = time.perf_counter()
+        rows = self._connection().execute(
+            "SELECT time, value FROM readings WHERE sensor = ? AND time BETWEEN ? AND ? ORDER BY time",
+            (sensor, start_ms, end_ms),
+        ).fetchall()
+        self._record(sensor, "rows_read", "query_seconds", len(rows), time.perf_counter() - started, "queries")
+        return rows
+
+    def _maybe_prune(self):
+        """Delete readings past the retention period, at most once per PRUNE_INTERVAL."""
+        if not self.retention_days:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < PRUNE_INTERVAL:
+                return
+            self._last_prune = now
+        cutoff = int((now - self.retention_days * 86400) * 1000)
+        connection = self._connection()
+        with connection:
+            deleted = connection.execute("DELETE FROM readings WHERE time < ?", (cutoff,)).rowcount
+        if deleted:
+            logging.info(f'Pruned {deleted} telemetry readings older than {self.retention_days} days')
+
+    def stats(self):
+        """Return per-sensor reading counts, watermarks and write/query throughput."""
+        connection = self._connection()
+        counts = dict(connection.execute("SELECT sensor, COUNT(*) FROM readings GROUP BY sensor").fetchall())
+        watermarks = dict(connection.execute("SELECT sensor, ingested_until FROM watermarks").fetchall())
+        with self._lock:
+            counters = {sensor: dict(values) for sensor, values in self._sensor_counters.items()}
+        sensors = {}
+        for sensor in sorted(set(counts) | set(watermarks) | set(counters)):
+            values = counters.get(sensor, {})
+            write_seconds = values.get("write_seconds", 0.0)
+            query_seconds = values.get("query_seconds", 0.0)
+            sensors[sensor] = {
+                "readings": counts.get(sensor, 0),
+                "ingested_until": format_time(watermarks[sensor]) if sensor in watermarks else None,
+                "rows_written": values.get("rows_written", 0),
+                "writes_per_second": round(values["rows_written"] / write_seconds) if write_seconds else None,
+                "queries": values.get("queries", 0),
+                "queries_per_second": round(values["queries"] / query_seconds) if query_seconds else None,
+                "rows_read_per_second": round(values["rows_read"] / query_seconds) if query_seconds else None,
+            }
+        return {"backend": "sqlite", "sensors": sensors}
+
+
+def get_store():
+    """Return the store configured by TelemetryStorePath (created on first use), or None when it is not set"""
+    global _store
+    db_path = os.environ.get('TelemetryStorePath')
+    if not db_path:
+        return None
+    if _store is None:
+        with _lock:
+            if _store is None:
+                retention_days = float(os.environ.get('TelemetryStoreRetentionDays', DEFAULT_RETENTION_DAYS))
+                logging.info(f'Using SQLite telemetry store at {db_path}')
+                _store = SQLiteTelemetryStore(db_path, retention_days)
+    return _store
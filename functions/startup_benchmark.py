@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark for the Function App entry points.
+
+Each run starts a fresh Python process, as a new consumption-plan instance
+would, and measures for GetTelemetry and SendAction:
+
+- import_ms: loading the function module (what the host does before the
+  first invocation)
+- warm_up_ms: shared_code.service_bus.warm_up(), when --warm-up is given
+- first_request_ms: the first invocation of main() with a valid request
+- warm_request_ms: a second invocation in the same process, which reuses the
+  credential, client and topic sender created by the first
+- deferred_import_ms: importing the Service Bus SDK and azure-identity,
+  which no longer happens at module load
+- time_to_first_request_ms: from process launch to the first response
+
+Without a ServiceBusNamespace setting the first request stops before the
+send (status 500), so first_request_ms only covers validation; set it (and
+sign in with the Azure CLI) to include token acquisition and the send.
+
+Usage:
+    python startup_benchmark.py --runs 5
+    ServiceBusNamespace=<ns>.servicebus.windows.net python startup_benchmark.py --warm-up
+"""
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTION_REQUESTS = {
+    "GetTelemetry": {"SensorKey": "Temperature", "StartDate": "2025-01-01T00:00:00Z", "EndDate": "2025-01-01T01:00:00Z"},
+    "SendAction": {"ActionType": "Camera", "ActionSpec": "{\"operation\": \"capture\"}"},
+}
+
+
+def run_child(function_name, warm_up, launched):
+    """Measure one cold start inside this (fresh) process and print the timings."""
+    functions_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(functions_dir))
+    package = os.path.basename(functions_dir)
+    timings = {}
+
+    started = time.perf_counter()
+    module = importlib.import_module(f"{package}.{function_name}")
+    timings["import_ms"] = (time.perf_counter() - started) * 1000
+
+    import azure.functions as func
+    service_bus = importlib.import_module(f"{package}.shared_code.service_bus")
+
+    if warm_up and service_bus.get_namespace():
+        started = time.perf_counter()
+        service_bus.warm_up()
+        timings["warm_up_ms"] = (time.perf_counter() - started) * 1000
+
+    request = func.HttpRequest(
+        method="POST",
+        url=f"/api/{function_name}",
+        headers={"Content-Type": "application/json"},
+        body=json.dumps(FUNCTION_REQUESTS[function_name]).encode(),
+    )
+    started = time.perf_counter()
+    response = module.main(request)
+    timings["first_request_ms"] = (time.perf_counter() - started) * 1000
+    timings["time_to_first_request_ms"] = (time.time() - launched) * 1000
+    timings["status_code"] = response.status_code
+
+    started = time.perf_counter()
+    module.main(request)
+    timings["warm_request_ms"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    import azure.identity  # noqa: F401
+    import azure.servicebus  # noqa: F401
+    timings["deferred_import_ms"] = (time.perf_counter() - started) * 1000
+    print(json.dumps(timings))
+
+
+def summarize(runs):
+    keys = [key for key in runs[0] if key.endswith("_ms")]
+    summary = {key: round(statistics.median(run[key] for run in runs), 1) for key in keys}
+    summary["max_time_to_first_request_ms"] = round(max(run["time_to_first_request_ms"] for run in runs), 1)
+    summary["status_codes"] = sorted({run["status_code"] for run in runs})
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark for the Function App")
+    parser.add_argument("--functions", nargs="+", choices=sorted(FUNCTION_REQUESTS), default=sorted(FUNCTION_REQUESTS))
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per function")
+    parser.add_argument("--warm-up", action="store_true", help="Run the Service Bus warm-up before the first request")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--launched", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.warm_up, args.launched)
+        return 0
+
+    report = {
+        "runs": args.runs,
+        "warm_up": args.warm_up,
+        "service_bus_configured": bool(os.environ.get("ServiceBusNamespace")),
+    }
+    for function_name in args.functions:
+        runs = []
+        for _ in range(args.runs):
+            command = [sys.executable, os.path.abspath(__file__), "--child", function_name, "--launched", str(time.time())]
+            if args.warm_up:
+                command.append("--warm-up")
+            completed = subprocess.run(command, capture_output=True, text=True, check=True)
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        report[function_name] = summarize(runs)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Write and query throughput benchmark for the telemetry store.
+
+Fills a fresh SQLite store with a history of readings for each sensor, in
+ingest batches the size the Pi pushes, then runs range queries of a few
+window sizes at random positions. Reports per sensor:
+
+- writes_per_second: readings ingested per second
+- ingest_batch_ms: median time of one ingest call
+- <window>_queries_per_second and <window>_query_ms: range queries of that
+  window, with the median number of readings each returned
+
+Usage:
+    python telemetry_store_benchmark.py --days 7 --interval 10
+    python telemetry_store_benchmark.py --db /tmp/telemetry.db --queries 500
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+SENSORS = ("Temperature", "Light", "CPU")
+
+# Query window name -> seconds
+WINDOWS = {"1h": 3600, "1d": 86400, "7d": 7 * 86400}
+
+
+def load_store_module():
+    functions_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(functions_dir))
+    return importlib.import_module(f"{os.path.basename(functions_dir)}.shared_code.telemetry_store")
+
+
+def benchmark_sensor(store, sensor, start_ms, args):
+    """Ingest the history of one sensor, then query it; returns the timings."""
+    interval_ms = int(args.interval * 1000)
+    count = int(args.days * 86400 / args.interval)
+    results = {"readings": count}
+
+    batch_times = []
+    started = time.perf_counter()
+    for offset in range(0, count, args.batch):
+        batch = [(start_ms + i * interval_ms, 20 + random.random() * 10)
+                 for i in range(offset, min(offset + args.batch, count))]
+        batch_started = time.perf_counter()
+        store.ingest(sensor, batch)
+        batch_times.append(time.perf_counter() - batch_started)
+    elapsed = time.perf_counter() - started
+    results["writes_per_second"] = round(count / elapsed)
+    results["ingest_batch_ms"] = round(statistics.median(batch_times) * 1000, 3)
+
+    end_ms = start_ms + count * interval_ms
+    for name, seconds in WINDOWS.items():
+        window_ms = seconds * 1000
+        if window_ms > end_ms - start_ms:
+            continue
+        query_times = []
+        sizes = []
+        for _ in range(args.queries):
+            query_start = random.randint(start_ms, end_ms - window_ms)
+            query_started = time.perf_counter()
+            rows = store.query(sensor, query_start, query_start + window_ms)
+            query_times.append(time.perf_counter() - query_started)
+            sizes.append(len(rows))
+        results[f"{name}_queries_per_second"] = round(len(query_times) / sum(query_times))
+        results[f"{name}_query_ms"] = round(statistics.median(query_times) * 1000, 3)
+        results[f"{name}_readings_per_query"] = round(statistics.median(sizes))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telemetry store throughput benchmark")
+    parser.add_argument("--days", type=float, default=7, help="History per sensor")
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between readings")
+    parser.add_argument("--batch", type=int, default=6, help="Readings per ingest call (one push of one sensor)")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per window size")
+    parser.add_argument("--db", help="Database file (default: a temporary file)")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    telemetry_store = load_store_module()
+    directory = None
+    db_path = args.db
+    if db_path is None:
+        directory = tempfile.TemporaryDirectory()
+        db_path = os.path.join(directory.name, "telemetry.db")
+    store = telemetry_store.SQLiteTelemetryStore(db_path, retention_days=0)
+
+    start_ms = int((time.time() - args.days * 86400) * 1000)
+    report = {"days": args.days, "interval": args.interval, "batch": args.batch, "queries": args.queries}
+    for sensor in SENSORS:
+        report[sensor] = benchmark_sensor(store, sensor, start_ms, args)
+    report["db_bytes"] = os.path.getsize(db_path)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    if directory is not None:
+        directory.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
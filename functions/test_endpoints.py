@@ -72,6 +72,40 @@ def test_send_action(base_url: str, function_key: str) -> bool:
         return False
 
 
+def test_get_telemetry_batch(base_url: str, function_key: str) -> bool:
+    """Test the batch mode of the GetTelemetry endpoint"""
+    url = f"{base_url}/api/GetTelemetry?code={function_key}"
+    
+    # Create test payload: one request per sensor
+    payload = [
+        {
+            "SensorKey": sensor_key,
+            "StartDate": (datetime.now() - timedelta(hours=1)).isoformat() + "Z",
+            "EndDate": datetime.now().isoformat() + "Z"
+        }
+        for sensor_key in ("Temperature", "CPU")
+    ]
+    
+    print("\nTesting GetTelemetry batch mode...")
+    print(f"  URL: {url}")
+    print(f"  Payload: {json.dumps(payload, indent=2)}")
+    
+    try:
+        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"})
+        print(f"  Status Code: {response.status_code}")
+        print(f"  Response: {response.text}")
+        
+        if response.status_code == 200 and len(response.json().get("results", [])) == len(payload):
+            print("✓ GetTelemetry batch test PASSED")
+            return True
+        else:
+            print("✗ GetTelemetry batch test FAILED")
+            return False
+    except Exception as e:
+        print(f"✗ GetTelemetry batch test FAILED with exception: {str(e)}")
+        return False
+
+
 def main():
     if len(sys.argv) < 3:
         print("Usage: python test_endpoints.py <function-app-url> <function-key>")
@@ -88,14 +122,16 @@ def main():
     # Run tests
     test1_passed = test_get_telemetry(base_url, function_key)
     test2_passed = test_send_action(base_url, function_key)
+    test3_passed = test_get_telemetry_batch(base_url, function_key)
     
     # Summary
     print("\n" + "=" * 50)
     print("Test Summary:")
     print(f"  GetTelemetry: {'PASSED' if test1_passed else 'FAILED'}")
     print(f"  SendAction: {'PASSED' if test2_passed else 'FAILED'}")
+    print(f"  GetTelemetry batch: {'PASSED' if test3_passed else 'FAILED'}")
     
-    if test1_passed and test2_passed:
+    if test1_passed and test2_passed and test3_passed:
         print("\n✓ All tests PASSED")
         sys.exit(0)
     else:
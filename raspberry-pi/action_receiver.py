@@ -4,44 +4,49 @@ Raspberry Pi Action Receiver Service
 
 This application runs on the Raspberry Pi and receives action requests
 from Azure Service Bus Action topic. It processes messages based on the
-ActionType field and executes the appropriate action.
+ActionType field and executes the appropriate action. Actions are processed
+by a MessagePump (see message_pump.py), one at a time unless
+ACTION_MAX_CONCURRENT_MESSAGES allows more.
 """
 
-import json
 import logging
 import os
+import signal
 import sys
+import threading
 from datetime import datetime
-from azure.servicebus import ServiceBusClient
+from azure.servicebus import AutoLockRenewer, ServiceBusClient
 from azure.identity import DefaultAzureCredential
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('/var/log/pi-action-receiver.log')
-    ]
-)
+import wire_format
+from message_pump import MessagePump
+
 logger = logging.getLogger(__name__)
 
 
 class ActionReceiver:
     """Handles receiving and processing action messages from Service Bus."""
     
-    def __init__(self, service_bus_namespace, subscription_name):
+    def __init__(self, service_bus_namespace, subscription_name, workers=1, prefetch_count=None,
+                 max_lock_renewal=300):
         """
         Initialize the ActionReceiver.
         
         Args:
             service_bus_namespace: The fully qualified Service Bus namespace (e.g., 'namespace.servicebus.windows.net')
             subscription_name: The name of the subscription to receive from
+            workers: Maximum number of actions executed at once (1 keeps them in order)
+            prefetch_count: Messages the receiver fetches ahead (default: one per worker)
+            max_lock_renewal: Seconds the lock of a message being processed is renewed for
         """
         self.service_bus_namespace = service_bus_namespace
         self.subscription_name = subscription_name
         self.topic_name = "Action"
+        self.workers = workers
+        self.prefetch_count = workers if prefetch_count is None else prefetch_count
+        self.max_lock_renewal = max_lock_renewal
+        self._stop = threading.Event()
         logger.info(f"Initializing ActionReceiver for namespace: {service_bus_namespace}")
         
     def process_camera_action(self, message_body):
@@ -68,8 +73,8 @@ class ActionReceiver:
             message: ServiceBusReceivedMessage object
         """
         try:
-            # Parse the message body
-            message_body = json.loads(str(message))
+            # Decode the body bytes in the format named by the message content_type
+            message_body = wire_format.decode_message(message)
             logger.info(f"Received message: {message_body}")
             
             # Extract ActionType
@@ -81,11 +86,15 @@ class ActionReceiver:
             else:
                 logger.warning(f"Unknown ActionType: {action_type}")
                 
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse message as JSON: {e}")
+        except ValueError as e:
+            logger.error(f"Failed to decode {message.content_type or 'JSON'} message: {e}")
         except Exception as e:
             logger.error(f"Error processing message: {e}", exc_info=True)
             
+    def stop(self):
+        """Stop receiving; run() returns once the actions in flight are done."""
+        self._stop.set()
+        
     def run(self):
         """
         Main loop to receive and process messages from Service Bus.
@@ -99,23 +108,26 @@ class ActionReceiver:
             with ServiceBusClient(self.service_bus_namespace, credential) as client:
                 logger.info(f"Connected to Service Bus: {self.service_bus_namespace}")
                 
-                # Create a receiver for the subscription
-                with client.get_subscription_receiver(
-                    topic_name=self.topic_name,
-                    subscription_name=self.subscription_name,
-                    max_wait_time=5
-                ) as receiver:
+                # Create a receiver for the subscription; locks of long-running actions are renewed
+                with AutoLockRenewer(max_lock_renewal_duration=self.max_lock_renewal) as renewer, \
+                        client.get_subscription_receiver(
+                            topic_name=self.topic_name,
+                            subscription_name=self.subscription_name,
+                            max_wait_time=5,
+                            prefetch_count=self.prefetch_count,
+                            auto_lock_renewer=renewer
+                        ) as receiver:
                     logger.info(f"Listening for messages on topic '{self.topic_name}', subscription '{self.subscription_name}'...")
                     
-                    while True:
-                        # Receive messages in batches
-                        received_msgs = receiver.receive_messages(max_message_count=10, max_wait_time=5)
-                        
-                        for msg in received_msgs:
-                            self.process_message(msg)
-                            # Complete the message to remove it from the subscription
-                            receiver.complete_message(msg)
-                            
+                    # Each message is completed once its action has run
+                    MessagePump(
+                        receiver,
+                        self.process_message,
+                        workers=self.workers,
+                        stop_event=self._stop,
+                        name="actions"
+                    ).run()
+                    
         except KeyboardInterrupt:
             logger.info("Service interrupted by user")
         except Exception as e:
@@ -125,12 +137,24 @@ class ActionReceiver:
 
 def main():
     """Main entry point for the action receiver service."""
+    # Configure logging here rather than on import, so device_agent.py can import this module
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler('/var/log/pi-action-receiver.log')
+        ]
+    )
+    
     # Load environment variables from .env file
     load_dotenv()
     
     # Get configuration from environment variables
     service_bus_namespace = os.getenv('SERVICE_BUS_NAMESPACE')
     subscription_name = os.getenv('ACTION_SUBSCRIPTION_NAME', 'pi-action-subscription')
+    workers = int(os.getenv('ACTION_MAX_CONCURRENT_MESSAGES', 1))
+    prefetch_count = os.getenv('ACTION_PREFETCH_COUNT')
     
     # Validate configuration
     if not service_bus_namespace:
@@ -142,11 +166,20 @@ def main():
     logger.info("=" * 60)
     logger.info(f"Service Bus Namespace: {service_bus_namespace}")
     logger.info(f"Subscription Name: {subscription_name}")
+    logger.info(f"Worker Threads: {workers}")
     logger.info(f"Started at: {datetime.now().isoformat()}")
     logger.info("=" * 60)
     
     # Create and run the receiver
-    receiver = ActionReceiver(service_bus_namespace, subscription_name)
+    receiver = ActionReceiver(
+        service_bus_namespace,
+        subscription_name,
+        workers=workers,
+        prefetch_count=int(prefetch_count) if prefetch_count else None,
+        max_lock_renewal=float(os.getenv('MAX_LOCK_RENEWAL', 300))
+    )
+    # systemctl stop sends SIGTERM: finish the actions in flight before exiting
+    signal.signal(signal.SIGTERM, lambda signum, frame: receiver.stop())
     receiver.run()
 
 
@@ -0,0 +1,275 @@
+"""
+Aggregation of recorded readings for telemetry range requests.
+
+A StartDate..EndDate window can hold far more readings than a caller wants
+to plot, so a request may ask for fewer points instead of the raw readings:
+
+- Resolution: seconds per bucket. Buckets are aligned to multiples of the
+  resolution since the epoch, and each non-empty bucket carries the count,
+  min, max, mean and last value of its readings, plus any Percentiles
+  asked for (e.g. [50, 95]).
+- MaxPoints: at most this many points. With the default Aggregation
+  "buckets", the resolution is chosen so the readings fall into at most
+  MaxPoints buckets; with Aggregation "lttb", MaxPoints readings are
+  selected by Largest-Triangle-Three-Buckets, which keeps the shape of the
+  series (peaks and dips) for plotting.
+
+Everything is computed with NumPy over the columns of a wire_format.Series
+(arrays, or views of the segment store's memory-mapped files), which NumPy
+reads without copying; no reading becomes a Python object. NumPy is optional: without it, requests that ask for
+aggregation are answered with an error, and raw requests are unaffected.
+"""
+
+import math
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import wire_format
+
+BUCKETS = "buckets"
+LTTB = "lttb"
+
+# Buckets a reply may carry, whether asked for by Resolution or MaxPoints
+MAX_BUCKETS = 10000
+
+
+class AggregationRequest:
+    """The aggregation parameters of a telemetry request."""
+
+    __slots__ = ("method", "resolution", "max_points", "percentiles")
+
+    def __init__(self, method=BUCKETS, resolution=None, max_points=None, percentiles=()):
+        self.method = method
+        self.resolution = resolution
+        self.max_points = max_points
+        self.percentiles = tuple(percentiles)
+
+
+def _positive_int(message_body, field):
+    value = message_body.get(field)
+    if value is None:
+        return None
+    if (isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)
+            or value != int(value) or value < 1):
+        raise ValueError(f"{field} must be a positive whole number, not {value!r}")
+    return int(value)
+
+
+def parse_request(message_body):
+    """
+    Read the aggregation parameters of a telemetry request.
+
+    Args:
+        message_body: Dictionary containing the telemetry request
+
+    Returns:
+        AggregationRequest, or None when the request asks for the raw readings
+
+    Raises:
+        ValueError: The parameters are invalid, or NumPy is not installed
+    """
+    resolution = _positive_int(message_body, 'Resolution')
+    max_points = _positive_int(message_body, 'MaxPoints')
+    method = str(message_body.get('Aggregation') or BUCKETS).lower()
+    percentiles = message_body.get('Percentiles') or ()
+    if resolution is None and max_points is None:
+        if 'Aggregation' in message_body or percentiles:
+            raise ValueError("Aggregation and Percentiles need a Resolution or MaxPoints")
+        return None
+
+    if method not in (BUCKETS, LTTB):
+        raise ValueError(f"Unknown Aggregation: {message_body.get('Aggregation')}")
+    if not isinstance(percentiles, (list, tuple)) or not all(
+            isinstance(q, (int, float)) and not isinstance(q, bool) and 0 <= q <= 100 for q in percentiles):
+        raise ValueError("Percentiles must be a list of numbers from 0 to 100")
+    if method == LTTB:
+        if max_points is None or max_points < 3:
+            raise ValueError("LTTB needs a MaxPoints of at least 3")
+        if resolution is not None or percentiles:
+            raise ValueError("LTTB takes MaxPoints only")
+    elif resolution is not None and max_points is not None:
+        raise ValueError("Pass either Resolution or MaxPoints, not both")
+    elif max_points is not None and max_points > MAX_BUCKETS:
+        raise ValueError(f"MaxPoints may be at most {MAX_BUCKETS}")
+    if np is None:
+        raise ValueError("Aggregation needs NumPy, which is not installed on this device")
+    return AggregationRequest(method, resolution, max_points, percentiles)
+
+
+def columns(series):
+    """(times, values) of a Series as NumPy arrays sharing its memory (arrays or strided memoryviews)"""
+    return np.asarray(series.times, dtype=np.int64), np.asarray(series.values, dtype=np.float64)
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def percentile_key(q):
+    """Name of a percentile in a bucket: 95 -> 'p95', 99.9 -> 'p99.9'"""
+    return f"p{q:g}"
+
+
+def resolution_for(times, max_points):
+    """Smallest whole-second resolution that puts the readings into at most ``max_points`` aligned buckets"""
+    span = int(times[-1] - times[0]) + 1
+    if max_points == 1:
+        # One bucket must cover the span wherever the alignment falls
+        return 2 * span
+    # An aligned bucket grid over the span has at most ceil(span / resolution) + 1 buckets
+    return max(1, math.ceil(span / (max_points - 1)))
+
+
+def bucket(times, values, resolution, percentiles=()):
+    """
+    Aggregate readings into aligned buckets.
+
+    Args:
+        times: Sorted epoch seconds (NumPy int64 array)
+        values: The readings (NumPy float64 array)
+        resolution: Seconds per bucket
+        percentiles: Percentiles (0-100) to compute per bucket, interpolated linearly as numpy.percentile does
+
+    Returns:
+        Dictionary of NumPy columns, one entry per non-empty bucket: 'time' (start of the bucket),
+        'count', 'min', 'max', 'mean', 'last' and one 'p<q>' per percentile
+    """
+    if not len(times):
+        empty = np.empty(0)
+        return {key: empty for key in ("time", "count", "min", "max", "mean", "last",
+                                       *map(percentile_key, percentiles))}
+    index = times // resolution
+    # The readings are sorted, so each bucket is a contiguous run
+    starts = np.concatenate(([0], np.flatnonzero(index[1:] != index[:-1]) + 1))
+    ends = np.append(starts[1:], len(values))
+    counts = ends - starts
+    result = {
+        "time": index[starts] * resolution,
+        "count": counts,
+        "min": np.minimum.reduceat(values, starts),
+        "max": np.maximum.reduceat(values, starts),
+        "mean": np.add.reduceat(values, starts) / counts,
+        "last": values[ends - 1],
+    }
+    if percentiles:
+        ordered, offsets = sort_within(values, starts, counts)
+        for q in percentiles:
+            position = (counts - 1) * (q / 100)
+            below = np.floor(position).astype(np.int64)
+            above = np.minimum(below + 1, counts - 1)
+            low, high = ordered[offsets + below], ordered[offsets + above]
+            result[percentile_key(q)] = low + (high - low) * (position - below)
+    return result
+
+
+def sort_within(values, starts, counts):
+    """
+    Sort the readings of each bucket by value.
+
+    Returns:
+        (ordered, offsets): the k-th smallest value of bucket i is ordered[offsets[i] + k]
+    """
+    width = int(counts.max())
+    if len(counts) * width <= 2 * len(values):
+        # Buckets of similar size (regular sampling): one row per bucket, padded with +inf and sorted
+        # along the rows. Much faster than a lexsort, which sorts indices rather than values.
+        bucket_ids = np.repeat(np.arange(len(counts)), counts)
+        rows = np.full((len(counts), width), np.inf)
+        rows[bucket_ids, np.arange(len(values)) - starts[bucket_ids]] = values
+        rows.sort(axis=1)
+        return rows.ravel(), np.arange(len(counts)) * width
+    # Very uneven buckets would need too much padding
+    return values[np.lexsort((values, np.repeat(np.arange(len(counts)), counts)))], starts
+
+
+def lttb(times, values, threshold):
+    """
+    Indices of the readings Largest-Triangle-Three-Buckets keeps.
+
+    The first and last readings are always kept. The others are split into
+    ``threshold - 2`` buckets of equal count, and from each bucket the reading
+    forming the largest triangle with the previously kept reading and the mean
+    of the next bucket is kept.
+
+    Args:
+        times: Sorted epoch seconds (NumPy int64 array)
+        values: The readings (NumPy float64 array)
+        threshold: Number of readings to keep, at least 3
+
+    Returns:
+        NumPy array of indices into times and values, ascending
+    """
+    count = len(values)
+    if threshold >= count:
+        return np.arange(count)
+    x = times.astype(np.float64)
+    # Bucket i holds the readings edges[i]..edges[i + 1] - 1; the first and last readings are not in any
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    sizes = np.diff(edges)
+    # The mean point of each bucket, and of the last reading for the final bucket to aim at
+    mean_x = np.append(np.add.reduceat(x[1:count - 1], edges[:-1] - 1) / sizes, x[-1])
+    mean_y = np.append(np.add.reduceat(values[1:count - 1], edges[:-1] - 1) / sizes, values[-1])
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, count - 1
+    previous = 0
+    # Each choice depends on the previous one, so the loop is over buckets; the work within a bucket is vectorised
+    for i in range(threshold - 2):
+        low, high = edges[i], edges[i + 1]
+        px, py = x[previous], values[previous]
+        # Twice the triangle areas; the factor does not change which is largest
+        areas = np.abs((px - mean_x[i + 1]) * (values[low:high] - py) - (px - x[low:high]) * (mean_y[i + 1] - py))
+        previous = low + int(areas.argmax())
+        kept[i + 1] = previous
+    return kept
+
+
+def aggregate(series, request):
+    """
+    Aggregate the readings of a window as a request asks.
+
+    Args:
+        series: wire_format.Series of the readings in the window
+        request: AggregationRequest from parse_request
+
+    Returns:
+        Dictionary of reply fields: 'sourceReadings' and, for buckets, 'resolution' and 'buckets'
+        (a list of dicts, one per non-empty bucket), or for LTTB, 'aggregation' and 'readings'
+        (a Series)
+    """
+    times, values = columns(series)
+    if request.method == LTTB:
+        kept = lttb(times, values, request.max_points)
+        return {
+            "aggregation": LTTB,
+            "sourceReadings": len(series),
+            # Back to arrays, so the reply packs them like any recorded readings
+            "readings": wire_format.Series(array('q', times[kept].tobytes()), array('d', values[kept].tobytes())),
+        }
+
+    resolution = request.resolution
+    if resolution is None:
+        resolution = resolution_for(times, request.max_points) if len(times) else 1
+    elif len(times) and (times[-1] // resolution - times[0] // resolution) >= MAX_BUCKETS:
+        raise ValueError(f"A Resolution of {resolution}s gives more than {MAX_BUCKETS} buckets in this window; "
+                         f"use a coarser Resolution or MaxPoints")
+    result = bucket(times, values, resolution, request.percentiles)
+    keys = list(result)
+    # One dict per bucket; there are at most MAX_BUCKETS, not one per reading
+    rows = zip(*(result[key].tolist() for key in keys))
+    buckets = []
+    for row in rows:
+        entry = dict(zip(keys, row))
+        entry["time"] = format_time(entry["time"])
+        buckets.append(entry)
+    return {
+        "aggregation": BUCKETS,
+        "resolution": resolution,
+        "sourceReadings": len(series),
+        "buckets": buckets,
+    }
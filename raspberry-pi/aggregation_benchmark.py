@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Time and reply size of aggregated telemetry replies across window sizes.
+
+For windows of 1,000 to 1,000,000 readings (a synthetic CPU-like series at
+one reading a second), it reports per method:
+
+- ms: median time to aggregate the window (aggregation.aggregate)
+- encode_ms: median time to encode the reply in MessagePack
+- reply_bytes: size of the MessagePack reply
+
+The methods are the raw readings (no aggregation), buckets of min, max,
+mean and last at MaxPoints, the same with p50/p95/p99, and LTTB at MaxPoints.
+Run it on the Pi itself (or pin it to one core of a comparable board with
+``taskset -c 0``) for figures that apply to the device.
+
+Usage:
+    python aggregation_benchmark.py
+    python aggregation_benchmark.py --sizes 1000,100000,1000000 --max-points 500 --output results.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from array import array
+
+import numpy as np
+
+import aggregation
+import wire_format
+
+
+def make_series(size, seed):
+    """``size`` readings a second apart: a slow daily cycle, noise and occasional spikes"""
+    rng = np.random.default_rng(seed)
+    times = np.arange(1_700_000_000, 1_700_000_000 + size, dtype=np.int64)
+    values = 30 + 20 * np.sin(times / 86400 * 2 * np.pi) + rng.normal(0, 5, size)
+    values[rng.random(size) < 0.001] = 100.0
+    return wire_format.Series(array('q', times.tobytes()), array('d', np.clip(values, 0, 100).tobytes()))
+
+
+def timed(function, repeat):
+    """Median milliseconds of ``repeat`` calls, and the last result"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 3), result
+
+
+def measure(series, request, repeat):
+    if request is None:
+        ms, fields = 0.0, {"readings": series}
+    else:
+        ms, fields = timed(lambda: aggregation.aggregate(series, request), repeat)
+    reply = {"status": "success", "SensorKey": "CPU", **fields}
+    encode_ms, (data, _) = timed(lambda: wire_format.encode(reply, wire_format.MSGPACK), repeat)
+    return {"ms": ms, "encode_ms": encode_ms, "reply_bytes": len(data)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregation time and reply size benchmark")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="Comma-separated window sizes (readings)")
+    parser.add_argument("--max-points", type=int, default=1000, help="MaxPoints of the aggregated replies")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the median is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    methods = {
+        "raw": None,
+        "buckets": {"MaxPoints": args.max_points},
+        "buckets_percentiles": {"MaxPoints": args.max_points, "Percentiles": [50, 95, 99]},
+        "lttb": {"MaxPoints": args.max_points, "Aggregation": "lttb"},
+    }
+    report = {"max_points": args.max_points, "numpy": np.__version__, "windows": {}}
+    for size in (int(size) for size in args.sizes.split(",")):
+        series = make_series(size, args.seed)
+        report["windows"][str(size)] = {
+            name: measure(series, aggregation.parse_request(body) if body else None, args.repeat)
+            for name, body in methods.items()
+        }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
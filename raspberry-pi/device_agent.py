@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Raspberry Pi Device Agent
+
+Runs the telemetry and action receivers in one asyncio process instead of
+two. Both subscriptions are received over one async ServiceBusClient, so
+the Pi holds one Python interpreter, one DefaultAzureCredential and one AMQP
+connection rather than two of each.
+
+Messages are dispatched to the existing handlers, TelemetryReceiver and
+ActionReceiver.process_message. Those block on sensor reads and camera
+captures, so they run on a thread pool; the event loop only receives,
+sends replies and settles messages, and a slow handler never stalls the
+other subscription. Each subscription has its own AsyncMessagePump (see
+message_pump.py) with the worker and prefetch settings of its receiver.
+
+The agent replaces pi-telemetry-receiver and pi-action-receiver; run either
+the agent or the two services, not both.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from azure.servicebus.aio import AutoLockRenewer, ServiceBusClient
+from azure.identity.aio import DefaultAzureCredential
+from dotenv import load_dotenv
+
+import wire_format
+from action_receiver import ActionReceiver
+from message_pump import AsyncMessagePump
+from sampler import create_sampler
+from segment_store import StoreWriter, create_store
+from telemetry_receiver import MAX_REPLY_BYTES, TelemetryPusher, TelemetryReceiver
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceAgent:
+    """Receives telemetry requests and actions over one Service Bus connection."""
+    
+    def __init__(self, telemetry_receiver, action_receiver):
+        """
+        Initialize the DeviceAgent.
+        
+        Args:
+            telemetry_receiver: TelemetryReceiver whose handlers, subscription and worker settings are used
+            action_receiver: ActionReceiver whose handlers, subscription and worker settings are used
+        """
+        self.telemetry = telemetry_receiver
+        self.actions = action_receiver
+        self.service_bus_namespace = telemetry_receiver.service_bus_namespace
+        self.reply_senders = {}
+        # One thread per worker of either subscription
+        self._executor = ThreadPoolExecutor(
+            max_workers=telemetry_receiver.workers + action_receiver.workers,
+            thread_name_prefix="handler"
+        )
+        self._stop = None
+        self._reply_lock = None
+        logger.info(f"Initializing DeviceAgent for namespace: {self.service_bus_namespace}")
+    
+    async def send_reply(self, client, message, reply_body):
+        """
+        Send the reply to a telemetry request that asked for one.
+        
+        Args:
+            client: The async ServiceBusClient to create the reply sender with
+            message: The request (ServiceBusReceivedMessage)
+            reply_body: Dictionary returned by TelemetryReceiver.process_message
+        """
+        if not message.reply_to:
+            return
+        reply = self.telemetry.build_reply(message, reply_body)
+        # Senders are not safe for concurrent use, even from coroutines
+        async with self._reply_lock:
+            sender = self.reply_senders.get(message.reply_to)
+            if sender is None:
+                sender = self.reply_senders[message.reply_to] = client.get_queue_sender(queue_name=message.reply_to)
+            try:
+                await sender.send_messages(reply)
+                logger.info(f"Sent reply {message.message_id} to {message.reply_to}")
+            except Exception as e:
+                # The requester times out instead; the sender is recreated for the next reply
+                logger.error(f"Failed to send reply {message.message_id} to {message.reply_to}: {e}")
+                self.reply_senders.pop(message.reply_to, None)
+                await sender.close()
+    
+    async def handle_telemetry(self, client, message):
+        """Read the sensor on a worker thread, then reply from the event loop."""
+        loop = asyncio.get_running_loop()
+        reply_body = await loop.run_in_executor(self._executor, self.telemetry.process_message, message)
+        await self.send_reply(client, message, reply_body)
+    
+    async def handle_action(self, message):
+        """Execute the action on a worker thread."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.actions.process_message, message)
+    
+    async def _receive(self, client, renewer, receiver, handler, name):
+        """Pump one subscription until stop() is called; stops the agent if the subscription fails."""
+        try:
+            async with client.get_subscription_receiver(
+                topic_name=receiver.topic_name,
+                subscription_name=receiver.subscription_name,
+                max_wait_time=5,
+                prefetch_count=receiver.prefetch_count,
+                auto_lock_renewer=renewer
+            ) as subscription_receiver:
+                logger.info(f"Listening for messages on topic '{receiver.topic_name}', subscription '{receiver.subscription_name}'...")
+                await AsyncMessagePump(
+                    subscription_receiver,
+                    handler,
+                    workers=receiver.workers,
+                    stop_event=self._stop,
+                    name=name
+                ).run()
+        except Exception:
+            # Take the other subscription down too, so systemd restarts the whole agent
+            self.stop()
+            raise
+    
+    def stop(self):
+        """Stop receiving; run() returns once the messages in flight are settled."""
+        if self._stop is not None:
+            self._stop.set()
+    
+    async def run(self):
+        """
+        Main loop: receive both subscriptions until stop() is called.
+        """
+        logger.info("Starting device agent...")
+        self._stop = asyncio.Event()
+        self._reply_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        # systemctl stop sends SIGTERM: finish the messages in flight before exiting
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+        
+        try:
+            # One credential and one connection for both subscriptions
+            async with DefaultAzureCredential() as credential, \
+                    ServiceBusClient(self.service_bus_namespace, credential) as client, \
+                    AutoLockRenewer(max_lock_renewal_duration=self.telemetry.max_lock_renewal) as renewer:
+                logger.info(f"Connected to Service Bus: {self.service_bus_namespace}")
+                try:
+                    # A failing pump stops the other, which drains its messages in flight; wait for
+                    # both to finish before the senders and the client are closed
+                    results = await asyncio.gather(
+                        self._receive(client, renewer, self.telemetry,
+                                      lambda msg: self.handle_telemetry(client, msg), "telemetry requests"),
+                        self._receive(client, renewer, self.actions, self.handle_action, "actions"),
+                        return_exceptions=True
+                    )
+                finally:
+                    for sender in self.reply_senders.values():
+                        await sender.close()
+                errors = [result for result in results if isinstance(result, BaseException)]
+                for error in errors[1:]:
+                    logger.error(f"The other subscription failed too: {error}")
+                if errors:
+                    raise errors[0]
+        except Exception as e:
+            logger.error(f"Fatal error in agent: {e}", exc_info=True)
+            raise
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    """Main entry point for the device agent."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler('/var/log/pi-device-agent.log')
+        ]
+    )
+    
+    # Load environment variables from .env file
+    load_dotenv()
+    
+    # Same configuration as the two receivers
+    service_bus_namespace = os.getenv('SERVICE_BUS_NAMESPACE')
+    subscription_name = os.getenv('SUBSCRIPTION_NAME', 'pi-telemetry-subscription')
+    action_subscription_name = os.getenv('ACTION_SUBSCRIPTION_NAME', 'pi-action-subscription')
+    prefetch_count = os.getenv('PREFETCH_COUNT')
+    action_prefetch_count = os.getenv('ACTION_PREFETCH_COUNT')
+    max_lock_renewal = float(os.getenv('MAX_LOCK_RENEWAL', 300))
+    
+    # Validate configuration
+    if not service_bus_namespace:
+        logger.error("SERVICE_BUS_NAMESPACE environment variable is not set")
+        sys.exit(1)
+    
+    logger.info("=" * 60)
+    logger.info("Raspberry Pi Device Agent")
+    logger.info("=" * 60)
+    logger.info(f"Service Bus Namespace: {service_bus_namespace}")
+    logger.info(f"Telemetry Subscription: {subscription_name}")
+    logger.info(f"Action Subscription: {action_subscription_name}")
+    logger.info(f"Started at: {datetime.now().isoformat()}")
+    logger.info("=" * 60)
+    
+    # Record the sensors in the background, so range requests are answered from memory
+    sampler = create_sampler()
+    sampler.start()
+    
+    # Keep the samples on disk, if configured, so history survives restarts
+    store = create_store()
+    writer = None
+    if store is not None:
+        writer = StoreWriter(store, sampler, flush_interval=float(os.getenv('STORE_FLUSH_INTERVAL', 600)))
+        writer.start()
+    
+    # Push readings to the cloud-side store, if configured
+    ingest_url = os.getenv('INGEST_URL')
+    if ingest_url:
+        TelemetryPusher(
+            ingest_url,
+            sampler,
+            function_key=os.getenv('INGEST_FUNCTION_KEY'),
+            push_interval=float(os.getenv('PUSH_INTERVAL', 60)),
+            content_type=os.getenv('INGEST_CONTENT_TYPE', wire_format.MSGPACK)
+        ).start()
+    
+    agent = DeviceAgent(
+        TelemetryReceiver(
+            service_bus_namespace,
+            subscription_name,
+            workers=int(os.getenv('MAX_CONCURRENT_MESSAGES', 4)),
+            prefetch_count=int(prefetch_count) if prefetch_count else None,
+            max_lock_renewal=max_lock_renewal,
+            sampler=sampler,
+            store=store,
+            max_reply_bytes=int(os.getenv('MAX_REPLY_BYTES', MAX_REPLY_BYTES))
+        ),
+        ActionReceiver(
+            service_bus_namespace,
+            action_subscription_name,
+            workers=int(os.getenv('ACTION_MAX_CONCURRENT_MESSAGES', 1)),
+            prefetch_count=int(action_prefetch_count) if action_prefetch_count else None,
+            max_lock_renewal=max_lock_renewal
+        )
+    )
+    try:
+        asyncio.run(agent.run())
+    finally:
+        # Flush the samples recorded since the last flush
+        if writer is not None:
+            writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,11 @@ mkdir -p "$INSTALL_DIR"
 # Copy application files
 echo "Copying application files..."
 cp telemetry_receiver.py "$INSTALL_DIR/"
+cp wire_format.py "$INSTALL_DIR/"
+cp message_pump.py "$INSTALL_DIR/"
+cp sampler.py "$INSTALL_DIR/"
+cp aggregation.py "$INSTALL_DIR/"
+cp segment_store.py "$INSTALL_DIR/"
 cp requirements.txt "$INSTALL_DIR/"
 cp .env.example "$INSTALL_DIR/"
 
@@ -32,6 +32,8 @@ mkdir -p "$INSTALL_DIR"
 # Copy application files
 echo "2. Copying application files..."
 cp "$SCRIPT_DIR/action_receiver.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/wire_format.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/message_pump.py" "$INSTALL_DIR/"
 cp "$SCRIPT_DIR/requirements.txt" "$INSTALL_DIR/"
 
 # Make the script executable
@@ -0,0 +1,116 @@
+#!/bin/bash
+
+# Installation script for the Raspberry Pi Device Agent
+# This script installs the device agent, which replaces the telemetry and action
+# receiver services, as a systemd service on Ubuntu 22.04
+
+set -e
+
+echo "=========================================="
+echo "Raspberry Pi Device Agent Installation"
+echo "=========================================="
+echo ""
+
+# Check if running as root
+if [ "$EUID" -ne 0 ]; then
+    echo "Please run as root (use sudo)"
+    exit 1
+fi
+
+# Define installation paths
+INSTALL_DIR="/opt/pi-device-agent"
+SERVICE_FILE="pi-device-agent.service"
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+echo "Installing device agent..."
+echo "Installation directory: $INSTALL_DIR"
+echo ""
+
+# Create installation directory
+echo "1. Creating installation directory..."
+mkdir -p "$INSTALL_DIR"
+
+# Copy application files
+echo "2. Copying application files..."
+cp "$SCRIPT_DIR/device_agent.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/telemetry_receiver.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/action_receiver.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/wire_format.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/message_pump.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/sampler.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/aggregation.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/segment_store.py" "$INSTALL_DIR/"
+cp "$SCRIPT_DIR/requirements.txt" "$INSTALL_DIR/"
+
+# Make the script executable
+chmod +x "$INSTALL_DIR/device_agent.py"
+
+# Create Python virtual environment
+echo "3. Creating Python virtual environment..."
+python3 -m venv "$INSTALL_DIR/venv"
+
+# Install dependencies
+echo "4. Installing Python dependencies..."
+"$INSTALL_DIR/venv/bin/pip" install --upgrade pip
+"$INSTALL_DIR/venv/bin/pip" install -r "$INSTALL_DIR/requirements.txt"
+
+# Create .env file if it doesn't exist
+if [ ! -f "$INSTALL_DIR/.env" ]; then
+    echo "5. Creating .env configuration file..."
+    cp "$SCRIPT_DIR/.env.example" "$INSTALL_DIR/.env"
+    echo "   ⚠️  Please edit $INSTALL_DIR/.env with your configuration"
+else
+    echo "5. .env file already exists, skipping..."
+fi
+
+# Set proper ownership
+echo "6. Setting file ownership..."
+if id "pi" &>/dev/null; then
+    chown -R pi:pi "$INSTALL_DIR"
+else
+    echo "   ⚠️  User 'pi' not found. Please set ownership manually."
+fi
+
+# Install systemd service
+echo "7. Installing systemd service..."
+cp "$SCRIPT_DIR/$SERVICE_FILE" /etc/systemd/system/
+systemctl daemon-reload
+
+# Create log file directory
+echo "8. Setting up logging..."
+touch /var/log/pi-device-agent.log
+if id "pi" &>/dev/null; then
+    chown pi:pi /var/log/pi-device-agent.log
+fi
+chmod 644 /var/log/pi-device-agent.log
+
+# The agent replaces the two receiver services
+echo "9. Disabling the separate receiver services..."
+for service in pi-telemetry-receiver pi-action-receiver; do
+    if systemctl is-enabled --quiet "$service" 2>/dev/null || systemctl is-active --quiet "$service"; then
+        systemctl disable --now "$service"
+        echo "   Disabled $service"
+    fi
+done
+
+echo ""
+echo "=========================================="
+echo "Installation Complete!"
+echo "=========================================="
+echo ""
+echo "Next steps:"
+echo "1. Edit the configuration file:"
+echo "   sudo nano $INSTALL_DIR/.env"
+echo ""
+echo "2. Start the service:"
+echo "   sudo systemctl start pi-device-agent"
+echo ""
+echo "3. Enable auto-start on boot:"
+echo "   sudo systemctl enable pi-device-agent"
+echo ""
+echo "4. Check service status:"
+echo "   sudo systemctl status pi-device-agent"
+echo ""
+echo "5. View logs:"
+echo "   sudo journalctl -u pi-device-agent -f"
+echo ""
@@ -0,0 +1,350 @@
+"""
+Concurrent processing of the messages of one Service Bus receiver.
+
+The receivers used to process each received batch one message at a time, so
+one slow sensor read or camera capture held up every message queued behind
+it. MessagePump hands the messages to a bounded pool of worker threads
+instead:
+
+- At most ``workers`` messages are processed at once. The pump only asks the
+  receiver for as many messages as there are idle workers, so apart from the
+  receiver's prefetch buffer no message is locked while it waits for a worker.
+- ServiceBusReceiver is not thread-safe, so workers never settle messages.
+  A finished message is handed back to the pump thread, which completes it
+  (or abandons it, if the handler raised) between receive calls.
+- Locks are renewed by the receiver's AutoLockRenewer while a handler runs;
+  a message whose lock was lost anyway is counted, and delivered again by
+  Service Bus.
+- stop() stops receiving. run() then waits up to ``drain_timeout`` seconds
+  for the messages in flight, settles them and returns. Prefetched messages
+  that were never handed to a worker are released when the receiver closes.
+
+stats() reports throughput, processing time and queue lag: the time between
+a message being enqueued and a worker starting on it.
+
+AsyncMessagePump does the same for a receiver of azure.servicebus.aio, with
+coroutine handlers on one event loop (see device_agent.py).
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from azure.servicebus.exceptions import MessageLockLostError
+
+logger = logging.getLogger(__name__)
+
+# Seconds a receive call waits while messages are in flight, so finished ones are settled promptly
+SETTLE_INTERVAL = 0.2
+
+# Processing times and queue lags kept for the percentiles in stats()
+SAMPLE_SIZE = 1000
+
+
+def queue_lag(message, now):
+    """Seconds between a message being enqueued and ``now``; None if the message has no enqueued time"""
+    enqueued = getattr(message, "enqueued_time_utc", None)
+    if enqueued is None:
+        return None
+    if enqueued.tzinfo is None:
+        enqueued = enqueued.replace(tzinfo=timezone.utc)
+    return max(0.0, (now - enqueued).total_seconds())
+
+
+def percentiles(name, samples):
+    """Median and 95th percentile, in milliseconds, of samples in seconds"""
+    if not samples:
+        return {f"{name}_p50_ms": None, f"{name}_p95_ms": None}
+    ordered = sorted(samples)
+    return {
+        f"{name}_p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+        f"{name}_p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+    }
+
+
+class MessagePump:
+    """Receives messages from one receiver and processes them on a pool of worker threads."""
+    
+    def __init__(self, receiver, handler, workers=4, max_wait_time=5, drain_timeout=30, stats_interval=60,
+                 stop_event=None, name="messages"):
+        """
+        Initialize the MessagePump.
+        
+        Args:
+            receiver: ServiceBusReceiver in PEEK_LOCK mode, ideally with an AutoLockRenewer
+            handler: Function called with each message on a worker thread; the message is
+                completed when it returns and abandoned when it raises
+            workers: Maximum number of messages processed at once
+            max_wait_time: Seconds a receive call waits when no message is in flight
+            drain_timeout: Seconds run() waits for the messages in flight after stop()
+            stats_interval: Seconds between two stats log lines (0 disables them)
+            stop_event: threading.Event that stops the pump when set (default: a new one)
+            name: Name used in thread names and log lines
+        """
+        self.receiver = receiver
+        self.handler = handler
+        self.workers = workers
+        self.max_wait_time = max_wait_time
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        self.name = name
+        self._stop = stop_event or threading.Event()
+        # Messages the workers finished, with whether the handler succeeded; settled by the pump thread
+        self._finished = queue.Queue()
+        # Only the pump thread changes this
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._counters = {"received": 0, "completed": 0, "abandoned": 0, "lock_lost": 0, "settle_errors": 0}
+        self._max_in_flight = 0
+        self._processing_times = deque(maxlen=SAMPLE_SIZE)
+        self._queue_lags = deque(maxlen=SAMPLE_SIZE)
+        self._started = None
+    
+    def stop(self):
+        """Stop receiving; run() returns once the messages in flight are settled."""
+        self._stop.set()
+    
+    def _record_received(self, messages):
+        now = datetime.now(timezone.utc)
+        lags = [queue_lag(message, now) for message in messages]
+        with self._lock:
+            self._counters["received"] += len(messages)
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+            self._queue_lags.extend(lag for lag in lags if lag is not None)
+    
+    def _record_processed(self, message, started, error):
+        if error is not None:
+            logger.error(f"Error processing message {message.message_id}: {error}", exc_info=error)
+        with self._lock:
+            self._processing_times.append(time.perf_counter() - started)
+    
+    def _record_settled(self, message, counter, error=None):
+        if counter == "lock_lost":
+            logger.warning(f"Lock of message {message.message_id} was lost; it will be delivered again")
+        elif error is not None:
+            logger.error(f"Failed to settle message {message.message_id}: {error}")
+        with self._lock:
+            self._counters[counter] += 1
+    
+    def _process(self, message):
+        started = time.perf_counter()
+        error = None
+        try:
+            self.handler(message)
+        except Exception as e:
+            error = e
+        self._record_processed(message, started, error)
+        self._finished.put((message, error is None))
+    
+    def _settle(self, message, succeeded):
+        self._in_flight -= 1
+        error = None
+        try:
+            if succeeded:
+                self.receiver.complete_message(message)
+                counter = "completed"
+            else:
+                self.receiver.abandon_message(message)
+                counter = "abandoned"
+        except MessageLockLostError:
+            counter = "lock_lost"
+        except Exception as e:
+            counter, error = "settle_errors", e
+        self._record_settled(message, counter, error)
+    
+    def _settle_finished(self, timeout=None):
+        """Settle every finished message, waiting up to ``timeout`` seconds for the first one."""
+        try:
+            item = self._finished.get(timeout=timeout) if timeout else self._finished.get_nowait()
+        except queue.Empty:
+            return
+        while True:
+            self._settle(*item)
+            try:
+                item = self._finished.get_nowait()
+            except queue.Empty:
+                return
+    
+    def _dispatch(self, executor, messages):
+        for message in messages:
+            self._in_flight += 1
+            executor.submit(self._process, message)
+        self._record_received(messages)
+    
+    def _drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        if self._in_flight:
+            logger.info(f"Draining {self._in_flight} {self.name} in flight...")
+        while self._in_flight and time.monotonic() < deadline:
+            self._settle_finished(timeout=SETTLE_INTERVAL)
+        if self._in_flight:
+            logger.warning(f"{self._in_flight} {self.name} still in flight after {self.drain_timeout}s; "
+                           f"they will be delivered again")
+    
+    def run(self):
+        """Receive and process messages until stop() is called, then drain."""
+        self._started = time.monotonic()
+        last_stats = self._started
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.name}-worker")
+        logger.info(f"Processing {self.name} on up to {self.workers} worker threads")
+        try:
+            while not self._stop.is_set():
+                self._settle_finished()
+                idle_workers = self.workers - self._in_flight
+                if idle_workers == 0:
+                    self._settle_finished(timeout=SETTLE_INTERVAL)
+                    continue
+                messages = self.receiver.receive_messages(
+                    max_message_count=idle_workers,
+                    max_wait_time=SETTLE_INTERVAL if self._in_flight else self.max_wait_time
+                )
+                self._dispatch(executor, messages)
+                if self.stats_interval and time.monotonic() - last_stats >= self.stats_interval:
+                    logger.info(f"{self.name} stats: {self.stats()}")
+                    last_stats = time.monotonic()
+        except KeyboardInterrupt:
+            logger.info(f"Interrupted, stopping {self.name}")
+        finally:
+            self._drain()
+            executor.shutdown(wait=not self._in_flight, cancel_futures=True)
+            logger.info(f"{self.name} stats: {self.stats()}")
+    
+    def stats(self):
+        """Counters, throughput, processing time and queue lag percentiles"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self._started else 0
+            processed = self._counters["completed"] + self._counters["abandoned"]
+            return {
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "max_in_flight": self._max_in_flight,
+                **self._counters,
+                "messages_per_second": round(processed / elapsed, 2) if elapsed else None,
+                **percentiles("processing", self._processing_times),
+                **percentiles("queue_lag", self._queue_lags),
+            }
+
+
+class AsyncMessagePump(MessagePump):
+    """
+    MessagePump for an azure.servicebus.aio receiver.
+    
+    The handler is a coroutine function and runs as a task on the event loop;
+    a handler that blocks (a sensor read, a camera capture) must hand that work
+    to a thread, e.g. with loop.run_in_executor(). Receiving and settling happen
+    in run(), so the receiver is only ever used by one coroutine at a time.
+    """
+    
+    def __init__(self, receiver, handler, workers=4, max_wait_time=5, drain_timeout=30, stats_interval=60,
+                 stop_event=None, name="messages"):
+        """
+        Initialize the AsyncMessagePump.
+        
+        Args:
+            receiver: azure.servicebus.aio ServiceBusReceiver in PEEK_LOCK mode
+            handler: Coroutine function awaited with each message; the message is completed
+                when it returns and abandoned when it raises
+            workers: Maximum number of messages processed at once
+            max_wait_time: Seconds a receive call waits when no message is in flight
+            drain_timeout: Seconds run() waits for the messages in flight after stop()
+            stats_interval: Seconds between two stats log lines (0 disables them)
+            stop_event: asyncio.Event that stops the pump when set (default: a new one)
+            name: Name used in log lines
+        """
+        super().__init__(receiver, handler, workers=workers, max_wait_time=max_wait_time,
+                         drain_timeout=drain_timeout, stats_interval=stats_interval,
+                         stop_event=stop_event or asyncio.Event(), name=name)
+        self._finished = asyncio.Queue()
+        self._tasks = set()
+    
+    async def _process(self, message):
+        started = time.perf_counter()
+        error = None
+        try:
+            await self.handler(message)
+        except Exception as e:
+            error = e
+        self._record_processed(message, started, error)
+        self._finished.put_nowait((message, error is None))
+    
+    async def _settle(self, message, succeeded):
+        self._in_flight -= 1
+        error = None
+        try:
+            if succeeded:
+                await self.receiver.complete_message(message)
+                counter = "completed"
+            else:
+                await self.receiver.abandon_message(message)
+                counter = "abandoned"
+        except MessageLockLostError:
+            counter = "lock_lost"
+        except Exception as e:
+            counter, error = "settle_errors", e
+        self._record_settled(message, counter, error)
+    
+    async def _settle_finished(self, timeout=None):
+        """Settle every finished message, waiting up to ``timeout`` seconds for the first one."""
+        try:
+            if timeout:
+                item = await asyncio.wait_for(self._finished.get(), timeout)
+            else:
+                item = self._finished.get_nowait()
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            return
+        while True:
+            await self._settle(*item)
+            try:
+                item = self._finished.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+    
+    def _dispatch(self, messages):
+        for message in messages:
+            self._in_flight += 1
+            task = asyncio.create_task(self._process(message))
+            # Keep a reference until the task is done
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._record_received(messages)
+    
+    async def _drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        if self._in_flight:
+            logger.info(f"Draining {self._in_flight} {self.name} in flight...")
+        while self._in_flight and time.monotonic() < deadline:
+            await self._settle_finished(timeout=SETTLE_INTERVAL)
+        if self._in_flight:
+            logger.warning(f"{self._in_flight} {self.name} still in flight after {self.drain_timeout}s; "
+                           f"they will be delivered again")
+            for task in self._tasks:
+                task.cancel()
+    
+    async def run(self):
+        """Receive and process messages until stop() is called, then drain."""
+        self._started = time.monotonic()
+        last_stats = self._started
+        logger.info(f"Processing {self.name} on up to {self.workers} concurrent tasks")
+        try:
+            while not self._stop.is_set():
+                await self._settle_finished()
+                idle_workers = self.workers - self._in_flight
+                if idle_workers == 0:
+                    await self._settle_finished(timeout=SETTLE_INTERVAL)
+                    continue
+                messages = await self.receiver.receive_messages(
+                    max_message_count=idle_workers,
+                    max_wait_time=SETTLE_INTERVAL if self._in_flight else self.max_wait_time
+                )
+                self._dispatch(messages)
+                if self.stats_interval and time.monotonic() - last_stats >= self.stats_interval:
+                    logger.info(f"{self.name} stats: {self.stats()}")
+                    last_stats = time.monotonic()
+        finally:
+            await self._drain()
+            logger.info(f"{self.name} stats: {self.stats()}")
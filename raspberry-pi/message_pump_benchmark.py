@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Throughput and queue lag of the message pump for different worker counts.
+
+Messages arrive at a fixed rate at an in-process stand-in for a Service Bus
+receiver, whose complete call takes a simulated round trip. Most handlers are
+short (a sensor read); a fraction is slow (a camera capture). For the old
+sequential loop (receive up to 10 messages, process and complete them one at
+a time) and for a MessagePump with each worker count, it reports:
+
+- messages_per_second: messages settled per second
+- queue_lag_p50_ms / queue_lag_p95_ms: time from enqueueing until processing
+  started
+- processing_p50_ms / processing_p95_ms: handler time
+- backlog: messages still queued when the arrivals stopped
+
+Usage:
+    python message_pump_benchmark.py
+    python message_pump_benchmark.py --rate 50 --slow-fraction 0.1 --workers 1,2,4,8,16 --output results.json
+"""
+
+import argparse
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from message_pump import MessagePump, percentiles, queue_lag
+
+
+class BenchmarkMessage:
+    """The message properties the pump reads."""
+    
+    def __init__(self, message_id, slow):
+        self.message_id = message_id
+        self.slow = slow
+        self.enqueued_time_utc = datetime.now(timezone.utc)
+
+
+class BenchmarkReceiver:
+    """A queue with the receive/complete/abandon calls of a ServiceBusReceiver."""
+    
+    def __init__(self, settle_seconds):
+        self.messages = queue.Queue()
+        self.settle_seconds = settle_seconds
+        self.settled = 0
+    
+    def receive_messages(self, max_message_count=1, max_wait_time=None):
+        try:
+            messages = [self.messages.get(timeout=max_wait_time)]
+        except queue.Empty:
+            return []
+        while len(messages) < max_message_count:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+    
+    def complete_message(self, message):
+        time.sleep(self.settle_seconds)
+        self.settled += 1
+    
+    abandon_message = complete_message
+
+
+def produce(receiver, args, stop):
+    """Enqueue messages at args.rate per second for args.duration seconds"""
+    interval = 1 / args.rate
+    started = time.monotonic()
+    for i in range(int(args.rate * args.duration)):
+        delay = started + i * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        receiver.messages.put(BenchmarkMessage(i, random.random() < args.slow_fraction))
+    stop.set()
+
+
+def make_handler(args):
+    def handler(message):
+        time.sleep(args.slow_ms / 1000 if message.slow else args.fast_ms / 1000)
+    return handler
+
+
+def run_sequential(receiver, handler, stop):
+    """The previous receive loop: up to 10 messages, processed and completed one at a time"""
+    lags, processing = [], []
+    started = time.monotonic()
+    while not (stop.is_set() and receiver.messages.empty()):
+        for message in receiver.receive_messages(max_message_count=10, max_wait_time=0.2):
+            lags.append(queue_lag(message, datetime.now(timezone.utc)))
+            handler_started = time.perf_counter()
+            handler(message)
+            processing.append(time.perf_counter() - handler_started)
+            receiver.complete_message(message)
+    elapsed = time.monotonic() - started
+    return {
+        "messages_per_second": round(receiver.settled / elapsed, 2),
+        **percentiles("queue_lag", lags),
+        **percentiles("processing", processing),
+    }
+
+
+def run_pump(receiver, handler, stop, workers):
+    pump = MessagePump(receiver, handler, workers=workers, max_wait_time=0.2, stats_interval=0, name="benchmark")
+
+    def stop_when_empty():
+        stop.wait()
+        while not receiver.messages.empty():
+            time.sleep(0.05)
+        pump.stop()
+    threading.Thread(target=stop_when_empty, daemon=True).start()
+    pump.run()
+    stats = pump.stats()
+    return {key: stats[key] for key in ("messages_per_second", "queue_lag_p50_ms", "queue_lag_p95_ms",
+                                        "processing_p50_ms", "processing_p95_ms", "max_in_flight")}
+
+
+def measure(args, run):
+    random.seed(args.seed)
+    receiver = BenchmarkReceiver(args.settle_ms / 1000)
+    stop = threading.Event()
+    producer = threading.Thread(target=produce, args=(receiver, args, stop), daemon=True)
+    producer.start()
+    backlog = []
+
+    def record_backlog():
+        stop.wait()
+        backlog.append(receiver.messages.qsize())
+    threading.Thread(target=record_backlog, daemon=True).start()
+    results = run(receiver, make_handler(args), stop)
+    return {**results, "backlog": backlog[0] if backlog else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message pump throughput and queue lag benchmark")
+    parser.add_argument("--rate", type=float, default=20, help="Messages arriving per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of arrivals")
+    parser.add_argument("--fast-ms", type=float, default=20, help="Handler time of most messages")
+    parser.add_argument("--slow-ms", type=float, default=1000, help="Handler time of slow messages")
+    parser.add_argument("--slow-fraction", type=float, default=0.05, help="Fraction of slow messages")
+    parser.add_argument("--settle-ms", type=float, default=5, help="Time of one complete call (a round trip)")
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma-separated worker counts")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = {key: getattr(args, key) for key in ("rate", "duration", "fast_ms", "slow_ms", "slow_fraction", "settle_ms")}
+    report["sequential"] = measure(args, run_sequential)
+    for workers in (int(count) for count in args.workers.split(",")):
+        report[f"workers_{workers}"] = measure(
+            args, lambda receiver, handler, stop: run_pump(receiver, handler, stop, workers))
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
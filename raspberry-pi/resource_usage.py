@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Resident memory and CPU of the Pi services: two receivers against the agent.
+
+Two modes:
+
+- ``--units`` / ``--pids`` samples running processes for ``--duration``
+  seconds. Run it once with the two receiver services running and once with
+  pi-device-agent instead.
+- ``--compare-startup`` starts both setups itself, without connecting to
+  Service Bus. Each process imports its modules and creates its credential
+  and client; the setups are then measured side by side. This isolates what
+  the second interpreter, SDK import and credential cost. A connected
+  device adds the AMQP connections, buffers and threads on top.
+
+Per process and in total it reports:
+
+- rss_mb: resident set size
+- pss_mb: proportional set size (shared pages divided among the processes
+  sharing them); the fair measure of what a setup costs the device
+- uss_mb: memory private to the process
+- cpu_percent: CPU used over the sampling period (``--units`` / ``--pids``)
+- startup_cpu_seconds: CPU used to start up (``--compare-startup``)
+
+Usage:
+    python resource_usage.py --units pi-telemetry-receiver pi-action-receiver --duration 300
+    python resource_usage.py --units pi-device-agent --duration 300
+    python resource_usage.py --compare-startup --output results.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# Start-up of each setup, up to the point where a connected service would open its connection
+TWO_PROCESSES = {
+    "telemetry_receiver": """
+import sys
+from azure.identity import DefaultAzureCredential
+from azure.servicebus import ServiceBusClient
+import telemetry_receiver
+credential = DefaultAzureCredential()
+client = ServiceBusClient("example.servicebus.windows.net", credential)
+receiver = telemetry_receiver.TelemetryReceiver("example.servicebus.windows.net", "pi-telemetry-subscription")
+print("ready", flush=True)
+sys.stdin.read()
+""",
+    "action_receiver": """
+import sys
+from azure.identity import DefaultAzureCredential
+from azure.servicebus import ServiceBusClient
+import action_receiver
+credential = DefaultAzureCredential()
+client = ServiceBusClient("example.servicebus.windows.net", credential)
+receiver = action_receiver.ActionReceiver("example.servicebus.windows.net", "pi-action-subscription")
+print("ready", flush=True)
+sys.stdin.read()
+""",
+}
+AGENT = {
+    "device_agent": """
+import asyncio, sys
+from azure.identity.aio import DefaultAzureCredential
+from azure.servicebus.aio import ServiceBusClient
+import device_agent
+
+async def start():
+    credential = DefaultAzureCredential()
+    client = ServiceBusClient("example.servicebus.windows.net", credential)
+    agent = device_agent.DeviceAgent(
+        device_agent.TelemetryReceiver("example.servicebus.windows.net", "pi-telemetry-subscription"),
+        device_agent.ActionReceiver("example.servicebus.windows.net", "pi-action-subscription"))
+    print("ready", flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+
+asyncio.run(start())
+""",
+}
+
+
+def memory_mb(pid):
+    """rss/pss/uss of a process, in MB, from /proc/<pid>/smaps_rollup"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    uss = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    return {"rss_mb": round(fields["Rss"] / 1024, 1), "pss_mb": round(fields["Pss"] / 1024, 1),
+            "uss_mb": round(uss / 1024, 1)}
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process, in seconds"""
+    with open(f"/proc/{pid}/stat") as f:
+        # The command name may contain spaces; the fields after it are space-separated
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def unit_pid(unit):
+    """Main PID of a running systemd unit"""
+    pid = subprocess.run(["systemctl", "show", "--property", "MainPID", "--value", unit],
+                         capture_output=True, text=True, check=True).stdout.strip()
+    if pid in ("", "0"):
+        raise SystemExit(f"{unit} is not running")
+    return int(pid)
+
+
+def total(processes, keys):
+    return {key: round(sum(process[key] for process in processes.values()), 1) for key in keys}
+
+
+def sample(pids, duration):
+    """Memory at the end of ``duration`` seconds and CPU used during them"""
+    before = {name: cpu_seconds(pid) for name, pid in pids.items()}
+    started = time.monotonic()
+    time.sleep(duration)
+    elapsed = time.monotonic() - started
+    processes = {}
+    for name, pid in pids.items():
+        cpu = cpu_seconds(pid) - before[name]
+        processes[name] = {**memory_mb(pid), "cpu_percent": round(100 * cpu / elapsed, 2)}
+    return {"processes": processes, "total": total(processes, ("rss_mb", "pss_mb", "uss_mb", "cpu_percent"))}
+
+
+def start_setup(setup):
+    """Start the processes of a setup and wait until each has started up"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    processes = {}
+    for name, code in setup.items():
+        process = subprocess.Popen([sys.executable, "-c", code], cwd=directory, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if process.stdout.readline().strip() != "ready":
+            raise SystemExit(f"{name} failed to start")
+        processes[name] = process
+    return processes
+
+
+def compare_startup():
+    report = {}
+    for setup_name, setup in (("two_processes", TWO_PROCESSES), ("agent", AGENT)):
+        processes = start_setup(setup)
+        try:
+            measured = {name: {**memory_mb(process.pid), "startup_cpu_seconds": round(cpu_seconds(process.pid), 2)}
+                        for name, process in processes.items()}
+        finally:
+            for process in processes.values():
+                process.stdin.close()
+                process.wait()
+        report[setup_name] = {
+            "processes": measured,
+            "total": total(measured, ("rss_mb", "pss_mb", "uss_mb", "startup_cpu_seconds")),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and CPU of the Pi services")
+    parser.add_argument("--units", nargs="+", help="systemd units to sample")
+    parser.add_argument("--pids", nargs="+", type=int, help="Process ids to sample")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to sample CPU over")
+    parser.add_argument("--compare-startup", action="store_true",
+                        help="Start both setups without connecting and compare them")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    if args.compare_startup:
+        report = compare_startup()
+    elif args.units or args.pids:
+        pids = {unit: unit_pid(unit) for unit in args.units or ()}
+        pids.update({str(pid): pid for pid in args.pids or ()})
+        report = {"duration": args.duration, **sample(pids, args.duration)}
+    else:
+        parser.error("pass --units, --pids or --compare-startup")
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
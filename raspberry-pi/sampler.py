@@ -0,0 +1,286 @@
+"""
+On-device sampling of the sensors into fixed-size ring buffers.
+
+A background thread reads each sensor at its own interval and records
+(epoch second, value) samples in that sensor's RingBuffer. Telemetry range
+requests are answered from the buffers without touching the hardware, and
+the TelemetryPusher pushes from them.
+
+A RingBuffer allocates its two arrays (times and values) once, at its full
+capacity: 16 bytes a sample. Memory use is therefore fixed by configuration
+(capacity = history / interval per sensor), and no sample is ever a Python
+object. Samples are appended in time order, so the buffer holds two sorted
+runs, from the write position to the end and from the start to the write
+position; a range query is a bisect in each run, and its result a
+wire_format.Series sliced out of the arrays.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+import wire_format
+
+logger = logging.getLogger(__name__)
+
+# Seconds of samples kept per sensor when SAMPLE_HISTORY is not set
+DEFAULT_HISTORY = 86400
+
+
+def read_cpu_times():
+    """Return (idle, total) jiffies from the first line of /proc/stat"""
+    with open('/proc/stat') as f:
+        fields = [int(field) for field in f.readline().split()[1:]]
+    # idle + iowait count as idle time
+    return fields[3] + fields[4], sum(fields)
+
+
+def cpu_percent(before, after):
+    """CPU utilisation (%) between two read_cpu_times() samples"""
+    total = after[1] - before[1]
+    busy = total - (after[0] - before[0])
+    return round(100 * busy / total, 1) if total else 0.0
+
+
+def read_temperature():
+    """SoC temperature in degrees Celsius"""
+    # The kernel reports millidegrees
+    with open('/sys/class/thermal/thermal_zone0/temp') as f:
+        return round(int(f.read().strip()) / 1000, 1)
+
+
+def parse_time(value):
+    """Epoch seconds of an ISO 8601 time ('2025-01-01T00:00:00Z') or a number; raises ValueError"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if not isinstance(value, str):
+        raise ValueError(f"Not a time: {value!r}")
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+class RingBuffer:
+    """The most recent ``capacity`` samples of one sensor, in two preallocated arrays."""
+    
+    def __init__(self, capacity):
+        """
+        Initialize the RingBuffer.
+        
+        Args:
+            capacity: Number of samples kept; the oldest is overwritten when the buffer is full
+        """
+        if capacity < 1:
+            raise ValueError("A ring buffer needs a capacity of at least 1")
+        self.capacity = capacity
+        self.times = array('q', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        # Index the next sample is written to
+        self._next = 0
+        self._count = 0
+        # The sampler thread appends while receiver threads query
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return self._count
+    
+    @property
+    def nbytes(self):
+        """Memory held by the samples, whether or not the buffer is full"""
+        return self.capacity * (self.times.itemsize + self.values.itemsize)
+    
+    def append(self, timestamp, value):
+        """
+        Record a sample.
+        
+        Args:
+            timestamp: Epoch seconds, not older than the previous sample
+            value: The reading
+        """
+        with self._lock:
+            # Index -1 is the last slot, which holds the newest sample once the buffer has wrapped
+            if self._count and timestamp < self.times[self._next - 1]:
+                raise ValueError("Samples must be appended in time order")
+            self.times[self._next] = timestamp
+            self.values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+    
+    def _runs(self):
+        """Index ranges holding the samples, oldest run first"""
+        if self._count < self.capacity:
+            return ((0, self._count),)
+        return ((self._next, self.capacity), (0, self._next))
+    
+    def query(self, start, end):
+        """
+        Samples recorded between two times.
+        
+        Args:
+            start: Epoch seconds, inclusive
+            end: Epoch seconds, inclusive
+        
+        Returns:
+            wire_format.Series of the samples, oldest first
+        """
+        times, values = array('q'), array('d')
+        with self._lock:
+            for lo, hi in self._runs():
+                left = bisect_left(self.times, start, lo, hi)
+                right = bisect_right(self.times, end, left, hi)
+                times += self.times[left:right]
+                values += self.values[left:right]
+        return wire_format.Series(times, values)
+    
+    def latest(self):
+        """The newest sample as (epoch seconds, value), or None when the buffer is empty"""
+        with self._lock:
+            if not self._count:
+                return None
+            return self.times[self._next - 1], self.values[self._next - 1]
+    
+    def oldest(self):
+        """The oldest sample as (epoch seconds, value), or None when the buffer is empty"""
+        with self._lock:
+            if not self._count:
+                return None
+            index = self._runs()[0][0]
+            return self.times[index], self.values[index]
+
+
+class Sampler:
+    """Reads each sensor at its own interval into a RingBuffer per sensor."""
+    
+    def __init__(self, intervals, history=DEFAULT_HISTORY):
+        """
+        Initialize the Sampler.
+        
+        Args:
+            intervals: Sensor key ('Temperature', 'CPU') -> seconds between two samples;
+                0 leaves the sensor out, as are sensors without a reader
+            history: Seconds of samples kept per sensor; sets the capacity of each buffer
+        """
+        self.readers = {"Temperature": read_temperature, "CPU": self._read_cpu}
+        self.intervals = {
+            sensor_key: interval for sensor_key, interval in intervals.items()
+            if interval > 0 and sensor_key in self.readers
+        }
+        self.buffers = {
+            sensor_key: RingBuffer(max(1, math.ceil(history / interval)))
+            for sensor_key, interval in self.intervals.items()
+        }
+        self._cpu_times = None
+        self._stop = threading.Event()
+    
+    def _read_cpu(self):
+        # Utilisation since the previous sample rather than a short extra sample; None the first time
+        cpu_times = read_cpu_times()
+        previous, self._cpu_times = self._cpu_times, cpu_times
+        return cpu_percent(previous, cpu_times) if previous is not None else None
+    
+    def sample(self, sensor_key, now=None):
+        """
+        Take one reading of a sensor into its buffer.
+        
+        Args:
+            sensor_key: The sensor to read
+            now: Epoch seconds of the sample (default: the current time)
+        """
+        try:
+            value = self.readers[sensor_key]()
+        except OSError as e:
+            logger.warning(f"Failed to sample {sensor_key}: {e}")
+            return
+        if value is None:
+            return
+        try:
+            self.buffers[sensor_key].append(int(time.time()) if now is None else now, value)
+        except ValueError as e:
+            # The clock was set back; samples resume once it passes the newest one
+            logger.warning(f"Dropped {sensor_key} sample: {e}")
+    
+    def buffer(self, sensor_key):
+        """The buffer of a sensor, by case-insensitive key; None if the sensor is not sampled"""
+        for key, buffer in self.buffers.items():
+            if key.lower() == sensor_key.lower():
+                return buffer
+        return None
+    
+    def query(self, sensor_key, start, end):
+        """
+        Samples of a sensor between two times.
+        
+        Args:
+            sensor_key: The sensor, case-insensitive
+            start: Epoch seconds, inclusive
+            end: Epoch seconds, inclusive
+        
+        Returns:
+            wire_format.Series of the samples, or None if the sensor is not sampled
+        """
+        buffer = self.buffer(sensor_key)
+        return buffer.query(start, end) if buffer is not None else None
+    
+    def run(self):
+        """Sample every sensor when it is due until stop() is called."""
+        due = {sensor_key: time.monotonic() for sensor_key in self.intervals}
+        while self.intervals:
+            now = time.monotonic()
+            for sensor_key in [key for key, when in due.items() if when <= now]:
+                self.sample(sensor_key)
+                if sensor_key not in self.intervals:
+                    del due[sensor_key]
+                    continue
+                # Scheduled from the previous due time, so the interval does not drift
+                due[sensor_key] = max(due[sensor_key] + self.intervals[sensor_key], now)
+            if not due or self._stop.wait(max(0.0, min(due.values()) - time.monotonic())):
+                return
+    
+    def start(self):
+        for sensor_key, interval in self.intervals.items():
+            buffer = self.buffers[sensor_key]
+            logger.info(f"Sampling {sensor_key} every {interval:g}s, keeping {buffer.capacity} samples "
+                        f"({buffer.nbytes / 1024:.0f} KiB)")
+        threading.Thread(target=self.run, name="sampler", daemon=True).start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def stats(self):
+        """Per sensor: samples held, capacity, bytes and the time range covered"""
+        stats = {}
+        for sensor_key, buffer in self.buffers.items():
+            oldest, latest = buffer.oldest(), buffer.latest()
+            stats[sensor_key] = {
+                "samples": len(buffer),
+                "capacity": buffer.capacity,
+                "bytes": buffer.nbytes,
+                "oldest": oldest[0] if oldest else None,
+                "latest": latest[0] if latest else None,
+            }
+        return stats
+
+
+def create_sampler():
+    """
+    Create a Sampler from the environment.
+
+    SAMPLE_INTERVAL (default 10) is the interval of every sensor, unless
+    TEMPERATURE_SAMPLE_INTERVAL or CPU_SAMPLE_INTERVAL overrides it. There is
+    no light sensor to sample.
+    SAMPLE_HISTORY (default 86400) is the seconds of samples kept per sensor.
+    """
+    interval = float(os.getenv('SAMPLE_INTERVAL', 10))
+    return Sampler(
+        {
+            "Temperature": float(os.getenv('TEMPERATURE_SAMPLE_INTERVAL', interval)),
+            "CPU": float(os.getenv('CPU_SAMPLE_INTERVAL', interval)),
+        },
+        history=float(os.getenv('SAMPLE_HISTORY', DEFAULT_HISTORY))
+    )
@@ -0,0 +1,521 @@
+"""
+Durable on-device history of the sensors in append-only segment files.
+
+The Sampler's ring buffers only live as long as the process. The segment
+store keeps weeks of samples on the SD card, written so as to wear it as
+little as possible:
+
+- A segment is a file of fixed-size records: epoch seconds (int64) and value
+  (float64), 16 bytes, in the machine's byte order. Records are only ever
+  appended, in time order. A segment covers SEGMENT_SECONDS (one day) of
+  samples, or that many records' worth of time in a downsampled tier.
+- A StoreWriter appends the samples recorded since the last flush every
+  STORE_FLUSH_INTERVAL seconds, as one sequential write per sensor followed
+  by one fdatasync. Samples are never written one at a time, and no file is
+  rewritten in place. The ring buffer holds the samples until they are
+  flushed, so the flush interval only bounds what a power cut loses.
+- Older segments are compacted into coarser tiers. STORE_TIERS lists
+  resolution:days pairs, "0:30,60:365,3600:3650" by default: the raw
+  samples are kept 30 days, then as 1-minute means for a year, then as
+  hourly means for ten years. A segment past its tier's retention is
+  downsampled into the next tier (one sequential write) and deleted; the
+  last tier's segments are just deleted. Means of means are unweighted
+  (records carry no count; see downsample()).
+- Segments are memory-mapped for reading. Each keeps a sparse index of the
+  time of every INDEX_STRIDE-th record (one per 64 KiB), so a range query
+  bisects the index and then one 64 KiB block, touching a few pages of the
+  file. The result is a wire_format.Series of memoryviews into the mapping:
+  no record is copied or becomes a Python object. A window that spans
+  several segments, or the samples not yet flushed, is joined with one copy.
+
+A record torn by a power cut (a file whose size is not a multiple of 16) is
+truncated when the segment is opened.
+"""
+
+import logging
+import mmap
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+import wire_format
+
+logger = logging.getLogger(__name__)
+
+# Bytes of one (time, value) record
+RECORD_SIZE = 16
+
+# Seconds a raw segment covers; a segment of a tier with resolution r covers r times as long
+SEGMENT_SECONDS = 86400
+
+# Records between two entries of a segment's sparse index (64 KiB of records)
+INDEX_STRIDE = 4096
+
+# (resolution in seconds, retention in days); resolution 0 is the raw samples
+DEFAULT_TIERS = "0:30,60:365,3600:3650"
+
+# Seconds between two compaction and retention passes
+MAINTENANCE_INTERVAL = 3600
+
+
+def parse_tiers(text):
+    """
+    Parse a STORE_TIERS value.
+
+    Args:
+        text: Comma-separated resolution:days pairs, finest first, starting with the raw tier (0)
+
+    Returns:
+        List of (resolution seconds, retention seconds); raises ValueError if the tiers are invalid
+    """
+    tiers = []
+    for pair in text.split(","):
+        try:
+            resolution, days = (float(part) for part in pair.split(":"))
+        except ValueError:
+            raise ValueError(f"Not a resolution:days pair: {pair!r}") from None
+        tiers.append((int(resolution), days * 86400))
+    if not tiers or tiers[0][0] != 0:
+        raise ValueError("The first tier must be the raw samples (resolution 0)")
+    for (finer, _), (coarser, _) in zip(tiers, tiers[1:]):
+        # Buckets and segments of a coarser tier must be made of whole ones of the finer tier
+        if coarser <= finer or coarser % max(finer, 1):
+            raise ValueError(f"Tier resolution {coarser} is not a multiple of the previous tier's {finer}")
+    return tiers
+
+
+def tier_name(resolution):
+    return "raw" if resolution == 0 else f"{resolution}s"
+
+
+def records(times, values):
+    """Interleave two columns into record bytes"""
+    data = bytearray(RECORD_SIZE * len(times))
+    view = memoryview(data)
+    view.cast("q")[0::2] = times if isinstance(times, memoryview) else memoryview(times)
+    view.cast("d")[1::2] = values if isinstance(values, memoryview) else memoryview(values)
+    return data
+
+
+def series(data):
+    """A wire_format.Series viewing record bytes (a memoryview or bytearray) without copying them"""
+    view = memoryview(data)
+    return wire_format.Series(view.cast("q")[0::2], view.cast("d")[1::2])
+
+
+def downsample(times, values, resolution):
+    """
+    Mean of the records in each bucket of ``resolution`` seconds.
+
+    Records carry no count, so compacting an already downsampled tier (1-minute
+    means into hourly ones) weights every minute equally: an hour whose minutes
+    were only partly sampled gets the mean of the minute means, not of the raw
+    samples. With regular sampling every minute has the same count and the two
+    agree.
+
+    Returns:
+        (times, values) arrays, one record per non-empty bucket, timed at the start of the bucket
+    """
+    bucket_times, means = array("q"), array("d")
+    bucket, total, count = None, 0.0, 0
+    for timestamp, value in zip(times, values):
+        start = timestamp - timestamp % resolution
+        if start != bucket:
+            if count:
+                bucket_times.append(bucket)
+                means.append(total / count)
+            bucket, total, count = start, 0.0, 0
+        total += value
+        count += 1
+    if count:
+        bucket_times.append(bucket)
+        means.append(total / count)
+    return bucket_times, means
+
+
+class Segment:
+    """One append-only file of records, memory-mapped for reading."""
+
+    def __init__(self, path, start):
+        """
+        Open (or create) a segment.
+
+        Args:
+            path: The segment file
+            start: Epoch seconds the segment's span starts at
+        """
+        self.path = path
+        self.start = start
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size % RECORD_SIZE:
+                logger.warning(f"Truncating a torn record at the end of {path}")
+                size -= size % RECORD_SIZE
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        self.count = 0
+        self.index = []
+        self._map = None
+        self._remap(size // RECORD_SIZE)
+
+    def _remap(self, count):
+        """Map the file's first ``count`` records and extend the sparse index over them"""
+        if count:
+            with open(self.path, "rb") as f:
+                new_map = mmap.mmap(f.fileno(), count * RECORD_SIZE, access=mmap.ACCESS_READ)
+            self._release()
+            self._map = new_map
+        self.count = count
+        times = self.times()
+        self.index.extend(times[position] for position in range(len(self.index) * INDEX_STRIDE, count, INDEX_STRIDE))
+
+    def _release(self):
+        if self._map is None:
+            return
+        try:
+            self._map.close()
+        except BufferError:
+            # Query results still view it; it is unmapped when the last of them is released
+            pass
+        self._map = None
+
+    def times(self):
+        """Times of the records, as a strided view of the mapping"""
+        if self._map is None:
+            return memoryview(b"").cast("q")
+        return memoryview(self._map).cast("q")[0::2]
+
+    def values(self):
+        if self._map is None:
+            return memoryview(b"").cast("d")
+        return memoryview(self._map).cast("d")[1::2]
+
+    def latest(self):
+        """Epoch seconds of the newest record, or None when the segment is empty"""
+        return self.times()[self.count - 1] if self.count else None
+
+    def append(self, data):
+        """
+        Append record bytes in one write, sync them to the card and map them.
+
+        Args:
+            data: Whole records, newer than the segment's newest
+
+        Returns:
+            Number of bytes written
+        """
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        self._remap(self.count + len(data) // RECORD_SIZE)
+        return len(data)
+
+    def _bisect(self, timestamp, bisect):
+        """Position of ``timestamp`` by ``bisect`` (bisect_left or bisect_right), via the sparse index"""
+        # The answer lies in the block between the index entries on either side of the timestamp
+        block = bisect(self.index, timestamp)
+        lo = max(0, (block - 1) * INDEX_STRIDE)
+        hi = min(self.count, block * INDEX_STRIDE)
+        return bisect(self.times(), timestamp, lo, hi)
+
+    def query(self, start, end):
+        """Records between two times (inclusive) as a memoryview of the mapping; empty if there are none"""
+        if not self.count:
+            return memoryview(b"")
+        lo = self._bisect(start, bisect_left)
+        hi = self._bisect(end, bisect_right)
+        return memoryview(self._map)[lo * RECORD_SIZE:max(lo, hi) * RECORD_SIZE]
+
+    def close(self):
+        self._release()
+        self.count = 0
+
+
+class SegmentStore:
+    """Segments of every sensor and tier under one directory: <path>/<sensor>/<tier>/<start>.seg"""
+
+    def __init__(self, path, tiers=None):
+        """
+        Open the store, loading the segments already on disk.
+
+        Args:
+            path: Directory of the store; created if missing
+            tiers: List of (resolution seconds, retention seconds), as returned by parse_tiers
+        """
+        self.path = path
+        self.tiers = tiers if tiers is not None else parse_tiers(DEFAULT_TIERS)
+        # (sensor key, tier number) -> segments, oldest first
+        self.segments = {}
+        # Record bytes written (raw and downsampled), and raw samples written, for write amplification
+        self.bytes_written = 0
+        self.samples_written = 0
+        # The writer thread appends and compacts while receiver threads query
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        names = {tier_name(resolution): number for number, (resolution, _) in enumerate(self.tiers)}
+        for sensor_key in sorted(os.listdir(self.path)):
+            for name, number in names.items():
+                directory = os.path.join(self.path, sensor_key, name)
+                if not os.path.isdir(directory):
+                    continue
+                segments = []
+                for start in sorted(int(file_name[:-4]) for file_name in os.listdir(directory)
+                                    if file_name.endswith(".seg")):
+                    segment = Segment(os.path.join(directory, f"{start}.seg"), start)
+                    if segment.count:
+                        segments.append(segment)
+                    else:
+                        # Created by an append that never got to write
+                        segment.close()
+                        os.unlink(segment.path)
+                self.segments[(sensor_key, number)] = segments
+        stats = self.stats()
+        logger.info(f"Opened segment store {self.path}: {sum(s['records'] for s in stats.values())} records "
+                    f"in {sum(s['segments'] for s in stats.values())} segments")
+
+    def span(self, tier):
+        """Seconds one segment of a tier covers"""
+        return SEGMENT_SECONDS * max(self.tiers[tier][0], 1)
+
+    def latest(self, sensor_key):
+        """Epoch seconds of the newest record of a sensor in any tier, or None"""
+        with self._lock:
+            return self._latest(sensor_key)
+
+    def _latest(self, sensor_key):
+        # The finest tier holds the newest records
+        for tier in range(len(self.tiers)):
+            segments = self.segments.get((sensor_key, tier))
+            if segments:
+                return segments[-1].latest()
+        return None
+
+    def append(self, sensor_key, times, values, tier=0):
+        """
+        Append records to a tier; records not newer than the sensor's newest in that tier are skipped.
+
+        Args:
+            sensor_key: The sensor
+            times: Epoch seconds, ascending
+            values: The values
+            tier: Tier number (0: raw samples)
+
+        Returns:
+            Number of records written
+        """
+        with self._lock:
+            return self._append(sensor_key, times, values, tier)
+
+    def _append(self, sensor_key, times, values, tier):
+        # append() with the lock held
+        span = self.span(tier)
+        written = 0
+        segments = self.segments.setdefault((sensor_key, tier), [])
+        newest = segments[-1].latest() if segments and segments[-1].count else None
+        position = bisect_right(times, newest) if newest is not None else 0
+        # One write per segment the records fall into (normally one)
+        while position < len(times):
+            start = times[position] - times[position] % span
+            end = bisect_left(times, start + span, position)
+            if not segments or segments[-1].start != start:
+                directory = os.path.join(self.path, sensor_key, tier_name(self.tiers[tier][0]))
+                os.makedirs(directory, exist_ok=True)
+                segments.append(Segment(os.path.join(directory, f"{start}.seg"), start))
+            self.bytes_written += segments[-1].append(records(times[position:end], values[position:end]))
+            written += end - position
+            position = end
+        if tier == 0:
+            self.samples_written += written
+        return written
+
+    def query(self, sensor_key, start, end, recent=None):
+        """
+        Records of a sensor between two times, from every tier.
+
+        Args:
+            sensor_key: The sensor
+            start: Epoch seconds, inclusive
+            end: Epoch seconds, inclusive
+            recent: RingBuffer of the sensor, for the samples after the newest flushed one
+
+        Returns:
+            wire_format.Series of the records, oldest first
+        """
+        pieces = []
+        with self._lock:
+            # Tiers hold disjoint times, older in the coarser ones
+            for tier in reversed(range(len(self.tiers))):
+                for segment in self.segments.get((sensor_key, tier), ()):
+                    if segment.start <= end and segment.start + self.span(tier) > start:
+                        piece = segment.query(start, end)
+                        if piece:
+                            pieces.append(piece)
+            stored = self._latest(sensor_key)
+        if recent is not None:
+            tail = recent.query(start if stored is None else max(start, stored + 1), end)
+            if len(tail):
+                pieces.append(records(tail.times, tail.values))
+        if len(pieces) == 1:
+            return series(pieces[0])
+        return series(b"".join(pieces))
+
+    def flush(self, sampler):
+        """
+        Append each sensor's samples recorded since its newest stored one.
+
+        Args:
+            sampler: Sampler whose ring buffers are flushed
+
+        Returns:
+            Number of samples written
+        """
+        written = 0
+        for sensor_key, buffer in sampler.buffers.items():
+            newest = buffer.latest()
+            stored = self.latest(sensor_key)
+            if newest is None or (stored is not None and newest[0] <= stored):
+                continue
+            if stored is not None and buffer.oldest()[0] > stored + 1:
+                logger.warning(f"{sensor_key} samples were overwritten before they were flushed; "
+                               f"flush more often than SAMPLE_HISTORY")
+            readings = buffer.query(buffer.oldest()[0] if stored is None else stored + 1, newest[0])
+            written += self.append(sensor_key, readings.times, readings.values)
+        return written
+
+    def maintain(self, now=None):
+        """
+        Compact the segments past their tier's retention into the next tier, and delete the last tier's.
+
+        Args:
+            now: Epoch seconds (default: the current time)
+        """
+        now = time.time() if now is None else now
+        for sensor_key in sorted({sensor_key for sensor_key, _ in self.segments}):
+            for tier, (_, retention) in enumerate(self.tiers):
+                with self._lock:
+                    expired = [segment for segment in self.segments.get((sensor_key, tier), ())
+                               if segment.start + self.span(tier) <= now - retention]
+                for segment in expired:
+                    compacted = None
+                    if tier + 1 < len(self.tiers):
+                        # Only this thread changes the segment, so it is read without the lock
+                        compacted = downsample(segment.times(), segment.values(), self.tiers[tier + 1][0])
+                    # The downsampled records appear and the segment disappears in one critical
+                    # section, so a query never sees the window twice (or not at all)
+                    with self._lock:
+                        if compacted is not None:
+                            # Written and synced before the segment is deleted; records already
+                            # compacted by an interrupted pass are skipped
+                            self._append(sensor_key, *compacted, tier + 1)
+                        self.segments[(sensor_key, tier)].remove(segment)
+                        count = segment.count
+                        segment.close()
+                        os.unlink(segment.path)
+                    if compacted is not None:
+                        logger.info(f"Compacted {count} {sensor_key} records of {segment.path} "
+                                    f"into {len(compacted[0])} in the {tier_name(self.tiers[tier + 1][0])} tier")
+                    else:
+                        logger.info(f"Deleted {sensor_key} segment {segment.path} past its retention")
+
+    def stats(self):
+        """Per sensor and tier: segments, records and bytes on disk"""
+        with self._lock:
+            return {
+                f"{sensor_key}/{tier_name(self.tiers[tier][0])}": {
+                    "segments": len(segments),
+                    "records": sum(segment.count for segment in segments),
+                    "bytes": sum(segment.count for segment in segments) * RECORD_SIZE,
+                }
+                for (sensor_key, tier), segments in sorted(self.segments.items()) if segments
+            }
+
+    def close(self):
+        with self._lock:
+            for segments in self.segments.values():
+                for segment in segments:
+                    segment.close()
+
+
+class StoreWriter:
+    """Flushes the Sampler's ring buffers into a SegmentStore periodically, and compacts it."""
+
+    def __init__(self, store, sampler, flush_interval=600):
+        """
+        Initialize the StoreWriter.
+
+        Args:
+            store: SegmentStore to write to
+            sampler: Sampler whose buffers are flushed
+            flush_interval: Seconds between two flushes
+        """
+        self.store = store
+        self.sampler = sampler
+        self.flush_interval = flush_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._maintained = 0.0
+
+    def flush(self):
+        try:
+            written = self.store.flush(self.sampler)
+            if written:
+                logger.info(f"Flushed {written} samples to {self.store.path}")
+            if time.monotonic() - self._maintained >= MAINTENANCE_INTERVAL:
+                self.store.maintain()
+                self._maintained = time.monotonic()
+        except OSError as e:
+            # The samples stay in the ring buffers and are flushed next time
+            logger.error(f"Failed to flush samples to {self.store.path}: {e}")
+
+    def run(self):
+        """Flush until stop() is called."""
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        for sensor_key, buffer in self.sampler.buffers.items():
+            if buffer.capacity * self.sampler.intervals.get(sensor_key, 0) < 2 * self.flush_interval:
+                logger.warning(f"The {sensor_key} ring buffer holds less than two flush intervals; "
+                               f"raise SAMPLE_HISTORY or lower STORE_FLUSH_INTERVAL")
+        self._thread = threading.Thread(target=self.run, name="segment-store", daemon=True)
+        self._thread.start()
+        logger.info(f"Flushing samples to {self.store.path} every {self.flush_interval:g}s")
+
+    def stop(self):
+        """Stop the thread and flush what it has not, so a restart loses nothing."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self.store.close()
+
+
+def create_store():
+    """
+    Create a SegmentStore from the environment, or None when STORE_PATH is not set.
+
+    STORE_TIERS (default "0:30,60:365,3600:3650") lists the tiers as
+    resolution:days pairs.
+    """
+    path = os.getenv('STORE_PATH')
+    if not path:
+        return None
+    tiers = parse_tiers(os.getenv('STORE_TIERS', DEFAULT_TIERS))
+    try:
+        return SegmentStore(path, tiers)
+    except OSError as e:
+        # The receiver still answers from the ring buffers
+        logger.error(f"Cannot open the segment store at {path}, keeping no history on disk: {e}")
+        return None
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Write amplification and query latency of the segment store.
+
+Run it on the device's SD card (``--path`` on the card's filesystem), not on
+a tmpfs: write amplification is read from the bytes the kernel sent to the
+block device (/proc/self/io write_bytes), which a tmpfs never does.
+
+Writes: one sensor sampled once a second is written for ``--write-hours``
+simulated hours with each flush interval of ``--flush-intervals``, each
+flush followed by fdatasync as the StoreWriter does. The baseline appends
+and syncs every sample on its own, as a naive logger would. Per setup:
+
+- samples: samples written
+- payload_bytes: 16 bytes a sample
+- device_bytes: bytes written to the block device (data, file system metadata
+  and journal)
+- write_amplification: device_bytes / payload_bytes
+- syncs: fdatasync calls
+- seconds: wall time
+
+Queries: a store of ``--days`` days of once-a-second samples is built, and
+windows from one minute to the whole store are queried. Per window:
+
+- readings: records in the window
+- query_ms: median time of SegmentStore.query (the records are not read)
+- aggregate_ms / aggregate_cold_ms: median time of the query plus
+  aggregation to 1000 buckets, which reads every record, with the store's
+  pages in the page cache and after reopening the store and dropping them
+
+open_cold_ms is the time to open the store (mapping every segment and
+building the sparse indexes) with nothing cached.
+
+Compaction: the time to compact the store into 1-minute means, keeping the
+newest ``--raw-days`` days raw, and the bytes that writes.
+
+Usage:
+    python segment_store_benchmark.py --path /var/lib/pi-telemetry/benchmark
+    python segment_store_benchmark.py --days 30 --write-hours 2 --flush-intervals 10,60,600 --output results.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from array import array
+
+import segment_store
+from segment_store import SegmentStore, parse_tiers
+
+try:
+    import aggregation
+except ImportError:
+    aggregation = None
+
+# Midnight UTC, so the store's segments are whole days
+START = 1_700_006_400
+
+
+def device_write_bytes():
+    """Bytes this process has caused to be written to block devices"""
+    with open("/proc/self/io") as f:
+        for line in f:
+            if line.startswith("write_bytes:"):
+                return int(line.split()[1])
+    return 0
+
+
+def samples(start, count):
+    """``count`` once-a-second samples from ``start``"""
+    times = array("q", range(start, start + count))
+    values = array("d", (20 + (i % 600) / 60 for i in range(count)))
+    return times, values
+
+
+def measure_writes(directory, seconds, flush_interval):
+    """Write ``seconds`` samples in flushes of ``flush_interval`` samples (0: one write per sample)"""
+    store = SegmentStore(directory, parse_tiers("0:30"))
+    times, values = samples(START, seconds)
+    chunk = max(1, flush_interval)
+    before = device_write_bytes()
+    started = time.perf_counter()
+    for position in range(0, seconds, chunk):
+        store.append("CPU", times[position:position + chunk], values[position:position + chunk])
+    elapsed = time.perf_counter() - started
+    device_bytes = device_write_bytes() - before
+    store.close()
+    payload = seconds * segment_store.RECORD_SIZE
+    return {
+        "samples": seconds,
+        "payload_bytes": payload,
+        "device_bytes": device_bytes,
+        "write_amplification": round(device_bytes / payload, 2),
+        "syncs": -(-seconds // chunk),
+        "seconds": round(elapsed, 2),
+    }
+
+
+def drop_cache(store):
+    """Evict the store's files from the page cache, so the next query reads the card"""
+    for segments in store.segments.values():
+        for segment in segments:
+            fd = os.open(segment.path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def median_ms(function, repeat, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 3)
+
+
+def measure_queries(path, tiers, days, repeat, report):
+    """
+    Query windows of the store at ``path`` into ``report``; reopens it with a
+    cold page cache for the cold timings. Returns the open store.
+    """
+    stores = [SegmentStore(path, tiers)]
+
+    def reopen():
+        # Mapped pages stay cached while they are mapped, so close the store before dropping them
+        stores[0].close()
+        drop_cache(stores[0])
+        stores[0] = SegmentStore(path, tiers)
+
+    end = START + days * 86400 - 1
+    windows = {"1m": 60, "1h": 3600, "1d": 86400, "7d": 7 * 86400, f"{days}d": days * 86400}
+    report["open_cold_ms"] = median_ms(reopen, repeat)
+    report["windows"] = {}
+    for name, seconds in windows.items():
+        if seconds > days * 86400:
+            continue
+        start = end - seconds + 1
+        query = lambda: stores[0].query("CPU", start, end)
+        result = {"readings": len(query()), "query_ms": median_ms(query, repeat)}
+        if aggregation is not None and aggregation.np is not None:
+            request = aggregation.parse_request({"MaxPoints": 1000})
+            aggregate = lambda: aggregation.aggregate(query(), request)
+            result["aggregate_ms"] = median_ms(aggregate, repeat)
+            result["aggregate_cold_ms"] = median_ms(aggregate, repeat, before=reopen)
+        report["windows"][name] = result
+    return stores[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment store write amplification and query latency benchmark")
+    parser.add_argument("--path", help="Directory to create the benchmark stores in (default: the current one)")
+    parser.add_argument("--days", type=int, default=30, help="Days of once-a-second samples for the query benchmark")
+    parser.add_argument("--raw-days", type=int, default=7, help="Days kept raw when compacting")
+    parser.add_argument("--write-hours", type=float, default=1, help="Simulated hours written per flush interval")
+    parser.add_argument("--flush-intervals", default="10,60,600", help="Comma-separated flush intervals (seconds)")
+    parser.add_argument("--baseline-samples", type=int, default=2000, help="Samples written one by one")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per query measurement; the median is reported")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="segment-store-benchmark-", dir=args.path or ".")
+    report = {"writes": {}}
+    try:
+        report["writes"]["per_sample"] = measure_writes(os.path.join(root, "per_sample"), args.baseline_samples, 0)
+        for interval in (int(interval) for interval in args.flush_intervals.split(",")):
+            report["writes"][f"flush_{interval}s"] = measure_writes(
+                os.path.join(root, f"flush_{interval}"), int(args.write_hours * 3600), interval)
+
+        # A day at a time, as a store that has been flushing for a month would hold
+        tiers = parse_tiers(f"0:{args.raw_days},60:3650")
+        store = SegmentStore(os.path.join(root, "query"), tiers)
+        for day in range(args.days):
+            store.append("CPU", *samples(START + day * 86400, 86400))
+        report["store"] = store.stats()
+        store.close()
+        report["queries"] = {}
+        store = measure_queries(os.path.join(root, "query"), tiers, args.days, args.repeat, report["queries"])
+
+        written = store.bytes_written
+        started = time.perf_counter()
+        store.maintain(now=START + args.days * 86400)
+        report["compaction"] = {
+            "seconds": round(time.perf_counter() - started, 2),
+            "bytes_written": store.bytes_written - written,
+            "store": store.stats(),
+        }
+        store.close()
+    finally:
+        shutil.rmtree(root)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
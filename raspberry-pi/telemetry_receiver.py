@@ -4,79 +4,240 @@ Raspberry Pi Telemetry Receiver Service
 
 This application runs on the Raspberry Pi and receives telemetry requests
 from Azure Service Bus Telemetry topic. It processes messages based on the
-SensorKey field and executes the appropriate action.
+SensorKey field and executes the appropriate action. When a request names a
+reply-to queue (GetTelemetry waits for the answer), the readings are sent
+there on the requester's session, correlated by the request's message id.
+Requests are processed concurrently by a MessagePump (see message_pump.py).
+
+A Sampler (see sampler.py) records the sensors in the background, so a
+request for a StartDate..EndDate window is answered from the recorded
+samples; the hardware is only read when no sample falls in a window that
+includes the current time (a past window without samples has no readings). When
+STORE_PATH is set, the samples are also kept on disk in a SegmentStore (see
+segment_store.py), which answers windows older than the ring buffers and
+survives restarts. When INGEST_URL is set, the samples are also pushed to
+the IngestTelemetry function, so GetTelemetry can answer historical windows
+without asking the Pi.
+
+A request may ask for a Resolution or MaxPoints instead of the raw readings;
+the recorded readings are then aggregated on the Pi (see aggregation.py).
 """
 
-import json
 import logging
 import os
+import signal
 import sys
-from datetime import datetime
-from azure.servicebus import ServiceBusClient
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from azure.servicebus import AutoLockRenewer, ServiceBusClient, ServiceBusMessage
 from azure.identity import DefaultAzureCredential
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('/var/log/pi-telemetry-receiver.log')
-    ]
-)
+import aggregation
+import wire_format
+from message_pump import MessagePump
+from sampler import create_sampler, cpu_percent, parse_time, read_cpu_times, read_temperature
+from segment_store import StoreWriter, create_store
+
 logger = logging.getLogger(__name__)
 
+# Replies nobody collects (the requester gave up) expire after this long
+REPLY_TIME_TO_LIVE = timedelta(seconds=60)
+
+# A window ending this many seconds ago still counts as "now" (the request spent time in transit)
+LIVE_WINDOW_GRACE = 60
+
+# Light is a SensorKey of the protocol, but the Pi has no light sensor fitted
+NO_LIGHT_SENSOR = "No light sensor is configured on this device"
+
+# Interval between the two /proc/stat samples of a CPU reading
+CPU_SAMPLE_SECONDS = 0.1
+
+# The Standard tier caps a Service Bus message at 256 KB, headers included
+MAX_REPLY_BYTES = 240 * 1024
+
+# Raw windows longer than this are reduced by LTTB to this many readings
+DEFAULT_MAX_POINTS = 2000
+
+
+def reading(value):
+    """A single reading timestamped now, in the format replies carry"""
+    return {"time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"), "value": value}
+
+
+def read_cpu():
+    """CPU utilisation (%) over CPU_SAMPLE_SECONDS"""
+    before = read_cpu_times()
+    time.sleep(CPU_SAMPLE_SECONDS)
+    return cpu_percent(before, read_cpu_times())
+
+
+class TelemetryPusher:
+    """Pushes the Sampler's recorded readings to the IngestTelemetry function periodically."""
+    
+    def __init__(self, ingest_url, sampler, function_key=None, push_interval=60, content_type=wire_format.MSGPACK):
+        """
+        Initialize the TelemetryPusher.
+        
+        Args:
+            ingest_url: URL of the IngestTelemetry function
+            sampler: Sampler whose buffers are pushed
+            function_key: Function key sent in the x-functions-key header
+            push_interval: Seconds between two pushes
+            content_type: Wire format of the pushes (see wire_format.py)
+        """
+        self.ingest_url = ingest_url
+        self.sampler = sampler
+        self.function_key = function_key
+        self.push_interval = push_interval
+        self.content_type = content_type
+        # Sensor -> epoch seconds of the newest reading the store has
+        self.pushed_until = {}
+        self._stop = threading.Event()
+        
+    def push(self):
+        """Send the readings recorded since the last push; a failed push is retried from the same point."""
+        items = []
+        for sensor_key, buffer in self.sampler.buffers.items():
+            latest = buffer.latest()
+            if latest is None or latest[0] == self.pushed_until.get(sensor_key):
+                continue
+            # Readings the ring buffer has overwritten meanwhile are lost
+            readings = buffer.query(self.pushed_until.get(sensor_key, -1) + 1, latest[0])
+            items.append({"SensorKey": sensor_key, "Readings": readings, "IngestedUntil": latest[0]})
+        if not items:
+            return
+        data, content_type = wire_format.encode(items, self.content_type)
+        headers = {"Content-Type": content_type}
+        if self.function_key:
+            headers["x-functions-key"] = self.function_key
+        request = urllib.request.Request(self.ingest_url, data=data, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+        except Exception as e:
+            logger.warning(f"Failed to push telemetry, retrying {sum(len(item['Readings']) for item in items)} readings next time: {e}")
+            return
+        for item in items:
+            self.pushed_until[item["SensorKey"]] = item["IngestedUntil"]
+        logger.info(f"Pushed {sum(len(item['Readings']) for item in items)} readings to {self.ingest_url}")
+        
+    def run(self):
+        """Push until stop() is called."""
+        while not self._stop.wait(self.push_interval):
+            self.push()
+            
+    def start(self):
+        threading.Thread(target=self.run, name="telemetry-pusher", daemon=True).start()
+        logger.info(f"Pushing telemetry to {self.ingest_url} every {self.push_interval}s")
+        
+    def stop(self):
+        self._stop.set()
+
 
 class TelemetryReceiver:
     """Handles receiving and processing telemetry messages from Service Bus."""
     
-    def __init__(self, service_bus_namespace, subscription_name):
+    def __init__(self, service_bus_namespace, subscription_name, workers=4, prefetch_count=None,
+                 max_lock_renewal=300, sampler=None, store=None, max_reply_bytes=MAX_REPLY_BYTES):
         """
         Initialize the TelemetryReceiver.
         
         Args:
             service_bus_namespace: The fully qualified Service Bus namespace (e.g., 'namespace.servicebus.windows.net')
             subscription_name: The name of the subscription to receive from
+            workers: Maximum number of requests processed at once
+            prefetch_count: Messages the receiver fetches ahead (default: one per worker)
+            max_lock_renewal: Seconds the lock of a message being processed is renewed for
+            sampler: Sampler whose recorded readings answer range requests (None: always read the sensor)
+            store: SegmentStore holding the readings flushed from the sampler (None: the sampler's only)
+            max_reply_bytes: Largest encoded reply sent; bigger replies are replaced by an error
         """
         self.service_bus_namespace = service_bus_namespace
         self.subscription_name = subscription_name
         self.topic_name = "Telemetry"
+        self.workers = workers
+        self.prefetch_count = workers if prefetch_count is None else prefetch_count
+        self.max_lock_renewal = max_lock_renewal
+        self.sampler = sampler
+        self.store = store
+        self.max_reply_bytes = max_reply_bytes
+        self.reply_senders = {}
+        # Senders are not thread-safe and workers reply concurrently
+        self._reply_lock = threading.Lock()
+        self._stop = threading.Event()
         logger.info(f"Initializing TelemetryReceiver for namespace: {service_bus_namespace}")
         
-    def process_temperature_request(self, message_body):
+    def recorded_readings(self, sensor_key, message_body):
         """
-        Process a temperature telemetry request.
+        Readings recorded in the request's StartDate..EndDate window, by the sampler or in the store.
         
         Args:
+            sensor_key: The sensor ('Temperature' or 'CPU')
             message_body: Dictionary containing the telemetry request
+            
+        Returns:
+            wire_format.Series of the readings, or None if none were recorded in the window
         """
-        logger.info(f"Processing TEMPERATURE request: {message_body}")
-        sensor_key = message_body.get('SensorKey')
-        start_date = message_body.get('StartDate')
-        end_date = message_body.get('EndDate')
+        if self.sampler is None and self.store is None:
+            return None
+        try:
+            start = parse_time(message_body.get('StartDate'))
+            end = parse_time(message_body.get('EndDate'))
+        except ValueError:
+            return None
+        if self.store is not None:
+            # Flushed readings are read from the mapped segments, the rest from the ring buffer
+            recent = self.sampler.buffer(sensor_key) if self.sampler is not None else None
+            readings = self.store.query(sensor_key, start, end, recent=recent)
+        else:
+            readings = self.sampler.query(sensor_key, start, end)
+        return readings if readings else None
         
-        # Placeholder: Implement temperature sensor reading logic here
-        logger.info(f"Reading temperature data for sensor '{sensor_key}' from {start_date} to {end_date}")
-        # TODO: Implement actual temperature sensor reading
-        # Example: Read from /sys/class/thermal/thermal_zone0/temp
+    def includes_now(self, message_body):
+        """
+        Whether the request's window includes the current time, so a reading taken now belongs in it.
         
-    def process_light_request(self, message_body):
+        Args:
+            message_body: Dictionary containing the telemetry request
+            
+        Returns:
+            True if StartDate <= now <= EndDate (with LIVE_WINDOW_GRACE), or if the window cannot be parsed
+        """
+        try:
+            start = parse_time(message_body.get('StartDate'))
+            end = parse_time(message_body.get('EndDate'))
+        except ValueError:
+            return True
+        return start <= time.time() <= end + LIVE_WINDOW_GRACE
+        
+    def process_temperature_request(self, message_body):
         """
-        Process a light telemetry request.
+        Process a temperature telemetry request.
         
         Args:
             message_body: Dictionary containing the telemetry request
+            
+        Returns:
+            The recorded readings in the window, else a list with one reading taken now if the
+            window includes the current time, else an empty list
         """
-        logger.info(f"Processing LIGHT request: {message_body}")
+        logger.info(f"Processing TEMPERATURE request: {message_body}")
         sensor_key = message_body.get('SensorKey')
         start_date = message_body.get('StartDate')
         end_date = message_body.get('EndDate')
         
-        # Placeholder: Implement light sensor reading logic here
-        logger.info(f"Reading light data for sensor '{sensor_key}' from {start_date} to {end_date}")
-        # TODO: Implement actual light sensor reading
-        # Example: Read from GPIO-connected light sensor
+        readings = self.recorded_readings("Temperature", message_body)
+        if readings is not None:
+            logger.info(f"Answering temperature data for sensor '{sensor_key}' from {start_date} to {end_date} with {len(readings)} recorded readings")
+            return readings
+        if not self.includes_now(message_body):
+            logger.info(f"No temperature data recorded for sensor '{sensor_key}' from {start_date} to {end_date}")
+            return []
+        logger.info(f"Reading temperature data for sensor '{sensor_key}' from {start_date} to {end_date}")
+        return [reading(read_temperature())]
         
     def process_cpu_request(self, message_body):
         """
@@ -84,16 +245,25 @@ class TelemetryReceiver:
         
         Args:
             message_body: Dictionary containing the telemetry request
+            
+        Returns:
+            The recorded readings in the window, else a list with one reading taken now if the
+            window includes the current time, else an empty list
         """
         logger.info(f"Processing CPU request: {message_body}")
         sensor_key = message_body.get('SensorKey')
         start_date = message_body.get('StartDate')
         end_date = message_body.get('EndDate')
         
-        # Placeholder: Implement CPU metrics reading logic here
+        readings = self.recorded_readings("CPU", message_body)
+        if readings is not None:
+            logger.info(f"Answering CPU data for sensor '{sensor_key}' from {start_date} to {end_date} with {len(readings)} recorded readings")
+            return readings
+        if not self.includes_now(message_body):
+            logger.info(f"No CPU data recorded for sensor '{sensor_key}' from {start_date} to {end_date}")
+            return []
         logger.info(f"Reading CPU data for sensor '{sensor_key}' from {start_date} to {end_date}")
-        # TODO: Implement actual CPU metrics reading
-        # Example: Use psutil or read from /proc/stat
+        return [reading(read_cpu())]
         
     def process_message(self, message):
         """
@@ -101,29 +271,136 @@ class TelemetryReceiver:
         
         Args:
             message: ServiceBusReceivedMessage object
+            
+        Returns:
+            The reply body: the readings, or the error that prevented them
         """
         try:
-            # Parse the message body
-            message_body = json.loads(str(message))
+            # Decode the body bytes in the format named by the message content_type
+            message_body = wire_format.decode_message(message)
             logger.info(f"Received message: {message_body}")
             
             # Extract SensorKey
             sensor_key = message_body.get('SensorKey', '').lower()
             
+            try:
+                aggregation_request = aggregation.parse_request(message_body)
+            except ValueError as e:
+                logger.warning(f"Invalid aggregation in request: {e}")
+                return {"status": "error", "error": str(e)}
+            
+            if sensor_key == 'light':
+                logger.warning("Light requested, but no light sensor is configured")
+                return {"status": "error", "error": NO_LIGHT_SENSOR}
+            
             # Route based on SensorKey using case statement
             if sensor_key == 'temperature':
-                self.process_temperature_request(message_body)
-            elif sensor_key == 'light':
-                self.process_light_request(message_body)
+                readings = self.process_temperature_request(message_body)
             elif sensor_key == 'cpu':
-                self.process_cpu_request(message_body)
+                readings = self.process_cpu_request(message_body)
             else:
                 logger.warning(f"Unknown SensorKey: {sensor_key}")
+                return {"status": "error", "error": f"Unknown SensorKey: {message_body.get('SensorKey')}"}
+                
+            reply_body = {
+                "status": "success",
+                "SensorKey": message_body.get('SensorKey'),
+                "StartDate": message_body.get('StartDate'),
+                "EndDate": message_body.get('EndDate'),
+            }
+            if (aggregation_request is None and isinstance(readings, wire_format.Series)
+                    and len(readings) > DEFAULT_MAX_POINTS and aggregation.np is not None):
+                # A long raw window would not fit in one message
+                logger.info(f"Reducing {len(readings)} raw readings to {DEFAULT_MAX_POINTS} by LTTB")
+                aggregation_request = aggregation.AggregationRequest(aggregation.LTTB, max_points=DEFAULT_MAX_POINTS)
+            # Only recorded readings are aggregated; a single live reading is returned as it is
+            if aggregation_request is not None and isinstance(readings, wire_format.Series):
+                started = time.perf_counter()
+                try:
+                    reply_body.update(aggregation.aggregate(readings, aggregation_request))
+                except ValueError as e:
+                    logger.warning(f"Cannot aggregate request: {e}")
+                    return {"status": "error", "error": str(e)}
+                logger.info(f"Aggregated {len(readings)} readings ({aggregation_request.method}) "
+                            f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+                return reply_body
+            reply_body["readings"] = readings
+            return reply_body
                 
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse message as JSON: {e}")
+        except ValueError as e:
+            logger.error(f"Failed to decode {message.content_type or 'JSON'} message: {e}")
+            return {"status": "error", "error": f"The request could not be decoded: {e}"}
         except Exception as e:
             logger.error(f"Error processing message: {e}", exc_info=True)
+            return {"status": "error", "error": str(e)}
+            
+    def build_reply(self, message, reply_body):
+        """
+        Build the reply message to a request.
+        
+        Args:
+            message: The request (ServiceBusReceivedMessage)
+            reply_body: Dictionary returned by process_message
+            
+        Returns:
+            ServiceBusMessage for the request's reply_to queue
+        """
+        # Reply in the request's format (JSON if this Pi cannot encode it)
+        data, content_type = wire_format.encode(reply_body, message.content_type)
+        if len(data) > self.max_reply_bytes:
+            # Sending it would fail and leave the requester waiting; tell it to ask for fewer points
+            logger.warning(f"Reply {message.message_id} is {len(data)} bytes, over the {self.max_reply_bytes}-byte limit")
+            data, content_type = wire_format.encode({
+                "status": "error",
+                "error": f"The reply ({len(data)} bytes) exceeds the {self.max_reply_bytes}-byte message limit; "
+                         f"ask for a Resolution or MaxPoints, or a shorter window"
+            }, message.content_type)
+        return ServiceBusMessage(
+            data,
+            content_type=content_type,
+            session_id=message.reply_to_session_id,
+            correlation_id=message.message_id,
+            time_to_live=REPLY_TIME_TO_LIVE
+        )
+        
+    def send_reply(self, client, message, reply_body):
+        """
+        Send the reply to a request that asked for one.
+        
+        Args:
+            client: ServiceBusClient to create the reply sender with
+            message: The request (ServiceBusReceivedMessage)
+            reply_body: Dictionary returned by process_message
+        """
+        if not message.reply_to:
+            return
+        reply = self.build_reply(message, reply_body)
+        with self._reply_lock:
+            sender = self.reply_senders.get(message.reply_to)
+            if sender is None:
+                sender = self.reply_senders[message.reply_to] = client.get_queue_sender(queue_name=message.reply_to)
+            try:
+                sender.send_messages(reply)
+                logger.info(f"Sent reply {message.message_id} to {message.reply_to}")
+            except Exception as e:
+                # The requester times out instead; the sender is recreated for the next reply
+                logger.error(f"Failed to send reply {message.message_id} to {message.reply_to}: {e}")
+                self.reply_senders.pop(message.reply_to, None)
+                sender.close()
+                
+    def handle_message(self, client, message):
+        """
+        Process one request and send its reply; runs on a MessagePump worker thread.
+        
+        Args:
+            client: ServiceBusClient to create the reply sender with
+            message: The request (ServiceBusReceivedMessage)
+        """
+        self.send_reply(client, message, self.process_message(message))
+        
+    def stop(self):
+        """Stop receiving; run() returns once the requests in flight are answered."""
+        self._stop.set()
             
     def run(self):
         """
@@ -138,23 +415,26 @@ class TelemetryReceiver:
             with ServiceBusClient(self.service_bus_namespace, credential) as client:
                 logger.info(f"Connected to Service Bus: {self.service_bus_namespace}")
                 
-                # Create a receiver for the subscription
-                with client.get_subscription_receiver(
-                    topic_name=self.topic_name,
-                    subscription_name=self.subscription_name,
-                    max_wait_time=5
-                ) as receiver:
+                # Create a receiver for the subscription; locks of messages being processed are renewed
+                with AutoLockRenewer(max_lock_renewal_duration=self.max_lock_renewal) as renewer, \
+                        client.get_subscription_receiver(
+                            topic_name=self.topic_name,
+                            subscription_name=self.subscription_name,
+                            max_wait_time=5,
+                            prefetch_count=self.prefetch_count,
+                            auto_lock_renewer=renewer
+                        ) as receiver:
                     logger.info(f"Listening for messages on topic '{self.topic_name}', subscription '{self.subscription_name}'...")
                     
-                    while True:
-                        # Receive messages in batches
-                        received_msgs = receiver.receive_messages(max_message_count=10, max_wait_time=5)
-                        
-                        for msg in received_msgs:
-                            self.process_message(msg)
-                            # Complete the message to remove it from the subscription
-                            receiver.complete_message(msg)
-                            
+                    # Process requests concurrently; each is completed after its reply is sent
+                    MessagePump(
+                        receiver,
+                        lambda msg: self.handle_message(client, msg),
+                        workers=self.workers,
+                        stop_event=self._stop,
+                        name="telemetry requests"
+                    ).run()
+                    
         except KeyboardInterrupt:
             logger.info("Service interrupted by user")
         except Exception as e:
@@ -164,12 +444,24 @@ class TelemetryReceiver:
 
 def main():
     """Main entry point for the telemetry receiver service."""
+    # Configure logging here rather than on import, so device_agent.py can import this module
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler('/var/log/pi-telemetry-receiver.log')
+        ]
+    )
+    
     # Load environment variables from .env file
     load_dotenv()
     
     # Get configuration from environment variables
     service_bus_namespace = os.getenv('SERVICE_BUS_NAMESPACE')
     subscription_name = os.getenv('SUBSCRIPTION_NAME', 'pi-telemetry-subscription')
+    workers = int(os.getenv('MAX_CONCURRENT_MESSAGES', 4))
+    prefetch_count = os.getenv('PREFETCH_COUNT')
     
     # Validate configuration
     if not service_bus_namespace:
@@ -181,12 +473,51 @@ def main():
     logger.info("=" * 60)
     logger.info(f"Service Bus Namespace: {service_bus_namespace}")
     logger.info(f"Subscription Name: {subscription_name}")
+    logger.info(f"Worker Threads: {workers}")
     logger.info(f"Started at: {datetime.now().isoformat()}")
     logger.info("=" * 60)
     
+    # Record the sensors in the background, so range requests are answered from memory
+    sampler = create_sampler()
+    sampler.start()
+    
+    # Keep the samples on disk, if configured, so history survives restarts
+    store = create_store()
+    writer = None
+    if store is not None:
+        writer = StoreWriter(store, sampler, flush_interval=float(os.getenv('STORE_FLUSH_INTERVAL', 600)))
+        writer.start()
+    
+    # Push readings to the cloud-side store, if configured
+    ingest_url = os.getenv('INGEST_URL')
+    if ingest_url:
+        TelemetryPusher(
+            ingest_url,
+            sampler,
+            function_key=os.getenv('INGEST_FUNCTION_KEY'),
+            push_interval=float(os.getenv('PUSH_INTERVAL', 60)),
+            content_type=os.getenv('INGEST_CONTENT_TYPE', wire_format.MSGPACK)
+        ).start()
+    
     # Create and run the receiver
-    receiver = TelemetryReceiver(service_bus_namespace, subscription_name)
-    receiver.run()
+    receiver = TelemetryReceiver(
+        service_bus_namespace,
+        subscription_name,
+        workers=workers,
+        prefetch_count=int(prefetch_count) if prefetch_count else None,
+        max_lock_renewal=float(os.getenv('MAX_LOCK_RENEWAL', 300)),
+        sampler=sampler,
+        store=store,
+        max_reply_bytes=int(os.getenv('MAX_REPLY_BYTES', MAX_REPLY_BYTES))
+    )
+    # systemctl stop sends SIGTERM: finish the requests in flight before exiting
+    signal.signal(signal.SIGTERM, lambda signum, frame: receiver.stop())
+    try:
+        receiver.run()
+    finally:
+        # Flush the samples recorded since the last flush
+        if writer is not None:
+            writer.stop()
 
 
 if __name__ == "__main__":
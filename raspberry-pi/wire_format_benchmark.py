@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Encode and decode cost of the message wire formats.
+
+Run it on the device: the point is the CPU a Pi spends per message. For a
+telemetry request and for replies carrying 1 to 8640 readings, it measures
+per format the encoded size and the median time to encode and to decode one
+message:
+
+- json: the standard library json module
+- orjson: orjson, when installed (what wire_format uses for JSON if present)
+- msgpack: MessagePack, when installed, with the readings given as a Series
+  (the columns the telemetry pusher keeps), so they are packed as
+  fixed-width arrays
+- msgpack_dicts: MessagePack of the same readings as a list of dicts
+- str_json: the previous decode path, json.loads(str(message)) on a
+  ServiceBusMessage, when azure-servicebus is installed
+
+Usage:
+    python wire_format_benchmark.py
+    python wire_format_benchmark.py --repeat 200 --output results.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import wire_format
+
+READING_COUNTS = (1, 60, 360, 8640)
+
+
+def make_reply(count):
+    """A reply with ``count`` readings 10 seconds apart"""
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    return {
+        "status": "success",
+        "SensorKey": "CPU",
+        "StartDate": "2025-01-01T00:00:00Z",
+        "EndDate": "2025-01-02T00:00:00Z",
+        "readings": [
+            {"time": (start + timedelta(seconds=10 * i)).strftime("%Y-%m-%dT%H:%M:%SZ"), "value": round(20 + (i % 97) * 0.37, 1)}
+            for i in range(count)
+        ],
+    }
+
+
+def as_series(payload):
+    """The payload with its readings as a wire_format.Series, as a sampler would produce it"""
+    if "readings" not in payload:
+        return payload
+    times = [int(datetime.fromisoformat(reading["time"][:-1]).replace(tzinfo=timezone.utc).timestamp())
+             for reading in payload["readings"]]
+    values = [reading["value"] for reading in payload["readings"]]
+    return {**payload, "readings": wire_format.Series(times, values)}
+
+
+def formats():
+    """Format name -> (prepare, encode, decode) functions available in this environment"""
+    unchanged = lambda payload: payload  # noqa: E731
+    available = {
+        "json": (unchanged, lambda obj: json.dumps(obj, separators=(",", ":")).encode(), json.loads),
+    }
+    if wire_format.orjson is not None:
+        available["orjson"] = (unchanged, wire_format.orjson.dumps, wire_format.orjson.loads)
+    if wire_format.MSGPACK in wire_format.CODECS:
+        codec = wire_format.CODECS[wire_format.MSGPACK]
+        available["msgpack"] = (as_series, codec.encode, codec.decode)
+        available["msgpack_dicts"] = (unchanged, codec.encode, codec.decode)
+    try:
+        from azure.servicebus import ServiceBusMessage
+    except ImportError:
+        return available
+    available["str_json"] = (
+        unchanged,
+        lambda obj: ServiceBusMessage(json.dumps(obj)),
+        lambda message: json.loads(str(message)),
+    )
+    return available
+
+
+def median_ms(function, argument, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - started)
+    return round(statistics.median(times) * 1000, 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire format encode/decode benchmark")
+    parser.add_argument("--repeat", type=int, default=50, help="Timed runs per measurement")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    payloads = {"request": {"SensorKey": "CPU", "StartDate": "2025-01-01T00:00:00Z", "EndDate": "2025-01-02T00:00:00Z"}}
+    for count in READING_COUNTS:
+        payloads[f"reply_{count}"] = make_reply(count)
+
+    report = {"repeat": args.repeat}
+    for name, (prepare, encode, decode) in formats().items():
+        results = {}
+        for payload_name, payload in payloads.items():
+            prepared = prepare(payload)
+            encoded = encode(prepared)
+            if decode(encoded) != payload:
+                raise SystemExit(f"{name} does not round-trip {payload_name}")
+            results[payload_name] = {
+                "bytes": len(wire_format.message_bytes(encoded)) if name == "str_json" else len(encoded),
+                "encode_ms": median_ms(encode, prepared, args.repeat),
+                "decode_ms": median_ms(decode, encoded, args.repeat),
+            }
+        report[name] = results
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+Admission control for /api/chat.
+
+Chat turns that reach the model are limited to a number in flight sized to
+the model deployment's quota. Requests beyond the limit wait in a bounded
+queue, served round-robin between sessions so one busy client cannot starve
+the others, and are rejected with a Retry-After hint when the queue is full
+or the wait times out. The limit adapts to the backend: it is halved when the
+model returns 429 and grows back additively on successful responses (AIMD).
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Smoothing factor of the service time moving average used for Retry-After
+SERVICE_TIME_ALPHA = 0.2
+
+# Longest Retry-After suggested to clients, in seconds
+MAX_RETRY_AFTER = 60
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; ``retry_after`` is in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def throttled_retry_after(error):
+    """Return the Retry-After (seconds) of a 429 error from the model backend, or None for other errors."""
+    if getattr(error, "status_code", None) != 429:
+        return None
+    response = getattr(error, "response", None)
+    retry_after = _retry_after_header(getattr(response, "headers", None) or {})
+    return max(1, math.ceil(retry_after)) if retry_after else 1
+
+
+def _retry_after_header(headers):
+    """Parse retry-after-ms / retry-after (seconds) response headers."""
+    for name, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            continue
+    return None
+
+
+class _ThreadWaiter:
+    """A queued request waiting in a worker thread."""
+
+    def __init__(self):
+        self.admitted = False
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+class _AsyncWaiter:
+    """A queued request waiting in an asyncio task."""
+
+    def __init__(self, loop):
+        self.admitted = False
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class AdmissionTicket:
+    """An admitted request; release() it when the chat turn is finished."""
+
+    def __init__(self, controller, waited):
+        self.controller = controller
+        self.waited = waited
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        """Free the slot (idempotent)."""
+        if not self._released:
+            self._released = True
+            self.controller._release(time.monotonic() - self._started)
+
+    def guard_stream(self, events):
+        """
+        Wrap an async generator of response chunks so that closing it frees
+        the slot, even when the server closes it before the first chunk.
+        """
+        return _GuardedStream(events, self)
+
+
+class _GuardedStream:
+    """Async iterator that releases an AdmissionTicket when it is closed."""
+
+    def __init__(self, events, ticket):
+        self.events = events
+        self.ticket = ticket
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.events.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.events.aclose()
+        finally:
+            self.ticket.release()
+
+
+class AdmissionController:
+    """Global in-flight limit with fair per-session queuing and adaptive backoff."""
+
+    def __init__(self, max_in_flight=16, max_queue=64, max_queue_per_session=4,
+                 queue_timeout=10.0, min_in_flight=1, decrease_interval=1.0):
+        """
+        Initialize the AdmissionController.
+
+        Args:
+            max_in_flight: Chat turns allowed in flight (per process) when the backend is healthy
+            max_queue: Requests allowed to wait for a slot before new ones are rejected
+            max_queue_per_session: Requests one session may have waiting at a time
+            queue_timeout: Seconds a request waits for a slot before it is rejected
+            min_in_flight: Lower bound for the adaptive limit
+            decrease_interval: Minimum seconds between two limit decreases on 429s
+        """
+        self.max_in_flight = max(1, max_in_flight)
+        self.min_in_flight = max(1, min(min_in_flight, self.max_in_flight))
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.queue_timeout = queue_timeout
+        self.decrease_interval = decrease_interval
+        self._lock = threading.Lock()
+        self._limit = float(self.max_in_flight)
+        self._in_flight = 0
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._service_time = None
+        self._throttled_until = 0.0
+        self._last_decrease = 0.0
+        self._counters = {"admitted": 0, "queued": 0, "rejected_queue_full": 0,
+                          "rejected_timeout": 0, "backend_throttled": 0}
+
+    @property
+    def limit(self):
+        """Current (adaptive) in-flight limit."""
+        return max(self.min_in_flight, int(self._limit))
+
+    def _retry_after_locked(self):
+        """Estimate when a slot is likely to be free, in whole seconds."""
+        service_time = self._service_time or 1.0
+        wait = (self._queued + 1) * service_time / self.limit
+        wait = max(wait, self._throttled_until - time.monotonic())
+        return max(1, math.ceil(min(wait, MAX_RETRY_AFTER)))
+
+    def _admit_or_enqueue_locked(self, key, make_waiter):
+        """Take a slot immediately (returns None) or queue a new waiter (returns it)."""
+        if self._in_flight < self.limit and not self._queued:
+            self._in_flight += 1
+            self._counters["admitted"] += 1
+            return None
+        waiters = self._queues.get(key)
+        if self._queued >= self.max_queue or (waiters and len(waiters) >= self.max_queue_per_session):
+            self._counters["rejected_queue_full"] += 1
+            raise AdmissionRejected("queue full", self._retry_after_locked())
+        waiter = make_waiter()
+        if waiters is None:
+            waiters = self._queues[key] = deque()
+        waiters.append(waiter)
+        self._queued += 1
+        self._counters["queued"] += 1
+        return waiter
+
+    def _dispatch_locked(self):
+        """Hand free slots to queued requests, one session at a time in turn."""
+        while self._queued and self._in_flight < self.limit:
+            key, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self._in_flight += 1
+            self._counters["admitted"] += 1
+            waiter.admitted = True
+            waiter.notify()
+
+    def _remove_locked(self, key, waiter):
+        """Remove a waiter that gave up; returns False if it was admitted meanwhile."""
+        if waiter.admitted:
+            return False
+        waiters = self._queues.get(key)
+        waiters.remove(waiter)
+        self._queued -= 1
+        if not waiters:
+            del self._queues[key]
+        return True
+
+    def acquire(self, key):
+        """
+        Wait for a slot for the session ``key`` and return an AdmissionTicket.
+
+        Raises AdmissionRejected when the queue is full or the wait times out.
+        """
+        started = time.monotonic()
+        with self._lock:
+            waiter = self._admit_or_enqueue_locked(key, _ThreadWaiter)
+        if waiter is not None and not waiter.wait(self.queue_timeout):
+            with self._lock:
+                if self._remove_locked(key, waiter):
+                    self._counters["rejected_timeout"] += 1
+                    raise AdmissionRejected("queue timeout", self._retry_after_locked())
+        return AdmissionTicket(self, time.monotonic() - started)
+
+    async def aacquire(self, key):
+        """Async variant of acquire() for the ASGI app."""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            waiter = self._admit_or_enqueue_locked(key, lambda: _AsyncWaiter(loop))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                with self._lock:
+                    removed = self._remove_locked(key, waiter)
+                    if removed and isinstance(e, asyncio.TimeoutError):
+                        self._counters["rejected_timeout"] += 1
+                        raise AdmissionRejected("queue timeout", self._retry_after_locked())
+                if isinstance(e, asyncio.CancelledError):
+                    if not removed:
+                        # Admitted just as the client went away: give the slot back
+                        self._release(None)
+                    raise
+        return AdmissionTicket(self, time.monotonic() - started)
+
+    def _release(self, duration):
+        with self._lock:
+            self._in_flight -= 1
+            if duration is not None:
+                if self._service_time is None:
+                    self._service_time = duration
+                else:
+                    self._service_time += SERVICE_TIME_ALPHA * (duration - self._service_time)
+            self._dispatch_locked()
+
+    def record_throttled(self, retry_after=None):
+        """The model backend returned 429: halve the limit (at most once per decrease interval)."""
+        now = time.monotonic()
+        with self._lock:
+            self._counters["backend_throttled"] += 1
+            if retry_after:
+                self._throttled_until = max(self._throttled_until, now + retry_after)
+            if now - self._last_decrease >= self.decrease_interval:
+                self._limit = max(float(self.min_in_flight), self._limit / 2)
+                self._last_decrease = now
+
+    def record_success(self):
+        """The model backend answered: grow the limit by about one per round trip of the window."""
+        with self._lock:
+            if self._limit < self.max_in_flight and time.monotonic() >= self._throttled_until:
+                self._limit = min(float(self.max_in_flight), self._limit + 1 / self._limit)
+                self._dispatch_locked()
+
+    def observe_response(self, pipeline_response):
+        """
+        ``raw_response_hook`` for the Azure AI client: sees every attempt,
+        including the 429s its retry policy handles internally.
+        """
+        response = pipeline_response.http_response
+        if response.status_code == 429:
+            self.record_throttled(_retry_after_header(response.headers))
+        elif response.status_code < 400:
+            self.record_success()
+
+    def stats(self):
+        """Return the current limit, occupancy and admission counters."""
+        with self._lock:
+            return {
+                **self._counters,
+                "limit": self.limit,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "waiting": self._queued,
+                "sessions_waiting": len(self._queues),
+                "avg_service_ms": round(self._service_time * 1000, 1) if self._service_time is not None else None,
+            }
@@ -2,160 +2,429 @@ import os
 import json
 import logging
 import secrets
-from flask import Flask, render_template, request, jsonify, session
+import threading
+import time
+from flask import Flask, Response, render_template, request, jsonify, session, stream_with_context
 from azure.ai.inference import ChatCompletionsClient
 from azure.ai.inference.models import (
-    SystemMessage,
-    UserMessage,
     AssistantMessage,
-    ChatCompletionsToolDefinition,
-    FunctionDefinition,
+    ChatCompletionsToolCall,
+    FunctionCall,
     ToolMessage,
 )
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-from opencensus.ext.azure.log_exporter import AzureLogHandler
-from opencensus.ext.flask.flask_middleware import FlaskMiddleware
-from applicationinsights import TelemetryClient
-from applicationinsights.flask.ext import AppInsights
-import requests
+from admission import AdmissionRejected, throttled_retry_after
+from chat_common import (
+    MAX_TOOL_ITERATIONS,
+    admission,
+    admission_wait_seconds,
+    app_insights_connection_string,
+    azure_api_key,
+    azure_deployment_name,
+    azure_endpoint,
+    build_messages,
+    chat_request_seconds,
+    coalescing_key,
+    conversation_store,
+    fast_path,
+    fast_path_events,
+    function_app_key,
+    function_app_url,
+    get_tools,
+    history_to_messages,
+    log_pipeline,
+    mcp_request_seconds,
+    mcp_tool_call_timeout,
+    metrics,
+    model_call_seconds,
+    model_first_token_seconds,
+    prefetcher,
+    result_shaper,
+    single_flight,
+    sse_event,
+    stage_seconds,
+    telemetry_cache,
+    telemetry_client,
+    tool_call_seconds,
+    tool_label,
+)
+from mcp_client import MCPClient
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 
 app = Flask(__name__)
 # Use a secure random secret key if not provided in environment
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(32))
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Application Insights configuration
-app_insights_connection_string = os.environ.get('APPLICATIONINSIGHTS_CONNECTION_STRING')
+# Application Insights request tracing for Flask; logs and custom events are
+# exported by chat_common
 if app_insights_connection_string:
-    # Add Azure Monitor handler for logging
-    logger.addHandler(AzureLogHandler(connection_string=app_insights_connection_string))
-    # Initialize Application Insights for Flask
+    from opencensus.ext.azure.trace_exporter import AzureExporter
+    from opencensus.ext.flask.flask_middleware import FlaskMiddleware
+    from opencensus.trace.samplers import ProbabilitySampler
+    from applicationinsights.flask.ext import AppInsights
+    
+    # Request spans are sampled and exported by the Azure exporter's own worker thread
     app_insights = AppInsights(app)
     FlaskMiddleware(
         app,
-        exporter=None,
-        sampler=None,
+        exporter=AzureExporter(connection_string=app_insights_connection_string),
+        sampler=ProbabilitySampler(rate=float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))),
     )
-    telemetry_client = TelemetryClient(app_insights_connection_string)
-    logger.info("Application Insights initialized successfully")
 else:
-    logger.warning("Application Insights not configured - APPLICATIONINSIGHTS_CONNECTION_STRING not set")
     app_insights = None
-    telemetry_client = None
-
-# Azure AI Foundry configuration
-azure_endpoint = os.environ.get('AZURE_OPENAI_ENDPOINT')
-azure_api_key = os.environ.get('AZURE_OPENAI_API_KEY')
-azure_deployment_name = os.environ.get('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4o-mini')
-
-# Azure Function MCP endpoints configuration
-function_app_url = os.environ.get('FUNCTION_APP_URL')
-function_app_key = os.environ.get('FUNCTION_APP_KEY')
-
-# Initialize Azure AI client
-if azure_endpoint and azure_api_key:
-    client = ChatCompletionsClient(
-        endpoint=azure_endpoint,
-        credential=AzureKeyCredential(azure_api_key)
-    )
-    logger.info(f"Azure AI client initialized with endpoint: {azure_endpoint}")
-else:
-    client = None
+
+# Tool calls from a single model turn run concurrently on a bounded pool
+mcp_max_concurrent_calls = int(os.environ.get('MCP_MAX_CONCURRENT_CALLS', 8))
+tool_executor = ThreadPoolExecutor(max_workers=mcp_max_concurrent_calls, thread_name_prefix='mcp-tool')
+
+# Shared MCP transport: pooled keep-alive connections, retries and a circuit breaker
+mcp_client = MCPClient(
+    function_app_url,
+    function_app_key,
+    pool_maxsize=mcp_max_concurrent_calls,
+    max_retries=int(os.environ.get('MCP_MAX_RETRIES', 3)),
+    failure_threshold=int(os.environ.get('MCP_BREAKER_FAILURE_THRESHOLD', 5)),
+    reset_timeout=float(os.environ.get('MCP_BREAKER_RESET_TIMEOUT', 30)),
+)
+
+# Azure AI client, built on first use by get_client() (or by warm_up())
+client = None
+client_lock = threading.Lock()
+if not (azure_endpoint and azure_api_key):
     logger.warning("Azure AI client not initialized - missing AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_API_KEY")
 
-# Define MCP tools for function calling
-tools = [
-    ChatCompletionsToolDefinition(
-        function=FunctionDefinition(
-            name="get_telemetry",
-            description="Retrieve telemetry data from a sensor. Use this to get temperature, light, or CPU readings from the Raspberry Pi.",
-            parameters={
-                "type": "object",
-                "properties": {
-                    "sensor_key": {
-                        "type": "string",
-                        "description": "The type of sensor to query (e.g., 'Temperature', 'Light', 'CPU')",
-                    },
-                    "start_date": {
-                        "type": "string",
-                        "description": "Start date for telemetry data in ISO 8601 format (e.g., '2025-01-01T00:00:00Z')",
-                    },
-                    "end_date": {
-                        "type": "string",
-                        "description": "End date for telemetry data in ISO 8601 format (e.g., '2025-01-02T00:00:00Z')",
-                    },
-                },
-                "required": ["sensor_key", "start_date", "end_date"],
-            },
-        )
-    ),
-    ChatCompletionsToolDefinition(
-        function=FunctionDefinition(
-            name="send_action",
-            description="Send an action command to the Raspberry Pi. Use this to control devices like camera, LEDs, or other actuators.",
-            parameters={
-                "type": "object",
-                "properties": {
-                    "action_type": {
-                        "type": "string",
-                        "description": "The type of action to perform (e.g., 'Camera', 'LED', 'Servo')",
-                    },
-                    "action_spec": {
-                        "type": "string",
-                        "description": "JSON string specifying the action details (e.g., '{\"operation\": \"capture\", \"resolution\": \"1920x1080\"}')",
-                    },
-                },
-                "required": ["action_type", "action_spec"],
-            },
-        )
-    ),
-]
+
+def save_conversation(conversation_id, messages, assistant_message):
+    """Store the turn (without the system prompt) in the conversation store"""
+    try:
+        with stage_seconds.time(stage='conversation_save'):
+            conversation_store.save(conversation_id, messages[1:] + [AssistantMessage(content=assistant_message)])
+    except Exception as e:
+        logger.error(f"Failed to save conversation {conversation_id}: {str(e)}", exc_info=True)
 
 
-def call_mcp_function(function_name, arguments):
-    """Call Azure Function MCP endpoints"""
-    if not function_app_url or not function_app_key:
-        logger.error("Function App URL or Key not configured")
-        return {"error": "MCP endpoints not configured"}
+def get_client():
+    """Return the Azure AI client, creating it on first use (None if not configured)"""
+    global client
+    if client is None and azure_endpoint and azure_api_key:
+        with client_lock:
+            if client is None:
+                client = ChatCompletionsClient(
+                    endpoint=azure_endpoint,
+                    credential=AzureKeyCredential(azure_api_key),
+                    # Every response, including retried 429s, adjusts the admission limit
+                    raw_response_hook=admission.observe_response,
+                )
+                logger.info(f"Azure AI client initialized with endpoint: {azure_endpoint}")
+    return client
+
+
+def warm_up():
+    """
+    Build the clients and open connections before the first chat request.
+    
+    Returns the time spent on each step in milliseconds. Failures are logged
+    and otherwise ignored; the first request will simply pay the cost.
+    """
+    timings = {}
+    started = time.perf_counter()
+    model_client = get_client()
+    if model_client is not None:
+        try:
+            # Opens the TLS connection to the model endpoint
+            model_client.get_model_info()
+        except Exception as e:
+            logger.warning(f"Model endpoint warm-up request failed: {str(e)}")
+    timings['model_client_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    
+    started = time.perf_counter()
+    mcp_client.warm_up()
+    timings['mcp_client_ms'] = round((time.perf_counter() - started) * 1000, 1)
     
+    logger.info(f"Warm-up completed: {timings}")
+    return timings
+
+
+def admission_key():
+    """Fair-queuing key: the browser session, or the client address without a session cookie"""
+    key = session.get('sid')
+    if key is None:
+        session['sid'] = secrets.token_urlsafe(12)
+        key = request.access_route[0] if request.access_route else request.remote_addr
+    return key
+
+
+def admit_chat_turn():
+    """Wait for an admission slot; raises AdmissionRejected when the server is saturated"""
+    started = time.perf_counter()
     try:
-        if function_name == "get_telemetry":
-            url = f"{function_app_url}/api/GetTelemetry"
-            payload = {
-                "SensorKey": arguments.get("sensor_key"),
-                "StartDate": arguments.get("start_date"),
-                "EndDate": arguments.get("end_date")
-            }
-        elif function_name == "send_action":
-            url = f"{function_app_url}/api/SendAction"
-            payload = {
-                "ActionType": arguments.get("action_type"),
-                "ActionSpec": arguments.get("action_spec")
-            }
-        else:
-            return {"error": f"Unknown function: {function_name}"}
+        ticket = admission.acquire(admission_key())
+    except AdmissionRejected as e:
+        admission_wait_seconds.observe(time.perf_counter() - started, outcome='rejected')
+        logger.warning(f"Chat request rejected: {e.reason}, retry after {e.retry_after}s")
+        raise
+    admission_wait_seconds.observe(ticket.waited, outcome='admitted')
+    return ticket
+
+
+def too_many_requests(message, retry_after):
+    """429 JSON response with a Retry-After header"""
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def call_tool(function_name, function_args):
+    """
+    Call an MCP function. get_telemetry is served from the cache when possible
+    and concurrent identical misses share a single backend call.
+    """
+    key = coalescing_key(function_name, function_args)
+    
+    def backend_call():
+        with mcp_request_seconds.time(tool=tool_label(function_name)):
+            return mcp_client.call(function_name, function_args)
+    
+    def fetch():
+        if key is None:
+            return backend_call()
+        return single_flight.do(key, backend_call)
+    
+    if function_name == "get_telemetry":
+        return telemetry_cache.get_or_fetch(function_args, fetch)
+    return fetch()
+
+
+def timed_call_tool(function_name, function_args, iteration):
+    """Call a tool and record its latency for the given tool-call iteration"""
+    with tool_call_seconds.time(tool=tool_label(function_name), iteration=iteration):
+        return call_tool(function_name, function_args)
+
+
+def fetch_fast_path_telemetry(function_args):
+    """Run the fast path's get_telemetry call on the tool executor with the tool-call timeout"""
+    future = tool_executor.submit(timed_call_tool, 'get_telemetry', function_args, 0)
+    try:
+        return future.result(timeout=mcp_tool_call_timeout)
+    except FutureTimeoutError:
+        logger.error(f"MCP function get_telemetry timed out after {mcp_tool_call_timeout}s")
+        return {"error": "get_telemetry timed out"}
+
+
+def start_prefetch(user_message):
+    """Start the get_telemetry call the message most likely leads to, alongside the first model call"""
+    if not get_tools():
+        return None
+    return prefetcher.start(
+        user_message,
+        lambda function_args: tool_executor.submit(timed_call_tool, 'get_telemetry', function_args, 0)
+    )
+
+
+def execute_tool_calls(tool_calls, iteration=0, speculation=None):
+    """
+    Execute the MCP functions requested by the model and return their ToolMessages.
+    
+    Calls run concurrently on the tool executor; results are returned in the
+    same order as ``tool_calls``. A call that does not finish within
+    ``mcp_tool_call_timeout`` seconds of being submitted is reported to the
+    model as an error. A call matching the turn's ``speculation`` uses the
+    prefetched result.
+    """
+    deadline = time.monotonic() + mcp_tool_call_timeout
+    futures = []
+    for tool_call in tool_calls:
+        function_name = tool_call.function.name
+        function_args = json.loads(tool_call.function.arguments)
         
-        headers = {
-            "Content-Type": "application/json",
-            "x-functions-key": function_app_key
-        }
+        logger.info(f"Executing function: {function_name} with args: {function_args}")
         
-        logger.info(f"Calling MCP function {function_name} with payload: {payload}")
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
-        response.raise_for_status()
+        prefetched = speculation.claim(function_name, function_args) if speculation else None
+        if prefetched is not None:
+            logger.info(f"Using prefetched result for {function_name}")
+            futures.append(prefetched)
+            continue
         
-        result = response.json()
-        logger.info(f"MCP function {function_name} response: {result}")
-        return result
+        # Call the MCP function
+        futures.append(tool_executor.submit(timed_call_tool, function_name, function_args, iteration))
+    
+    tool_messages = []
+    for tool_call, future in zip(tool_calls, futures):
+        try:
+            function_result = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            logger.error(f"MCP function {tool_call.function.name} timed out after {mcp_tool_call_timeout}s")
+            function_result = {"error": f"{tool_call.function.name} timed out"}
+        
+        with stage_seconds.time(stage='tool_result_serialization'):
+            content = result_shaper.shape(function_result)
+        tool_messages.append(ToolMessage(
+            tool_call_id=tool_call.id,
+            content=content
+        ))
+    return tool_messages
+
+
+def stream_chat_events(messages, conversation_id, started=None, ticket=None, speculation=None):
+    """
+    Run the chat/tool-call loop with streaming completions.
+    
+    Yields SSE frames: ``tool_call`` before each MCP function runs, ``token``
+    for every content delta from the model, then ``done`` (or ``error``).
+    The completed turn is saved to the conversation store before ``done``.
+    ``started`` is the perf_counter() value at which the request arrived;
+    the admission ``ticket`` is released and the prefetch ``speculation``
+    finished when the turn ends.
+    """
+    started = started if started is not None else time.perf_counter()
+    iteration = 0
+    try:
+        while True:
+            content_parts = []
+            tool_calls = []
+            finish_reason = None
+            
+            model_started = time.perf_counter()
+            first_update = True
+            with get_client().complete(
+                messages=messages,
+                model=azure_deployment_name,
+                tools=get_tools(),
+                stream=True,
+            ) as updates:
+                for update in updates:
+                    if first_update:
+                        model_first_token_seconds.observe(time.perf_counter() - model_started, iteration=iteration)
+                        first_update = False
+                    if not update.choices:
+                        continue
+                    choice = update.choices[0]
+                    delta = choice.delta
+                    
+                    if delta and delta.content:
+                        content_parts.append(delta.content)
+                        yield sse_event('token', {'content': delta.content})
+                    
+                    # Tool calls arrive in fragments: a new id starts a call,
+                    # later fragments append to its arguments
+                    if delta and delta.tool_calls:
+                        for tool_call_update in delta.tool_calls:
+                            function = tool_call_update.function
+                            if tool_call_update.id:
+                                tool_calls.append({
+                                    'id': tool_call_update.id,
+                                    'name': (function.name if function else None) or '',
+                                    'arguments': '',
+                                })
+                            if tool_calls and function and function.arguments:
+                                tool_calls[-1]['arguments'] += function.arguments
+                    
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+            model_call_seconds.observe(time.perf_counter() - model_started, mode='stream', iteration=iteration)
+            
+            if finish_reason != "tool_calls" or not tool_calls or iteration >= MAX_TOOL_ITERATIONS:
+                break
+            
+            logger.info(f"Model requested function calls: {len(tool_calls)}")
+            completed_tool_calls = [
+                ChatCompletionsToolCall(
+                    id=tool_call['id'],
+                    function=FunctionCall(name=tool_call['name'], arguments=tool_call['arguments'])
+                )
+                for tool_call in tool_calls
+            ]
+            messages.append(AssistantMessage(
+                content="".join(content_parts),
+                tool_calls=completed_tool_calls
+            ))
+            for tool_call in completed_tool_calls:
+                yield sse_event('tool_call', {'name': tool_call.function.name})
+            messages.extend(execute_tool_calls(completed_tool_calls, iteration, speculation))
+            iteration += 1
+        
+        assistant_message = "".join(content_parts)
+        save_conversation(conversation_id, messages, assistant_message)
+        if iteration == 1:
+            fast_path.record_model_turn(time.perf_counter() - started)
+        logger.info(f"Generated response: {assistant_message[:100]}...")
+        if telemetry_client:
+            telemetry_client.track_event('chat_response', {
+                'response_length': len(assistant_message),
+                'function_calls_made': iteration,
+                'streamed': True
+            })
+        
+        yield sse_event('done', {'finish_reason': finish_reason, 'conversation_id': conversation_id})
         
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error calling MCP function {function_name}: {str(e)}")
-        return {"error": f"Failed to call {function_name}: {str(e)}"}
+    except Exception as e:
+        retry_after = throttled_retry_after(e)
+        if retry_after is not None:
+            logger.warning(f"Model throttled the chat stream, retry after {retry_after}s")
+            yield sse_event('error', {'error': 'The model is busy, please retry shortly', 'retry_after': retry_after})
+            return
+        logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
+        if telemetry_client:
+            telemetry_client.track_exception()
+        yield sse_event('error', {'error': f'An error occurred: {str(e)}'})
+    finally:
+        if ticket is not None:
+            ticket.release()
+        if speculation is not None:
+            speculation.finish()
+        chat_request_seconds.observe(time.perf_counter() - started, mode='stream')
+
+
+def run_chat_turn(client, messages, speculation=None):
+    """
+    Run the chat/tool-call loop with non-streaming completions.
+    
+    Returns the final response and the number of tool-call rounds made.
+    """
+    # Call Azure AI with function calling capability
+    with model_call_seconds.time(mode='json', iteration=0):
+        response = client.complete(
+            messages=messages,
+            model=azure_deployment_name,
+            tools=get_tools(),
+        )
+    
+    # Handle function calls
+    iteration = 0
+    
+    while iteration < MAX_TOOL_ITERATIONS:
+        choice = response.choices[0]
+        
+        # If the model wants to call a function
+        if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
+            logger.info(f"Model requested function calls: {len(choice.message.tool_calls)}")
+            
+            # Add the assistant's message with tool calls to history
+            messages.append(AssistantMessage(
+                content=choice.message.content or "",
+                tool_calls=choice.message.tool_calls
+            ))
+            
+            # Execute the function calls and add the results to messages
+            messages.extend(execute_tool_calls(choice.message.tool_calls, iteration, speculation))
+            
+            # Get the next response from the model
+            with model_call_seconds.time(mode='json', iteration=iteration + 1):
+                response = client.complete(
+                    messages=messages,
+                    model=azure_deployment_name,
+                    tools=get_tools(),
+                )
+            iteration += 1
+        else:
+            # No more function calls, return the final response
+            break
+    
+    return response, iteration
 
 
 @app.route('/')
@@ -167,14 +436,20 @@ def index():
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """Handle chat requests with Azure AI Foundry"""
+    started = time.perf_counter()
     try:
         data = request.json
         user_message = data.get('message', '')
-        conversation_history = data.get('history', [])
+        conversation_id = data.get('conversation_id') or secrets.token_urlsafe(16)
+        stream = bool(data.get('stream', False))
         
         if not user_message:
             return jsonify({'error': 'Message is required'}), 400
         
+        if not isinstance(conversation_id, str) or len(conversation_id) > 128:
+            return jsonify({'error': 'Invalid conversation_id'}), 400
+        
+        client = get_client()
         if not client:
             return jsonify({'error': 'Azure AI client not configured'}), 500
         
@@ -183,73 +458,75 @@ def chat():
         if telemetry_client:
             telemetry_client.track_event('chat_request', {'message_length': len(user_message)})
         
-        # Build messages for AI
-        messages = [
-            SystemMessage(content="You are a helpful assistant that can interact with a Raspberry Pi system. You can retrieve telemetry data from sensors (Temperature, Light, CPU) and send action commands to control devices. When users ask about sensor data or want to control devices, use the appropriate functions to help them.")
-        ]
+        # Build messages for AI from the stored conversation; clients without a
+        # conversation id may still send their own history
+        with stage_seconds.time(stage='message_build'):
+            history = conversation_store.get(conversation_id)
+            if not history:
+                history = history_to_messages(data.get('history', []))
+            messages = build_messages(user_message, history)
         
-        # Add conversation history
-        for msg in conversation_history:
-            if msg['role'] == 'user':
-                messages.append(UserMessage(content=msg['content']))
-            elif msg['role'] == 'assistant':
-                messages.append(AssistantMessage(content=msg['content']))
+        # Simple single-sensor questions are answered from get_telemetry directly
+        fast_answer = fast_path.answer(user_message, fetch_fast_path_telemetry) if get_tools() else None
+        if fast_answer is not None:
+            tool_args, assistant_message = fast_answer
+            logger.info(f"Fast path answered with get_telemetry args: {tool_args}")
+            save_conversation(conversation_id, messages, assistant_message)
+            if telemetry_client:
+                telemetry_client.track_event('chat_response', {
+                    'response_length': len(assistant_message),
+                    'function_calls_made': 1,
+                    'fast_path': True
+                })
+            chat_request_seconds.observe(time.perf_counter() - started, mode='fast_path')
+            if stream:
+                return Response(
+                    fast_path_events(assistant_message, conversation_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Conversation-Id': conversation_id}
+                )
+            return jsonify({
+                'response': assistant_message,
+                'finish_reason': 'stop',
+                'conversation_id': conversation_id,
+                'fast_path': True
+            })
         
-        # Add current user message
-        messages.append(UserMessage(content=user_message))
+        # Only turns that reach the model take an admission slot
+        ticket = admit_chat_turn()
+        try:
+            speculation = start_prefetch(user_message)
+        except Exception:
+            ticket.release()
+            raise
         
-        # Call Azure AI with function calling capability
-        response = client.complete(
-            messages=messages,
-            model=azure_deployment_name,
-            tools=tools if function_app_url and function_app_key else None,
-        )
+        if stream:
+            response = Response(
+                stream_with_context(stream_chat_events(messages, conversation_id, started, ticket, speculation)),
+                mimetype='text/event-stream',
+                headers={
+                    'Cache-Control': 'no-cache',
+                    'X-Accel-Buffering': 'no',
+                    'X-Conversation-Id': conversation_id,
+                }
+            )
+            # Also frees the slot if the client disconnects before the stream starts
+            response.call_on_close(ticket.release)
+            if speculation is not None:
+                response.call_on_close(speculation.finish)
+            return response
         
-        # Handle function calls
-        max_iterations = 5
-        iteration = 0
-        
-        while iteration < max_iterations:
-            choice = response.choices[0]
-            
-            # If the model wants to call a function
-            if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
-                logger.info(f"Model requested function calls: {len(choice.message.tool_calls)}")
-                
-                # Add the assistant's message with tool calls to history
-                messages.append(AssistantMessage(
-                    content=choice.message.content or "",
-                    tool_calls=choice.message.tool_calls
-                ))
-                
-                # Execute each function call
-                for tool_call in choice.message.tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    
-                    logger.info(f"Executing function: {function_name} with args: {function_args}")
-                    
-                    # Call the MCP function
-                    function_result = call_mcp_function(function_name, function_args)
-                    
-                    # Add function result to messages
-                    messages.append(ToolMessage(
-                        tool_call_id=tool_call.id,
-                        content=json.dumps(function_result)
-                    ))
-                
-                # Get the next response from the model
-                response = client.complete(
-                    messages=messages,
-                    model=azure_deployment_name,
-                    tools=tools if function_app_url and function_app_key else None,
-                )
-                iteration += 1
-            else:
-                # No more function calls, return the final response
-                break
+        try:
+            response, iteration = run_chat_turn(client, messages, speculation)
+        finally:
+            ticket.release()
+            if speculation is not None:
+                speculation.finish()
         
         assistant_message = response.choices[0].message.content
+        save_conversation(conversation_id, messages, assistant_message)
+        if iteration == 1:
+            fast_path.record_model_turn(time.perf_counter() - started)
         
         # Log the response
         logger.info(f"Generated response: {assistant_message[:100]}...")
@@ -259,12 +536,22 @@ def chat():
                 'function_calls_made': iteration
             })
         
-        return jsonify({
-            'response': assistant_message,
-            'finish_reason': response.choices[0].finish_reason
-        })
+        with stage_seconds.time(stage='response_serialization'):
+            result = jsonify({
+                'response': assistant_message,
+                'finish_reason': response.choices[0].finish_reason,
+                'conversation_id': conversation_id
+            })
+        chat_request_seconds.observe(time.perf_counter() - started, mode='json')
+        return result
         
+    except AdmissionRejected as e:
+        return too_many_requests('The server is busy, please retry shortly', e.retry_after)
     except Exception as e:
+        retry_after = throttled_retry_after(e)
+        if retry_after is not None:
+            logger.warning(f"Model throttled the chat request, retry after {retry_after}s")
+            return too_many_requests('The model is busy, please retry shortly', retry_after)
         logger.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
         if telemetry_client:
             telemetry_client.track_exception()
@@ -276,14 +563,40 @@ def health():
     """Health check endpoint"""
     status = {
         'status': 'healthy',
-        'azure_ai_configured': client is not None,
+        'azure_ai_configured': bool(azure_endpoint and azure_api_key),
         'app_insights_configured': app_insights is not None,
         'mcp_endpoints_configured': function_app_url is not None and function_app_key is not None,
+        'mcp_client': mcp_client.stats(),
+        'conversation_store': conversation_store.stats(),
+        'telemetry_cache': telemetry_cache.stats(),
+        'single_flight': single_flight.stats(),
+        'result_shaping': result_shaper.stats(),
+        'fast_path': fast_path.stats(),
+        'admission': admission.stats(),
+        'prefetch': prefetcher.stats(),
+        'observability': {
+            'logs': log_pipeline.stats(),
+            'events': telemetry_client.stats() if telemetry_client else None,
+        },
         'timestamp': datetime.utcnow().isoformat()
     }
     return jsonify(status)
 
 
+@app.route('/api/warmup', methods=['GET'])
+def warmup():
+    """Build clients and open connections ahead of real traffic (e.g. WEBSITE_WARMUP_PATH)"""
+    return jsonify({'status': 'warm', 'timings': warm_up()})
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Per-stage latency histograms in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
+    if os.environ.get('WARM_UP_ON_START', 'false').lower() == 'true':
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,598 @@
+"""
+Async (ASGI) serving mode for the Pi Chat backend.
+
+Serves the same routes as app.py (``/``, ``/api/chat``, ``/api/health`` and
+``/api/metrics``) with Quart, the async ChatCompletionsClient and an
+aiohttp-based MCP client. A chat turn waiting on the model or a tool call no
+longer holds a worker thread, so one process can hold hundreds of in-flight
+conversations.
+
+Configuration, tool definitions, the conversation store and the telemetry
+cache come from chat_common.py, which app.py imports too; importing this
+module does not build the Flask app or its synchronous clients.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+"""
+
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from datetime import datetime
+
+from azure.ai.inference.models import (
+    AssistantMessage,
+    ChatCompletionsToolCall,
+    FunctionCall,
+    ToolMessage,
+)
+from azure.core.credentials import AzureKeyCredential
+from quart import Quart, Response, jsonify, render_template, request, session
+
+from admission import AdmissionRejected, throttled_retry_after
+from chat_common import (
+    MAX_TOOL_ITERATIONS,
+    admission,
+    admission_wait_seconds,
+    azure_api_key,
+    azure_deployment_name,
+    azure_endpoint,
+    build_messages,
+    chat_request_seconds,
+    coalescing_key,
+    conversation_store,
+    fast_path,
+    fast_path_events,
+    function_app_key,
+    function_app_url,
+    get_tools,
+    history_to_messages,
+    log_pipeline,
+    mcp_request_seconds,
+    mcp_tool_call_timeout,
+    metrics,
+    model_call_seconds,
+    model_first_token_seconds,
+    prefetcher,
+    result_shaper,
+    single_flight,
+    sse_event,
+    stage_seconds,
+    telemetry_cache,
+    telemetry_client,
+    tool_call_seconds,
+    tool_label,
+)
+from mcp_client import AsyncMCPClient
+
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+# Signs the session cookie that keys fair queuing, as in the sync app
+app.secret_key = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(32))
+# Match the gunicorn worker timeout used by the sync app
+app.config['RESPONSE_TIMEOUT'] = 120
+
+# Async MCP transport and a bound on concurrent tool calls per process. One
+# process serves many conversations, so the bound is higher than the sync pool.
+mcp_async_max_concurrent_calls = int(os.environ.get('MCP_ASYNC_MAX_CONCURRENT_CALLS', 100))
+mcp_client = AsyncMCPClient(
+    function_app_url,
+    function_app_key,
+    pool_maxsize=mcp_async_max_concurrent_calls,
+    max_retries=int(os.environ.get('MCP_MAX_RETRIES', 3)),
+    failure_threshold=int(os.environ.get('MCP_BREAKER_FAILURE_THRESHOLD', 5)),
+    reset_timeout=float(os.environ.get('MCP_BREAKER_RESET_TIMEOUT', 30)),
+)
+tool_call_semaphore = asyncio.Semaphore(mcp_async_max_concurrent_calls)
+
+# Async Azure AI client, built on first use by get_client() (or by warm_up())
+client = None
+if not (azure_endpoint and azure_api_key):
+    logger.warning("Async Azure AI client not initialized - missing AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_API_KEY")
+
+
+def get_client():
+    """Return the async Azure AI client, creating it on first use (None if not configured)"""
+    global client
+    if client is None and azure_endpoint and azure_api_key:
+        from azure.ai.inference.aio import ChatCompletionsClient
+
+        client = ChatCompletionsClient(
+            endpoint=azure_endpoint,
+            credential=AzureKeyCredential(azure_api_key),
+            # Every response, including retried 429s, adjusts the admission limit
+            raw_response_hook=admission.observe_response,
+        )
+        logger.info(f"Async Azure AI client initialized with endpoint: {azure_endpoint}")
+    return client
+
+
+async def warm_up():
+    """Build the clients and open connections before the first chat request; returns timings in ms"""
+    timings = {}
+    started = time.perf_counter()
+    model_client = get_client()
+    if model_client is not None:
+        try:
+            # Opens the TLS connection to the model endpoint
+            await model_client.get_model_info()
+        except Exception as e:
+            logger.warning(f"Model endpoint warm-up request failed: {str(e)}")
+    timings['model_client_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    await mcp_client.warm_up()
+    timings['mcp_client_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    logger.info(f"Warm-up completed: {timings}")
+    return timings
+
+
+@app.before_serving
+async def start_warm_up():
+    """Warm up in the background when WARM_UP_ON_START is set, without delaying startup"""
+    if os.environ.get('WARM_UP_ON_START', 'false').lower() == 'true':
+        app.add_background_task(warm_up)
+
+
+@app.after_serving
+async def close_clients():
+    """Close pooled connections on shutdown"""
+    await mcp_client.close()
+    if client:
+        await client.close()
+
+
+def admission_key():
+    """Fair-queuing key: the browser session, or the client address without a session cookie"""
+    key = session.get('sid')
+    if key is None:
+        session['sid'] = secrets.token_urlsafe(12)
+        key = request.access_route[0] if request.access_route else request.remote_addr
+    return key
+
+
+async def admit_chat_turn():
+    """Wait for an admission slot; raises AdmissionRejected when the server is saturated"""
+    started = time.perf_counter()
+    try:
+        ticket = await admission.aacquire(admission_key())
+    except AdmissionRejected as e:
+        admission_wait_seconds.observe(time.perf_counter() - started, outcome='rejected')
+        logger.warning(f"Chat request rejected: {e.reason}, retry after {e.retry_after}s")
+        raise
+    admission_wait_seconds.observe(ticket.waited, outcome='admitted')
+    return ticket
+
+
+def too_many_requests(message, retry_after):
+    """429 JSON response with a Retry-After header"""
+    return jsonify({'error': message, 'retry_after': retry_after}), 429, {'Retry-After': str(retry_after)}
+
+
+async def call_tool(function_name, function_args):
+    """
+    Call an MCP function. get_telemetry is served from the cache when possible
+    and concurrent identical misses share a single backend call.
+    """
+    key = coalescing_key(function_name, function_args)
+
+    async def backend_call():
+        with mcp_request_seconds.time(tool=tool_label(function_name)):
+            return await mcp_client.call(function_name, function_args)
+
+    def fetch():
+        if key is None:
+            return backend_call()
+        return single_flight.ado(key, backend_call)
+
+    if function_name == "get_telemetry":
+        return await telemetry_cache.aget_or_fetch(function_args, fetch)
+    return await fetch()
+
+
+async def timed_call_tool(function_name, function_args, iteration):
+    """Call a tool (bounded by ``tool_call_semaphore``) and record its latency"""
+    async with tool_call_semaphore:
+        with tool_call_seconds.time(tool=tool_label(function_name), iteration=iteration):
+            return await call_tool(function_name, function_args)
+
+
+async def fetch_fast_path_telemetry(function_args):
+    """Run the fast path's get_telemetry call with the tool-call timeout"""
+    try:
+        return await asyncio.wait_for(timed_call_tool('get_telemetry', function_args, 0), mcp_tool_call_timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"MCP function get_telemetry timed out after {mcp_tool_call_timeout}s")
+        return {"error": "get_telemetry timed out"}
+
+
+def start_prefetch(user_message):
+    """Start the get_telemetry call the message most likely leads to, alongside the first model call"""
+    if not get_tools():
+        return None
+    return prefetcher.start(
+        user_message,
+        lambda function_args: asyncio.ensure_future(timed_call_tool('get_telemetry', function_args, 0))
+    )
+
+
+async def execute_tool_calls(tool_calls, iteration=0, speculation=None):
+    """
+    Execute the MCP functions requested by the model and return their ToolMessages.
+
+    Calls run concurrently (bounded by ``tool_call_semaphore``) and results are
+    returned in the same order as ``tool_calls``. A call that does not finish
+    within ``mcp_tool_call_timeout`` seconds is reported to the model as an error.
+    A call matching the turn's ``speculation`` uses the prefetched result.
+    """
+    calls = []
+    for tool_call in tool_calls:
+        function_name = tool_call.function.name
+        function_args = json.loads(tool_call.function.arguments)
+
+        logger.info(f"Executing function: {function_name} with args: {function_args}")
+        prefetched = speculation.claim(function_name, function_args) if speculation else None
+        if prefetched is not None:
+            logger.info(f"Using prefetched result for {function_name}")
+            calls.append(asyncio.wait_for(asyncio.shield(prefetched), mcp_tool_call_timeout))
+            continue
+        calls.append(asyncio.wait_for(timed_call_tool(function_name, function_args, iteration), mcp_tool_call_timeout))
+
+    results = await asyncio.gather(*calls, return_exceptions=True)
+
+    tool_messages = []
+    for tool_call, function_result in zip(tool_calls, results):
+        if isinstance(function_result, asyncio.TimeoutError):
+            logger.error(f"MCP function {tool_call.function.name} timed out after {mcp_tool_call_timeout}s")
+            function_result = {"error": f"{tool_call.function.name} timed out"}
+        elif isinstance(function_result, Exception):
+            raise function_result
+
+        with stage_seconds.time(stage='tool_result_serialization'):
+            content = result_shaper.shape(function_result)
+        tool_messages.append(ToolMessage(
+            tool_call_id=tool_call.id,
+            content=content
+        ))
+    return tool_messages
+
+
+async def save_conversation(conversation_id, messages, assistant_message):
+    """Store the turn (without the system prompt) in the conversation store"""
+    try:
+        with stage_seconds.time(stage='conversation_save'):
+            await asyncio.to_thread(
+                conversation_store.save,
+                conversation_id,
+                messages[1:] + [AssistantMessage(content=assistant_message)]
+            )
+    except Exception as e:
+        logger.error(f"Failed to save conversation {conversation_id}: {str(e)}", exc_info=True)
+
+
+async def stream_chat_events(messages, conversation_id, started=None, ticket=None, speculation=None):
+    """
+    Run the chat/tool-call loop with streaming completions.
+
+    Yields the same SSE frames as the sync app: ``tool_call``, ``token`` and
+    then ``done`` (or ``error``). The admission ``ticket`` is released and the
+    prefetch ``speculation`` finished when the turn ends.
+    """
+    started = started if started is not None else time.perf_counter()
+    iteration = 0
+    try:
+        while True:
+            content_parts = []
+            tool_calls = []
+            finish_reason = None
+
+            model_started = time.perf_counter()
+            first_update = True
+            updates = await get_client().complete(
+                messages=messages,
+                model=azure_deployment_name,
+                tools=get_tools(),
+                stream=True,
+            )
+            async with updates:
+                async for update in updates:
+                    if first_update:
+                        model_first_token_seconds.observe(time.perf_counter() - model_started, iteration=iteration)
+                        first_update = False
+                    if not update.choices:
+                        continue
+                    choice = update.choices[0]
+                    delta = choice.delta
+
+                    if delta and delta.content:
+                        content_parts.append(delta.content)
+                        yield sse_event('token', {'content': delta.content})
+
+                    # Tool calls arrive in fragments: a new id starts a call,
+                    # later fragments append to its arguments
+                    if delta and delta.tool_calls:
+                        for tool_call_update in delta.tool_calls:
+                            function = tool_call_update.function
+                            if tool_call_update.id:
+                                tool_calls.append({
+                                    'id': tool_call_update.id,
+                                    'name': (function.name if function else None) or '',
+                                    'arguments': '',
+                                })
+                            if tool_calls and function and function.arguments:
+                                tool_calls[-1]['arguments'] += function.arguments
+
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+            model_call_seconds.observe(time.perf_counter() - model_started, mode='stream', iteration=iteration)
+
+            if finish_reason != "tool_calls" or not tool_calls or iteration >= MAX_TOOL_ITERATIONS:
+                break
+
+            logger.info(f"Model requested function calls: {len(tool_calls)}")
+            completed_tool_calls = [
+                ChatCompletionsToolCall(
+                    id=tool_call['id'],
+                    function=FunctionCall(name=tool_call['name'], arguments=tool_call['arguments'])
+                )
+                for tool_call in tool_calls
+            ]
+            messages.append(AssistantMessage(
+                content="".join(content_parts),
+                tool_calls=completed_tool_calls
+            ))
+            for tool_call in completed_tool_calls:
+                yield sse_event('tool_call', {'name': tool_call.function.name})
+            messages.extend(await execute_tool_calls(completed_tool_calls, iteration, speculation))
+            iteration += 1
+
+        assistant_message = "".join(content_parts)
+        await save_conversation(conversation_id, messages, assistant_message)
+        if iteration == 1:
+            fast_path.record_model_turn(time.perf_counter() - started)
+        logger.info(f"Generated response: {assistant_message[:100]}...")
+        if telemetry_client:
+            telemetry_client.track_event('chat_response', {
+                'response_length': len(assistant_message),
+                'function_calls_made': iteration,
+                'streamed': True
+            })
+
+        yield sse_event('done', {'finish_reason': finish_reason, 'conversation_id': conversation_id})
+
+    except Exception as e:
+        retry_after = throttled_retry_after(e)
+        if retry_after is not None:
+            logger.warning(f"Model throttled the chat stream, retry after {retry_after}s")
+            yield sse_event('error', {'error': 'The model is busy, please retry shortly', 'retry_after': retry_after})
+            return
+        logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
+        if telemetry_client:
+            telemetry_client.track_exception()
+        yield sse_event('error', {'error': f'An error occurred: {str(e)}'})
+    finally:
+        if ticket is not None:
+            ticket.release()
+        if speculation is not None:
+            speculation.finish()
+        chat_request_seconds.observe(time.perf_counter() - started, mode='stream')
+
+
+async def run_chat_turn(client, messages, speculation=None):
+    """
+    Run the chat/tool-call loop with non-streaming completions.
+
+    Returns the final response and the number of tool-call rounds made.
+    """
+    # Call Azure AI with function calling capability
+    with model_call_seconds.time(mode='json', iteration=0):
+        response = await client.complete(
+            messages=messages,
+            model=azure_deployment_name,
+            tools=get_tools(),
+        )
+
+    # Handle function calls
+    iteration = 0
+
+    while iteration < MAX_TOOL_ITERATIONS:
+        choice = response.choices[0]
+
+        # If the model wants to call a function
+        if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
+            logger.info(f"Model requested function calls: {len(choice.message.tool_calls)}")
+
+            # Add the assistant's message with tool calls to history
+            messages.append(AssistantMessage(
+                content=choice.message.content or "",
+                tool_calls=choice.message.tool_calls
+            ))
+
+            # Execute the function calls and add the results to messages
+            messages.extend(await execute_tool_calls(choice.message.tool_calls, iteration, speculation))
+
+            # Get the next response from the model
+            with model_call_seconds.time(mode='json', iteration=iteration + 1):
+                response = await client.complete(
+                    messages=messages,
+                    model=azure_deployment_name,
+                    tools=get_tools(),
+                )
+            iteration += 1
+        else:
+            # No more function calls, return the final response
+            break
+
+    return response, iteration
+
+
+@app.route('/')
+async def index():
+    """Render the chat interface"""
+    return await render_template('index.html')
+
+
+@app.route('/api/chat', methods=['POST'])
+async def chat():
+    """Handle chat requests with Azure AI Foundry"""
+    started = time.perf_counter()
+    try:
+        data = await request.get_json()
+        user_message = data.get('message', '')
+        conversation_id = data.get('conversation_id') or secrets.token_urlsafe(16)
+        stream = bool(data.get('stream', False))
+
+        if not user_message:
+            return jsonify({'error': 'Message is required'}), 400
+
+        if not isinstance(conversation_id, str) or len(conversation_id) > 128:
+            return jsonify({'error': 'Invalid conversation_id'}), 400
+
+        client = get_client()
+        if not client:
+            return jsonify({'error': 'Azure AI client not configured'}), 500
+
+        # Log the request
+        logger.info(f"Received chat message: {user_message}")
+        if telemetry_client:
+            telemetry_client.track_event('chat_request', {'message_length': len(user_message)})
+
+        # Build messages for AI from the stored conversation; clients without a
+        # conversation id may still send their own history
+        with stage_seconds.time(stage='message_build'):
+            history = await asyncio.to_thread(conversation_store.get, conversation_id)
+            if not history:
+                history = history_to_messages(data.get('history', []))
+            messages = build_messages(user_message, history)
+
+        # Simple single-sensor questions are answered from get_telemetry directly
+        fast_answer = await fast_path.aanswer(user_message, fetch_fast_path_telemetry) if get_tools() else None
+        if fast_answer is not None:
+            tool_args, assistant_message = fast_answer
+            logger.info(f"Fast path answered with get_telemetry args: {tool_args}")
+            await save_conversation(conversation_id, messages, assistant_message)
+            if telemetry_client:
+                telemetry_client.track_event('chat_response', {
+                    'response_length': len(assistant_message),
+                    'function_calls_made': 1,
+                    'fast_path': True
+                })
+            chat_request_seconds.observe(time.perf_counter() - started, mode='fast_path')
+            if stream:
+                return Response(
+                    fast_path_events(assistant_message, conversation_id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Conversation-Id': conversation_id}
+                )
+            return jsonify({
+                'response': assistant_message,
+                'finish_reason': 'stop',
+                'conversation_id': conversation_id,
+                'fast_path': True
+            })
+
+        # Only turns that reach the model take an admission slot
+        ticket = await admit_chat_turn()
+        try:
+            speculation = start_prefetch(user_message)
+        except Exception:
+            ticket.release()
+            raise
+
+        if stream:
+            return Response(
+                # Also frees the slot if the client disconnects before the stream starts
+                ticket.guard_stream(stream_chat_events(messages, conversation_id, started, ticket, speculation)),
+                mimetype='text/event-stream',
+                headers={
+                    'Cache-Control': 'no-cache',
+                    'X-Accel-Buffering': 'no',
+                    'X-Conversation-Id': conversation_id,
+                }
+            )
+
+        try:
+            response, iteration = await run_chat_turn(client, messages, speculation)
+        finally:
+            ticket.release()
+            if speculation is not None:
+                speculation.finish()
+
+        assistant_message = response.choices[0].message.content
+        await save_conversation(conversation_id, messages, assistant_message)
+        if iteration == 1:
+            fast_path.record_model_turn(time.perf_counter() - started)
+
+        # Log the response
+        logger.info(f"Generated response: {assistant_message[:100]}...")
+        if telemetry_client:
+            telemetry_client.track_event('chat_response', {
+                'response_length': len(assistant_message),
+                'function_calls_made': iteration
+            })
+
+        with stage_seconds.time(stage='response_serialization'):
+            result = jsonify({
+                'response': assistant_message,
+                'finish_reason': response.choices[0].finish_reason,
+                'conversation_id': conversation_id
+            })
+        chat_request_seconds.observe(time.perf_counter() - started, mode='json')
+        return result
+
+    except AdmissionRejected as e:
+        return too_many_requests('The server is busy, please retry shortly', e.retry_after)
+    except Exception as e:
+        retry_after = throttled_retry_after(e)
+        if retry_after is not None:
+            logger.warning(f"Model throttled the chat request, retry after {retry_after}s")
+            return too_many_requests('The model is busy, please retry shortly', retry_after)
+        logger.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
+        if telemetry_client:
+            telemetry_client.track_exception()
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+
+
+@app.route('/api/health', methods=['GET'])
+async def health():
+    """Health check endpoint"""
+    # The SQLite store queries its database
+    store_stats = await asyncio.to_thread(conversation_store.stats)
+    status = {
+        'status': 'healthy',
+        'serving_mode': 'asgi',
+        'azure_ai_configured': bool(azure_endpoint and azure_api_key),
+        'app_insights_configured': telemetry_client is not None,
+        'mcp_endpoints_configured': function_app_url is not None and function_app_key is not None,
+        'mcp_client': mcp_client.stats(),
+        'conversation_store': store_stats,
+        'telemetry_cache': telemetry_cache.stats(),
+        'single_flight': single_flight.stats(),
+        'result_shaping': result_shaper.stats(),
+        'fast_path': fast_path.stats(),
+        'admission': admission.stats(),
+        'prefetch': prefetcher.stats(),
+        'observability': {
+            'logs': log_pipeline.stats(),
+            'events': telemetry_client.stats() if telemetry_client else None,
+        },
+        'timestamp': datetime.utcnow().isoformat()
+    }
+    return jsonify(status)
+
+
+@app.route('/api/warmup', methods=['GET'])
+async def warmup():
+    """Build clients and open connections ahead of real traffic (e.g. WEBSITE_WARMUP_PATH)"""
+    return jsonify({'status': 'warm', 'timings': await warm_up()})
+
+
+@app.route('/api/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """Per-stage latency histograms in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
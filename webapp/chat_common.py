@@ -0,0 +1,258 @@
+"""
+Configuration and components shared by the two serving modes.
+
+app.py (Flask, WSGI) and asgi_app.py (Quart, ASGI) both import this module
+for the settings, the logging pipeline, the tool definitions and system
+prompt, and the components that work in either mode: the conversation
+store, the get_telemetry cache, single-flight coalescing, result shaping,
+the fast path, the prefetcher, admission control and the metrics. Neither
+app imports the other, so the ASGI app does not build the Flask app, its
+tool thread pool or the synchronous MCP and model clients.
+"""
+
+import json
+import logging
+import os
+
+from azure.ai.inference.models import (
+    AssistantMessage,
+    ChatCompletionsToolDefinition,
+    FunctionDefinition,
+    SystemMessage,
+    UserMessage,
+)
+from admission import AdmissionController
+from conversation_store import create_conversation_store
+from fast_path import FastPath
+from mcp_client import MCP_FUNCTIONS
+from metrics import MetricsRegistry
+from observability import EventBatcher, configure_logging, parse_sample_rates
+from prefetch import SpeculativePrefetcher
+from result_shaping import ResultShaper
+from single_flight import SingleFlight
+from telemetry_cache import TelemetryCache, parse_sensor_ttls
+
+# Configure logging: records are redacted, truncated and queued, and a
+# background thread writes them to the console and Azure Monitor
+log_pipeline = configure_logging(
+    level=logging.INFO,
+    queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+    max_message_length=int(os.environ.get('LOG_MAX_MESSAGE_LENGTH', 1000)),
+)
+logger = logging.getLogger(__name__)
+
+# Application Insights configuration; the Flask request tracing is set up in app.py
+app_insights_connection_string = os.environ.get('APPLICATIONINSIGHTS_CONNECTION_STRING')
+if app_insights_connection_string:
+    # Imported only when configured; these SDKs are slow to import
+    from opencensus.ext.azure.log_exporter import AzureLogHandler
+    from applicationinsights import TelemetryClient
+    
+    # Export logs of the apps and their helper modules to Azure Monitor
+    log_pipeline.add_handler(
+        AzureLogHandler(connection_string=app_insights_connection_string),
+        logger_names=('app', 'asgi_app', __name__, 'mcp_client', 'conversation_store', 'telemetry_cache', 'result_shaping'),
+    )
+    # Custom events are sampled per event type and exported in batches
+    telemetry_client = EventBatcher(
+        TelemetryClient(app_insights_connection_string),
+        sample_rates=parse_sample_rates(os.environ.get('TELEMETRY_EVENT_SAMPLING', '')),
+        batch_size=int(os.environ.get('TELEMETRY_BATCH_SIZE', 50)),
+        flush_interval=float(os.environ.get('TELEMETRY_FLUSH_INTERVAL', 5)),
+    )
+    logger.info("Application Insights initialized successfully")
+else:
+    logger.warning("Application Insights not configured - APPLICATIONINSIGHTS_CONNECTION_STRING not set")
+    telemetry_client = None
+
+# Azure AI Foundry configuration
+azure_endpoint = os.environ.get('AZURE_OPENAI_ENDPOINT')
+azure_api_key = os.environ.get('AZURE_OPENAI_API_KEY')
+azure_deployment_name = os.environ.get('AZURE_OPENAI_DEPLOYMENT_NAME', 'gpt-4o-mini')
+
+# Azure Function MCP endpoints configuration
+function_app_url = os.environ.get('FUNCTION_APP_URL')
+function_app_key = os.environ.get('FUNCTION_APP_KEY')
+
+# Seconds a tool call may take before it is reported to the model as timed out
+mcp_tool_call_timeout = float(os.environ.get('MCP_TOOL_CALL_TIMEOUT', 30))
+
+# Cache for get_telemetry results (send_action is never cached)
+telemetry_cache = TelemetryCache(
+    granularity_seconds=int(os.environ.get('TELEMETRY_CACHE_GRANULARITY', 60)),
+    default_ttl=float(os.environ.get('TELEMETRY_CACHE_TTL', 60)),
+    sensor_ttls=parse_sensor_ttls(os.environ.get('TELEMETRY_CACHE_SENSOR_TTLS', '')),
+    max_entries=int(os.environ.get('TELEMETRY_CACHE_MAX_ENTRIES', 1024)),
+)
+
+# Identical idempotent tool calls in flight at the same time share one backend call
+single_flight = SingleFlight()
+
+# Downsampling and token capping of tool results before they go back to the model
+result_shaper = ResultShaper(
+    token_budget=int(os.environ.get('TOOL_RESULT_TOKEN_BUDGET', 2000)),
+    max_points=int(os.environ.get('TOOL_RESULT_MAX_POINTS', 100)),
+    method=os.environ.get('TOOL_RESULT_DOWNSAMPLE', 'buckets'),
+)
+
+# Server-side conversation history keyed by conversation id
+conversation_store = create_conversation_store()
+
+# Template answers for simple single-sensor questions, skipping the model
+fast_path = FastPath(
+    enabled=os.environ.get('FAST_PATH_ENABLED', 'true').lower() == 'true',
+    default_window_minutes=int(os.environ.get('FAST_PATH_DEFAULT_WINDOW_MINUTES', 15)),
+)
+
+# Speculative get_telemetry calls started alongside the first model call
+prefetcher = SpeculativePrefetcher(
+    enabled=os.environ.get('PREFETCH_ENABLED', 'false').lower() == 'true',
+    default_window_minutes=int(os.environ.get('FAST_PATH_DEFAULT_WINDOW_MINUTES', 15)),
+    max_in_flight=int(os.environ.get('PREFETCH_MAX_IN_FLIGHT', 4)),
+    max_waste_ratio=float(os.environ.get('PREFETCH_MAX_WASTE_RATIO', 0.5)),
+    match_tolerance_seconds=float(os.environ.get('PREFETCH_MATCH_TOLERANCE', 120)),
+)
+
+# Admission control: chat turns in flight are capped (per worker process) and
+# queued fairly between sessions; the cap adapts to model 429s
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get('CHAT_MAX_IN_FLIGHT', 16)),
+    max_queue=int(os.environ.get('CHAT_MAX_QUEUE', 64)),
+    max_queue_per_session=int(os.environ.get('CHAT_MAX_QUEUE_PER_SESSION', 4)),
+    queue_timeout=float(os.environ.get('CHAT_QUEUE_TIMEOUT', 10)),
+)
+
+# Per-stage latency histograms, exposed at /api/metrics
+metrics = MetricsRegistry()
+chat_request_seconds = metrics.histogram(
+    'pichat_chat_request_duration_seconds', 'End-to-end /api/chat latency', ['mode'])
+model_call_seconds = metrics.histogram(
+    'pichat_model_call_duration_seconds', 'Model completion call latency', ['mode', 'iteration'])
+model_first_token_seconds = metrics.histogram(
+    'pichat_model_first_token_seconds', 'Time to the first streamed update of a model call', ['iteration'])
+tool_call_seconds = metrics.histogram(
+    'pichat_tool_call_duration_seconds', 'Tool call latency including cache and coalescing', ['tool', 'iteration'])
+mcp_request_seconds = metrics.histogram(
+    'pichat_mcp_request_duration_seconds', 'MCP backend call latency including retries', ['tool'])
+stage_seconds = metrics.histogram(
+    'pichat_stage_duration_seconds', 'Latency of in-process stages of a chat turn', ['stage'])
+admission_wait_seconds = metrics.histogram(
+    'pichat_admission_wait_seconds', 'Time chat requests waited for an admission slot', ['outcome'])
+
+# Define MCP tools for function calling
+tools = [
+    ChatCompletionsToolDefinition(
+        function=FunctionDefinition(
+            name="get_telemetry",
+            description="Retrieve telemetry data from a sensor. Use this to get temperature, light, or CPU readings from the Raspberry Pi.",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "sensor_key": {
+                        "type": "string",
+                        "description": "The type of sensor to query (e.g., 'Temperature', 'Light', 'CPU')",
+                    },
+                    "start_date": {
+                        "type": "string",
+                        "description": "Start date for telemetry data in ISO 8601 format (e.g., '2025-01-01T00:00:00Z')",
+                    },
+                    "end_date": {
+                        "type": "string",
+                        "description": "End date for telemetry data in ISO 8601 format (e.g., '2025-01-02T00:00:00Z')",
+                    },
+                    "max_points": {
+                        "type": "integer",
+                        "description": "Optional: return at most this many points, aggregated on the device. Use it for windows longer than a few hours.",
+                    },
+                    "resolution": {
+                        "type": "integer",
+                        "description": "Optional: aggregate the readings into buckets of this many seconds (e.g., 3600 for hourly min/max/mean). Do not combine with max_points.",
+                    },
+                },
+                "required": ["sensor_key", "start_date", "end_date"],
+            },
+        )
+    ),
+    ChatCompletionsToolDefinition(
+        function=FunctionDefinition(
+            name="send_action",
+            description="Send an action command to the Raspberry Pi. Use this to control devices like camera, LEDs, or other actuators.",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "action_type": {
+                        "type": "string",
+                        "description": "The type of action to perform (e.g., 'Camera', 'LED', 'Servo')",
+                    },
+                    "action_spec": {
+                        "type": "string",
+                        "description": "JSON string specifying the action details (e.g., '{\"operation\": \"capture\", \"resolution\": \"1920x1080\"}')",
+                    },
+                },
+                "required": ["action_type", "action_spec"],
+            },
+        )
+    ),
+]
+
+
+SYSTEM_PROMPT = "You are a helpful assistant that can interact with a Raspberry Pi system. You can retrieve telemetry data from sensors (Temperature, Light, CPU) and send action commands to control devices. When users ask about sensor data or want to control devices, use the appropriate functions to help them."
+
+# Maximum number of tool-call rounds per chat turn
+MAX_TOOL_ITERATIONS = 5
+
+
+def history_to_messages(conversation_history):
+    """Convert a client-supplied role/content history into chat messages"""
+    messages = []
+    for msg in conversation_history:
+        if msg['role'] == 'user':
+            messages.append(UserMessage(content=msg['content']))
+        elif msg['role'] == 'assistant':
+            messages.append(AssistantMessage(content=msg['content']))
+    return messages
+
+
+def build_messages(user_message, history):
+    """Build the model message list from the system prompt, prior messages and new message"""
+    return [SystemMessage(content=SYSTEM_PROMPT), *history, UserMessage(content=user_message)]
+
+
+def get_tools():
+    """Return the tool definitions if the MCP endpoints are configured"""
+    return tools if function_app_url and function_app_key else None
+
+
+def tool_label(function_name):
+    """Metric label for a tool name; names the model made up share one label"""
+    return function_name if function_name in MCP_FUNCTIONS else 'unknown'
+
+
+def coalescing_key(function_name, function_args):
+    """
+    Return the key under which identical in-flight calls are merged, or None
+    for functions that must always run (non-idempotent actions).
+    """
+    if not MCP_FUNCTIONS.get(function_name, {}).get('idempotent'):
+        return None
+    normalized = {
+        name: value.strip() if isinstance(value, str) else value
+        for name, value in function_args.items()
+    }
+    if isinstance(normalized.get('sensor_key'), str):
+        normalized['sensor_key'] = normalized['sensor_key'].lower()
+    return function_name, json.dumps(normalized, sort_keys=True)
+
+
+def sse_event(event, data):
+    """Format a Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def fast_path_events(answer, conversation_id):
+    """SSE frames for a fast-path answer, matching those of a streamed model turn"""
+    return [
+        sse_event('tool_call', {'name': 'get_telemetry'}),
+        sse_event('token', {'content': answer}),
+        sse_event('done', {'finish_reason': 'stop', 'conversation_id': conversation_id}),
+    ]
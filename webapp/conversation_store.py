@@ -0,0 +1,197 @@
+"""
+Server-side conversation store.
+
+Holds the already-built chat messages (including assistant tool calls and
+tool results) keyed by conversation id, so clients only send the new user
+message. History is trimmed to a token budget on save.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from azure.ai.inference.models import (
+    AssistantMessage,
+    SystemMessage,
+    ToolMessage,
+    UserMessage,
+)
+
+logger = logging.getLogger(__name__)
+
+# Message role -> model class used to rebuild stored messages
+MESSAGE_CLASSES = {
+    "system": SystemMessage,
+    "user": UserMessage,
+    "assistant": AssistantMessage,
+    "tool": ToolMessage,
+}
+
+# Rough per-message overhead (role, separators) in tokens
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def estimate_tokens(message):
+    """Estimate the token count of a message (about four characters per token)."""
+    content = message.get("content") or ""
+    size = len(content) if isinstance(content, str) else len(json.dumps(content))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function") or {}
+        size += len(function.get("name") or "") + len(function.get("arguments") or "")
+    return size // 4 + MESSAGE_TOKEN_OVERHEAD
+
+
+def trim_to_token_budget(messages, token_budget):
+    """
+    Drop the oldest turns until the history fits in ``token_budget`` tokens.
+
+    A turn starts at a user message and includes the assistant and tool
+    messages that follow it, so tool results are never separated from the
+    tool calls that produced them. The most recent turn is always kept.
+    """
+    turns = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+
+    turn_tokens = [sum(estimate_tokens(message) for message in turn) for turn in turns]
+    total = sum(turn_tokens)
+    start = 0
+    while total > token_budget and start < len(turns) - 1:
+        total -= turn_tokens[start]
+        start += 1
+
+    return [message for turn in turns[start:] for message in turn]
+
+
+def serialize_messages(messages):
+    """Serialize chat messages to a JSON string."""
+    return json.dumps([message.as_dict() for message in messages])
+
+
+def deserialize_messages(data):
+    """Rebuild chat messages from a JSON string produced by serialize_messages."""
+    return [MESSAGE_CLASSES[message["role"]](message) for message in json.loads(data)]
+
+
+class InMemoryConversationStore:
+    """Process-local LRU conversation store."""
+
+    def __init__(self, max_conversations=1000, token_budget=3000):
+        """
+        Initialize the InMemoryConversationStore.
+
+        Args:
+            max_conversations: Conversations kept before the least recently used is evicted
+            token_budget: Approximate token budget for the stored history of one conversation
+        """
+        self.max_conversations = max_conversations
+        self.token_budget = token_budget
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        """Return the stored messages for a conversation (empty if unknown)."""
+        with self._lock:
+            messages = self._conversations.get(conversation_id)
+            if messages is None:
+                return []
+            self._conversations.move_to_end(conversation_id)
+            return list(messages)
+
+    def save(self, conversation_id, messages):
+        """Store the messages for a conversation, trimmed to the token budget."""
+        messages = trim_to_token_budget(messages, self.token_budget)
+        with self._lock:
+            self._conversations[conversation_id] = messages
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def stats(self):
+        """Return store statistics."""
+        with self._lock:
+            return {"backend": "memory", "conversations": len(self._conversations)}
+
+
+class SQLiteConversationStore:
+    """SQLite-backed conversation store, shared by all worker processes on a host."""
+
+    def __init__(self, db_path, max_conversations=10000, token_budget=3000):
+        """
+        Initialize the SQLiteConversationStore.
+
+        Args:
+            db_path: Path of the SQLite database file
+            max_conversations: Conversations kept before the least recently used is evicted
+            token_budget: Approximate token budget for the stored history of one conversation
+        """
+        self.db_path = db_path
+        self.max_conversations = max_conversations
+        self.token_budget = token_budget
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return this thread's connection, opening it (and the schema) on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)"
+            )
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def get(self, conversation_id):
+        """Return the stored messages for a conversation (empty if unknown)."""
+        row = self._connection().execute(
+            "SELECT messages FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return deserialize_messages(row[0]) if row else []
+
+    def save(self, conversation_id, messages):
+        """Store the messages for a conversation, trimmed to the token budget."""
+        data = serialize_messages(trim_to_token_budget(messages, self.token_budget))
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO conversations (id, messages, updated_at) VALUES (?, ?, ?)",
+                (conversation_id, data, time.time()),
+            )
+            connection.execute(
+                "DELETE FROM conversations WHERE id IN ("
+                "SELECT id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_conversations,),
+            )
+
+    def stats(self):
+        """Return store statistics."""
+        count = self._connection().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return {"backend": "sqlite", "conversations": count}
+
+
+def create_conversation_store():
+    """Create the conversation store selected by the CONVERSATION_STORE environment variable."""
+    backend = os.environ.get("CONVERSATION_STORE", "memory").lower()
+    max_conversations = int(os.environ.get("CONVERSATION_MAX_CONVERSATIONS", 1000))
+    token_budget = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", 3000))
+
+    if backend == "sqlite":
+        db_path = os.environ.get("CONVERSATION_DB_PATH", "conversations.db")
+        logger.info(f"Using SQLite conversation store at {db_path}")
+        return SQLiteConversationStore(db_path, max_conversations, token_budget)
+
+    if backend != "memory":
+        logger.warning(f"Unknown CONVERSATION_STORE '{backend}', using in-memory store")
+    return InMemoryConversationStore(max_conversations, token_budget)
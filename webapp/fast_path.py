@@ -0,0 +1,268 @@
+"""
+Rule-based fast path for simple telemetry questions.
+
+Messages such as "what's the CPU now?" or "temperature last hour" name one
+sensor and at most one time window and nothing else. They are answered by
+calling get_telemetry directly and filling in a template, which skips the two
+model round-trips around the tool call. The matcher is deliberately strict:
+any word it does not recognise sends the message to the full model loop.
+"""
+
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from result_shaping import summarize
+
+# Words that name each sensor key from the get_telemetry tool schema
+SENSOR_WORDS = {
+    "Temperature": {"temperature", "temp", "hot", "warm", "cold"},
+    "Light": {"light", "brightness", "bright", "lux", "dark"},
+    "CPU": {"cpu", "processor"},
+}
+
+SENSOR_UNITS = {"Temperature": "°C", "Light": " lux", "CPU": "%"}
+
+# Words that may appear around a sensor name without changing the question
+FILLER_WORDS = {
+    "a", "an", "it", "the", "is", "are", "was", "what", "whats", "how", "s", "show", "me", "tell",
+    "get", "give", "check", "please", "current", "currently", "latest", "right", "now",
+    "reading", "readings", "level", "levels", "value", "values", "usage", "load",
+    "utilisation", "utilization", "data", "sensor", "of", "on", "for", "in", "over", "during",
+    "my", "pi", "raspberry", "average", "min", "max", "minimum", "maximum",
+}
+
+UNIT_SECONDS = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+
+# Longest window the parser accepts (five years); longer ones go to the model
+MAX_WINDOW_SECONDS = 5 * 365 * 86400
+
+# "last 3 hours", "past 30 mins", "previous day", "last hour"
+WINDOW_PATTERN = re.compile(
+    r"\b(?:last|past|previous)\s+(?:(\d+)\s+)?(minute|min|hour|hr|day|week)s?\b"
+)
+TODAY_PATTERN = re.compile(r"\btoday\b")
+
+UNIT_ALIASES = {"min": "minute", "hr": "hour"}
+
+
+def _format_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def normalize(message):
+    """Lower-case a message and replace punctuation with spaces ("what's" becomes "whats")."""
+    return re.sub(r"[^a-z0-9\s]", " ", message.lower().replace("'", ""))
+
+
+def parse_window(text, now, default_window):
+    """
+    Find the time window named in normalized ``text``.
+
+    Returns ``(start, window_description, remaining_text)``, using
+    ``default_window`` ("right now") when no window is named, or None when the
+    text names more than one window or one longer than MAX_WINDOW_SECONDS.
+    """
+    window = None
+    windows = WINDOW_PATTERN.findall(text)
+    if len(windows) > 1:
+        return None
+    if windows:
+        count, unit = windows[0]
+        unit = UNIT_ALIASES.get(unit, unit)
+        count = int(count) if count else 1
+        if count <= 0 or count * UNIT_SECONDS[unit] > MAX_WINDOW_SECONDS:
+            return None
+        start = now - timedelta(seconds=count * UNIT_SECONDS[unit])
+        window = f"the last {count} {unit}s" if count > 1 else f"the last {unit}"
+        text = WINDOW_PATTERN.sub(" ", text)
+    if TODAY_PATTERN.search(text):
+        if window is not None:
+            return None
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        window = "today"
+        text = TODAY_PATTERN.sub(" ", text)
+    if window is None:
+        start = now - default_window
+        window = "right now"
+    return start, window, text
+
+
+def find_sensors(words):
+    """Return the sensor keys named by ``words`` and the words that are neither sensors nor filler."""
+    sensors = set()
+    unknown = []
+    for word in words:
+        sensor = next((key for key, names in SENSOR_WORDS.items() if word in names), None)
+        if sensor is not None:
+            sensors.add(sensor)
+        elif word not in FILLER_WORDS:
+            unknown.append(word)
+    return sensors, unknown
+
+
+def telemetry_args(sensor, start, end):
+    """get_telemetry arguments for a sensor and window."""
+    return {"sensor_key": sensor, "start_date": _format_time(start), "end_date": _format_time(end)}
+
+
+def extract_values(result):
+    """Return the numeric readings in a get_telemetry result (oldest first), or an empty list."""
+    if not isinstance(result, dict):
+        return []
+    for field in ("values", "readings", "data", "points"):
+        items = result.get(field)
+        if not isinstance(items, list):
+            continue
+        values = []
+        for item in items:
+            if isinstance(item, dict):
+                item = item.get("value")
+            elif isinstance(item, (list, tuple)) and len(item) == 2:
+                item = item[1]
+            if isinstance(item, (int, float)) and not isinstance(item, bool):
+                values.append(item)
+        if values:
+            return values
+    value = result.get("value")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return [value]
+    return []
+
+
+class FastPath:
+    """Answers simple single-sensor telemetry questions without calling the model."""
+
+    def __init__(self, enabled=True, default_window_minutes=15, max_words=12):
+        """
+        Initialize the FastPath.
+
+        Args:
+            enabled: Whether messages are matched at all
+            default_window_minutes: Window queried for "now"/"current" questions
+            max_words: Longer messages always go to the model
+        """
+        self.enabled = enabled
+        self.default_window = timedelta(minutes=default_window_minutes)
+        self.max_words = max_words
+        self._lock = threading.Lock()
+        self._counters = {"checked": 0, "hits": 0, "fallbacks": 0}
+        self._fast_seconds = 0.0
+        self._model_turns = 0
+        self._model_seconds = 0.0
+
+    def match(self, message, now=None):
+        """
+        Return ``(tool_args, window_description)`` for a simple telemetry
+        question, or None if the message needs the model.
+        """
+        if not self.enabled or not isinstance(message, str):
+            return None
+        now = now or datetime.now(timezone.utc)
+        text = normalize(message)
+        if len(text.split()) > self.max_words:
+            return None
+
+        parsed = parse_window(text, now, self.default_window)
+        if parsed is None:
+            return None
+        start, window, text = parsed
+
+        sensors, unknown = find_sensors(text.split())
+        if unknown or len(sensors) != 1:
+            return None
+        return telemetry_args(sensors.pop(), start, now), window
+
+    def format_answer(self, args, window, result):
+        """Fill in the answer template for a get_telemetry result."""
+        sensor = args["sensor_key"]
+        unit = SENSOR_UNITS.get(sensor, "")
+        if isinstance(result, dict) and result.get("error"):
+            return f"Sorry, I couldn't get the {sensor} reading: {result['error']}"
+
+        values = extract_values(result)
+        if not values:
+            message = result.get("message") if isinstance(result, dict) else None
+            detail = f" ({message})" if message else ""
+            if window == "right now":
+                return f"I've asked the Raspberry Pi for its latest {sensor} reading{detail}."
+            return f"I've asked the Raspberry Pi for its {sensor} readings for {window}{detail}."
+
+        summary = summarize(values)
+        if summary["count"] == 1 or window == "right now":
+            return f"The {sensor} reading is {summary['last']}{unit}."
+        return (
+            f"{sensor} over {window}: latest {summary['last']}{unit}, "
+            f"min {summary['min']}{unit}, max {summary['max']}{unit}, "
+            f"average {summary['mean']}{unit} ({summary['count']} readings)."
+        )
+
+    def _begin(self, message):
+        with self._lock:
+            self._counters["checked"] += 1
+        matched = self.match(message)
+        if matched is None:
+            with self._lock:
+                self._counters["fallbacks"] += 1
+        return matched
+
+    def _finish(self, started):
+        with self._lock:
+            self._counters["hits"] += 1
+            self._fast_seconds += time.perf_counter() - started
+
+    def answer(self, message, fetch):
+        """
+        Return ``(tool_args, answer)`` for a simple telemetry question, or None.
+
+        ``fetch(tool_args)`` performs the get_telemetry call.
+        """
+        started = time.perf_counter()
+        matched = self._begin(message)
+        if matched is None:
+            return None
+        args, window = matched
+        answer = self.format_answer(args, window, fetch(args))
+        self._finish(started)
+        return args, answer
+
+    async def aanswer(self, message, fetch):
+        """Async variant of answer(); ``fetch(tool_args)`` returns an awaitable."""
+        started = time.perf_counter()
+        matched = self._begin(message)
+        if matched is None:
+            return None
+        args, window = matched
+        answer = self.format_answer(args, window, await fetch(args))
+        self._finish(started)
+        return args, answer
+
+    def record_model_turn(self, seconds):
+        """Record the latency of a model-loop turn with one tool round, for the savings estimate."""
+        with self._lock:
+            self._model_turns += 1
+            self._model_seconds += seconds
+
+    def stats(self):
+        """Return hit rate and the estimated latency saved by answering without the model."""
+        with self._lock:
+            counters = dict(self._counters)
+            fast_seconds = self._fast_seconds
+            model_turns = self._model_turns
+            model_seconds = self._model_seconds
+
+        hits = counters["hits"]
+        avg_fast_ms = fast_seconds / hits * 1000 if hits else None
+        avg_model_ms = model_seconds / model_turns * 1000 if model_turns else None
+        saved_s = None
+        if avg_fast_ms is not None and avg_model_ms is not None:
+            saved_s = round(hits * (avg_model_ms - avg_fast_ms) / 1000, 3)
+        return {
+            **counters,
+            "enabled": self.enabled,
+            "hit_rate": round(hits / counters["checked"], 3) if counters["checked"] else 0.0,
+            "avg_fast_path_ms": round(avg_fast_ms, 1) if avg_fast_ms is not None else None,
+            "avg_model_turn_ms": round(avg_model_ms, 1) if avg_model_ms is not None else None,
+            "estimated_seconds_saved": saved_s,
+        }
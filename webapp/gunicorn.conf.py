@@ -0,0 +1,16 @@
+"""
+Gunicorn server hooks for the Pi Chat web app.
+
+Gunicorn loads this file from the working directory automatically; the
+bind/workers/timeout options stay on the command line (see Dockerfile).
+"""
+
+import os
+import threading
+
+
+def post_worker_init(worker):
+    """Warm up each worker's clients in the background when WARM_UP_ON_START is set"""
+    if os.environ.get('WARM_UP_ON_START', 'false').lower() == 'true':
+        from app import warm_up
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Offline load test and latency benchmark for the /api/chat pipeline.
+
+Runs the real Flask (or ASGI) application against local stand-ins so the
+request path can be measured without Azure:
+
+- a fake ChatCompletionsClient that replays a scripted tool-call sequence
+  with configurable model and per-token latency, and
+- a fake Function App serving /api/GetTelemetry and /api/SendAction with
+  configurable latency.
+
+/api/chat is driven at the requested concurrency and the results (p50/p95/p99
+latency, time to first token when streaming, throughput and tool-iteration
+counts) are printed as JSON.
+
+Usage:
+    python load_test.py --scenario parallel_tools --concurrency 16 --requests 200
+    python load_test.py --app asgi --stream --output results.json --max-p95-ms 2000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+# Tool calls the fake model requests, one list per model turn
+SCENARIOS = {
+    "direct": [],
+    "single_tool": [
+        [("get_telemetry", {"sensor_key": "Temperature"})],
+    ],
+    "parallel_tools": [
+        [("get_telemetry", {"sensor_key": "Temperature"}), ("get_telemetry", {"sensor_key": "CPU"})],
+    ],
+    "chained_tools": [
+        [("get_telemetry", {"sensor_key": "Light"})],
+        [("send_action", {"action_type": "Camera", "action_spec": "{\"operation\": \"capture\"}"})],
+    ],
+}
+
+# With --fast-path every other request asks this instead of the scripted question
+FAST_PATH_QUESTION = "What's the temperature right now?"
+
+# With --prefetch the scripted question names its window, so get_telemetry can be prefetched
+PREFETCH_QUESTION = "What was the temperature over the last hour? ({index})"
+
+FINAL_ANSWER = "The temperature is 22.5°C and the CPU is at 41% utilisation over the last hour."
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of numbers (nearest-rank)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def jittered(latency_ms, jitter):
+    """Return a latency in seconds with +/- jitter (fraction of the latency)."""
+    return max(0.0, latency_ms * (1 + random.uniform(-jitter, jitter))) / 1000
+
+
+class ScriptedModel:
+    """Shared logic of the fake sync/async ChatCompletionsClient."""
+
+    def __init__(self, scenario, model_latency_ms, token_latency_ms, jitter):
+        self.turns = SCENARIOS[scenario]
+        self.model_latency_ms = model_latency_ms
+        self.token_latency_ms = token_latency_ms
+        self.jitter = jitter
+        self.iterations = []
+        self._lock = threading.Lock()
+
+    def _next_turn(self, messages):
+        """Return the tool calls for this turn, or None when the answer is due."""
+        rounds = 0
+        for message in reversed(messages):
+            if message.role == "user":
+                break
+            if message.role == "assistant" and message.get("tool_calls"):
+                rounds += 1
+        if rounds < len(self.turns):
+            return self._tool_calls(self.turns[rounds], rounds)
+        with self._lock:
+            self.iterations.append(rounds)
+        return None
+
+    def _tool_calls(self, turn, rounds):
+        from azure.ai.inference.models import ChatCompletionsToolCall, FunctionCall
+
+        now = time.time()
+        tool_calls = []
+        for index, (name, arguments) in enumerate(turn):
+            if name == "get_telemetry":
+                arguments = {
+                    **arguments,
+                    "start_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - 3600)),
+                    "end_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now + 60)),
+                }
+            tool_calls.append(ChatCompletionsToolCall(
+                id=f"call_{rounds}_{index}_{random.getrandbits(32):08x}",
+                function=FunctionCall(name=name, arguments=json.dumps(arguments)),
+            ))
+        return tool_calls
+
+    def _response(self, tool_calls):
+        if tool_calls:
+            message = SimpleNamespace(content=None, tool_calls=tool_calls)
+            return SimpleNamespace(choices=[SimpleNamespace(finish_reason="tool_calls", message=message)])
+        message = SimpleNamespace(content=FINAL_ANSWER, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(finish_reason="stop", message=message)])
+
+    def _updates(self, tool_calls):
+        """Streaming updates: the tool calls in one update, or the answer word by word."""
+        def update(content=None, tool_call_updates=None, finish_reason=None):
+            delta = SimpleNamespace(content=content, tool_calls=tool_call_updates)
+            return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+        if tool_calls:
+            return [update(tool_call_updates=tool_calls), update(finish_reason="tool_calls")]
+        words = FINAL_ANSWER.split(" ")
+        return [update(content=word + " ") for word in words] + [update(finish_reason="stop")]
+
+
+class FakeChatCompletionsClient(ScriptedModel):
+    """Stand-in for azure.ai.inference.ChatCompletionsClient."""
+
+    def complete(self, messages, model=None, tools=None, stream=False, **kwargs):
+        time.sleep(jittered(self.model_latency_ms, self.jitter))
+        tool_calls = self._next_turn(messages)
+        if not stream:
+            return self._response(tool_calls)
+
+        updates, token_delay = self._updates(tool_calls), self.token_latency_ms / 1000
+
+        class Stream:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def __iter__(self):
+                for item in updates:
+                    if token_delay:
+                        time.sleep(token_delay)
+                    yield item
+
+        return Stream()
+
+
+class FakeAsyncChatCompletionsClient(ScriptedModel):
+    """Stand-in for azure.ai.inference.aio.ChatCompletionsClient."""
+
+    async def complete(self, messages, model=None, tools=None, stream=False, **kwargs):
+        await asyncio.sleep(jittered(self.model_latency_ms, self.jitter))
+        tool_calls = self._next_turn(messages)
+        if not stream:
+            return self._response(tool_calls)
+
+        updates, token_delay = self._updates(tool_calls), self.token_latency_ms / 1000
+
+        class Stream:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc_info):
+                return False
+
+            async def __aiter__(self):
+                for item in updates:
+                    if token_delay:
+                        await asyncio.sleep(token_delay)
+                    yield item
+
+        return Stream()
+
+    async def close(self):
+        pass
+
+
+def start_fake_function_app(latency_ms, jitter):
+    """Serve fake GetTelemetry/SendAction endpoints on a local port; returns (server, url)."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            time.sleep(jittered(latency_ms, jitter))
+            if self.path.startswith("/api/GetTelemetry"):
+                result = {"status": "success", "SensorKey": body.get("SensorKey"), "value": 22.5}
+            elif self.path.startswith("/api/SendAction"):
+                result = {"status": "success", "message": "Action request sent"}
+            else:
+                self.send_error(404)
+                return
+            payload = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_flask_app(model):
+    """Serve app.py with a threaded WSGI server; returns (stop, url)."""
+    from werkzeug.serving import make_server
+    import app as flask_app
+
+    flask_app.client = model
+    server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_asgi_app(model):
+    """Serve asgi_app.py with uvicorn in a background thread; returns (stop, url)."""
+    import uvicorn
+    import asgi_app
+
+    asgi_app.client = model
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(asgi_app.app, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join(timeout=5)
+
+    return stop, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def run_load(url, total_requests, concurrency, stream, fast_path=False, prefetch=False):
+    """Drive /api/chat and return a list of per-request result dicts."""
+    # Imported here so startup_benchmark.py can reuse the fakes without it
+    import requests
+
+    counter = iter(range(total_requests))
+    counter_lock = threading.Lock()
+    local = threading.local()
+
+    def one_request(index):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        message = PREFETCH_QUESTION.format(index=index) if prefetch else f"What is the temperature? ({index})"
+        if fast_path and index % 2 == 0:
+            message = FAST_PATH_QUESTION
+        body = {"message": message, "stream": stream}
+        started = time.perf_counter()
+        first_token = None
+        try:
+            response = session.post(f"{url}/api/chat", json=body, stream=stream, timeout=120)
+            ok = response.status_code == 200
+            if stream and ok:
+                for line in response.iter_lines(decode_unicode=True):
+                    if first_token is None and line == "event: token":
+                        first_token = time.perf_counter()
+                    elif line == "event: error":
+                        ok = False
+            else:
+                response.content
+        except requests.exceptions.RequestException:
+            ok = False
+        finished = time.perf_counter()
+        return {
+            "ok": ok,
+            "latency_ms": (finished - started) * 1000,
+            "ttft_ms": (first_token - started) * 1000 if first_token else None,
+        }
+
+    def worker():
+        results = []
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                return results
+            results.append(one_request(index))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker) for _ in range(concurrency)]
+        return [result for future in futures for result in future.result()]
+
+
+def summarize_latencies(values):
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(statistics.mean(values), 2),
+        "max": round(max(values), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for /api/chat")
+    parser.add_argument("--app", choices=["flask", "asgi"], default="flask", help="Serving mode to benchmark")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="single_tool")
+    parser.add_argument("--requests", type=int, default=100, help="Total chat requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--stream", action="store_true", help="Use the SSE streaming mode")
+    parser.add_argument("--model-latency-ms", type=float, default=300, help="Latency of each model call")
+    parser.add_argument("--token-latency-ms", type=float, default=5, help="Delay between streamed tokens")
+    parser.add_argument("--tool-latency-ms", type=float, default=200, help="Latency of each Function App call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter as a fraction")
+    parser.add_argument("--fast-path", action="store_true",
+                        help="Enable the rule-based fast path and send it every other request")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Enable speculative get_telemetry prefetch and ask questions that name a window")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit non-zero if p95 latency exceeds this")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    function_server, function_url = start_fake_function_app(args.tool_latency_ms, args.jitter)
+
+    # Configure the application before it is imported
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.update({
+        "FUNCTION_APP_URL": function_url,
+        "FUNCTION_APP_KEY": "load-test",
+        "AZURE_OPENAI_ENDPOINT": "https://load-test.invalid",
+        "AZURE_OPENAI_API_KEY": "load-test",
+        "CONVERSATION_STORE": "memory",
+        "FAST_PATH_ENABLED": "true" if args.fast_path else "false",
+        "PREFETCH_ENABLED": "true" if args.prefetch else "false",
+    })
+    os.environ.pop("APPLICATIONINSIGHTS_CONNECTION_STRING", None)
+    logging.disable(logging.INFO)
+
+    model_args = (args.scenario, args.model_latency_ms, args.token_latency_ms, args.jitter)
+    if args.app == "asgi":
+        model = FakeAsyncChatCompletionsClient(*model_args)
+        stop, url = start_asgi_app(model)
+    else:
+        model = FakeChatCompletionsClient(*model_args)
+        stop, url = start_flask_app(model)
+
+    started = time.perf_counter()
+    results = run_load(url, args.requests, args.concurrency, args.stream, args.fast_path, args.prefetch)
+    elapsed = time.perf_counter() - started
+    stop()
+    function_server.shutdown()
+
+    latencies = [r["latency_ms"] for r in results if r["ok"]]
+    ttfts = [r["ttft_ms"] for r in results if r["ok"] and r["ttft_ms"] is not None]
+    report = {
+        "config": vars(args),
+        "requests": len(results),
+        "errors": sum(1 for r in results if not r["ok"]),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_ms": summarize_latencies(latencies),
+        "time_to_first_token_ms": summarize_latencies(ttfts),
+        "tool_iterations": {
+            "mean": round(statistics.mean(model.iterations), 2) if model.iterations else 0,
+            "max": max(model.iterations, default=0),
+        },
+    }
+    if args.fast_path:
+        import chat_common
+        report["fast_path"] = chat_common.fast_path.stats()
+    if args.prefetch:
+        import chat_common
+        report["prefetch"] = chat_common.prefetcher.stats()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if report["errors"]:
+        return 1
+    if args.max_p95_ms is not None and report["latency_ms"] and report["latency_ms"]["p95"] > args.max_p95_ms:
+        print(f"p95 latency {report['latency_ms']['p95']}ms exceeds {args.max_p95_ms}ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
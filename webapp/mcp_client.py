@@ -0,0 +1,411 @@
+"""
+MCP transport for the Azure Function endpoints.
+
+Keeps a pooled keep-alive ``requests.Session`` (or ``aiohttp.ClientSession``
+for the async serving mode) per host, retries idempotent calls with jittered
+exponential backoff and fails fast through a circuit breaker while the
+Function App is down.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# requests and aiohttp are imported where they are first needed: each app
+# only uses one of them, and both are slow to import on a cold start
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes worth retrying (throttling and transient server errors)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def telemetry_payload(arguments):
+    """GetTelemetry request for get_telemetry arguments; max_points and resolution only when given"""
+    payload = {
+        "SensorKey": arguments.get("sensor_key"),
+        "StartDate": arguments.get("start_date"),
+        "EndDate": arguments.get("end_date"),
+    }
+    if arguments.get("max_points") is not None:
+        payload["MaxPoints"] = arguments["max_points"]
+    if arguments.get("resolution") is not None:
+        payload["Resolution"] = arguments["resolution"]
+    return payload
+
+
+# Function name -> endpoint, payload builder and whether it is safe to retry
+MCP_FUNCTIONS = {
+    "get_telemetry": {
+        "endpoint": "GetTelemetry",
+        "payload": telemetry_payload,
+        "idempotent": True,
+    },
+    "send_action": {
+        "endpoint": "SendAction",
+        "payload": lambda arguments: {
+            "ActionType": arguments.get("action_type"),
+            "ActionSpec": arguments.get("action_spec"),
+        },
+        "idempotent": False,
+    },
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open trial call."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        Initialize the CircuitBreaker.
+
+        Args:
+            failure_threshold: Consecutive failures that open the circuit
+            reset_timeout: Seconds to stay open before allowing a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.times_opened = 0
+        self.rejected_calls = 0
+
+    def before_call(self):
+        """Reserve a call slot, raising CircuitOpenError if the circuit is open."""
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError("circuit open")
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError("circuit half-open, trial call in flight")
+                self._trial_in_flight = True
+
+    def record_success(self):
+        """Close the circuit after a successful call."""
+        with self._lock:
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """Count a failed call, opening the circuit once the threshold is reached."""
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.times_opened += 1
+                    logger.warning(f"Circuit breaker opened after {self._consecutive_failures} consecutive failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        """Return a snapshot of the breaker state and counters."""
+        with self._lock:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._consecutive_failures,
+                "times_opened": self.times_opened,
+                "rejected_calls": self.rejected_calls,
+            }
+
+
+class MCPClient:
+    """Reusable client for the Azure Function MCP endpoints."""
+
+    def __init__(self, base_url, function_key, timeout=30, pool_maxsize=10,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        """
+        Initialize the MCPClient.
+
+        Args:
+            base_url: Function App base URL (e.g., 'https://app.azurewebsites.net')
+            function_key: Function key sent in the x-functions-key header
+            timeout: Per-attempt HTTP timeout in seconds
+            pool_maxsize: Keep-alive connections kept per host
+            max_retries: Retries for idempotent calls after the first attempt
+            backoff_base: Base delay in seconds for exponential backoff
+            backoff_max: Upper bound in seconds for a single backoff delay
+            failure_threshold: Consecutive failures that open the circuit breaker
+            reset_timeout: Seconds the breaker stays open before a trial call
+        """
+        self.base_url = base_url.rstrip("/") if base_url else base_url
+        self.function_key = function_key
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._sessions = {}
+        self._adapters = {}
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "retries": 0, "failures": 0}
+
+    @property
+    def configured(self):
+        """Whether the Function App URL and key are both set."""
+        return bool(self.base_url and self.function_key)
+
+    def _session_for(self, url):
+        """Return the pooled session for the URL's host, creating it on first use."""
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        host = urlparse(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    "Content-Type": "application/json",
+                    "x-functions-key": self.function_key,
+                })
+                self._sessions[host] = session
+                self._adapters[host] = adapter
+            return session
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _backoff(self, attempt):
+        """Full-jitter exponential backoff delay for the given retry attempt."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _prepare_call(self, function_name, arguments):
+        """
+        Resolve the URL, payload and attempt count for a call and reserve a
+        circuit breaker slot.
+
+        Returns ``(url, payload, attempts, None)``, or ``(None, None, 0, error_result)``
+        when the call must not be made.
+        """
+        if not self.configured:
+            logger.error("Function App URL or Key not configured")
+            return None, None, 0, {"error": "MCP endpoints not configured"}
+
+        function = MCP_FUNCTIONS.get(function_name)
+        if function is None:
+            return None, None, 0, {"error": f"Unknown function: {function_name}"}
+
+        url = f"{self.base_url}/api/{function['endpoint']}"
+        payload = function["payload"](arguments)
+        attempts = 1 + (self.max_retries if function["idempotent"] else 0)
+        self._count("calls")
+
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            logger.warning(f"MCP function {function_name} rejected: circuit breaker open")
+            return None, None, 0, {"error": f"{function_name} is temporarily unavailable, please try again shortly"}
+
+        return url, payload, attempts, None
+
+    def call(self, function_name, arguments):
+        """
+        Call an MCP function and return its JSON result.
+
+        Errors are returned as ``{"error": ...}`` dictionaries so they can be
+        passed back to the model as the tool result.
+        """
+        import requests
+
+        url, payload, attempts, error_result = self._prepare_call(function_name, arguments)
+        if error_result is not None:
+            return error_result
+        session = self._session_for(url)
+
+        logger.info(f"Calling MCP function {function_name} with payload: {payload}")
+        for attempt in range(attempts):
+            if attempt:
+                self._count("retries")
+                time.sleep(self._backoff(attempt - 1))
+            try:
+                response = session.post(url, json=payload, timeout=self.timeout)
+                if response.status_code in RETRYABLE_STATUS_CODES and attempt + 1 < attempts:
+                    logger.warning(f"MCP function {function_name} returned {response.status_code}, retrying")
+                    continue
+                response.raise_for_status()
+                result = response.json()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt + 1 < attempts:
+                    logger.warning(f"MCP function {function_name} attempt {attempt + 1} failed: {str(e)}")
+                    continue
+                return self._fail(function_name, e, transient=True)
+            except requests.exceptions.HTTPError as e:
+                transient = e.response is not None and e.response.status_code in RETRYABLE_STATUS_CODES
+                return self._fail(function_name, e, transient=transient)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                return self._fail(function_name, e, transient=False)
+
+            self.breaker.record_success()
+            logger.info(f"MCP function {function_name} succeeded")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"MCP function {function_name} response: {result}")
+            return result
+
+    def warm_up(self):
+        """Open a pooled connection to the Function App ahead of the first call."""
+        import requests
+
+        if not self.configured:
+            return False
+        try:
+            self._session_for(self.base_url).head(self.base_url, timeout=self.timeout)
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"MCP warm-up request failed: {str(e)}")
+            return False
+
+    def _fail(self, function_name, error, transient):
+        """Record a failed call and build the error result for the model."""
+        self._count("failures")
+        if transient:
+            self.breaker.record_failure()
+        else:
+            # The backend answered, so it is up even if this request was bad
+            self.breaker.record_success()
+        logger.error(f"Error calling MCP function {function_name}: {str(error)}")
+        return {"error": f"Failed to call {function_name}: {str(error)}"}
+
+    def stats(self):
+        """Return connection pool, retry and circuit breaker statistics."""
+        with self._lock:
+            counters = dict(self._counters)
+            adapters = dict(self._adapters)
+
+        pools = {}
+        for host, adapter in adapters.items():
+            host_stats = {"connections_opened": 0, "requests_sent": 0, "idle_connections": 0,
+                          "max_connections": self.pool_maxsize}
+            pool_manager = adapter.poolmanager
+            for key in pool_manager.pools.keys():
+                pool = pool_manager.pools.get(key)
+                if pool is None:
+                    continue
+                host_stats["connections_opened"] += pool.num_connections
+                host_stats["requests_sent"] += pool.num_requests
+                # Empty slots in the pool queue are None placeholders
+                if pool.pool is not None:
+                    host_stats["idle_connections"] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            pools[host] = host_stats
+
+        return {**counters, "pools": pools, "circuit_breaker": self.breaker.stats()}
+
+
+class AsyncMCPClient(MCPClient):
+    """asyncio variant of MCPClient built on a pooled aiohttp session per host."""
+
+    def _session_for(self, url):
+        """Return the pooled aiohttp session for the URL's host, creating it on first use."""
+        import aiohttp
+
+        host = urlparse(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(limit_per_host=self.pool_maxsize, keepalive_timeout=60)
+                session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                    headers={
+                        "Content-Type": "application/json",
+                        "x-functions-key": self.function_key,
+                    },
+                )
+                self._sessions[host] = session
+            return session
+
+    async def call(self, function_name, arguments):
+        """
+        Call an MCP function and return its JSON result.
+
+        Errors are returned as ``{"error": ...}`` dictionaries so they can be
+        passed back to the model as the tool result.
+        """
+        import aiohttp
+
+        url, payload, attempts, error_result = self._prepare_call(function_name, arguments)
+        if error_result is not None:
+            return error_result
+        session = self._session_for(url)
+
+        logger.info(f"Calling MCP function {function_name} with payload: {payload}")
+        for attempt in range(attempts):
+            if attempt:
+                self._count("retries")
+                await asyncio.sleep(self._backoff(attempt - 1))
+            try:
+                async with session.post(url, json=payload) as response:
+                    if response.status in RETRYABLE_STATUS_CODES and attempt + 1 < attempts:
+                        logger.warning(f"MCP function {function_name} returned {response.status}, retrying")
+                        continue
+                    response.raise_for_status()
+                    result = await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt + 1 < attempts:
+                    logger.warning(f"MCP function {function_name} attempt {attempt + 1} failed: {str(e)}")
+                    continue
+                return self._fail(function_name, e, transient=True)
+            except aiohttp.ClientResponseError as e:
+                return self._fail(function_name, e, transient=e.status in RETRYABLE_STATUS_CODES)
+            except (aiohttp.ClientError, ValueError) as e:
+                return self._fail(function_name, e, transient=False)
+
+            self.breaker.record_success()
+            logger.info(f"MCP function {function_name} succeeded")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"MCP function {function_name} response: {result}")
+            return result
+
+    async def warm_up(self):
+        """Open a pooled connection to the Function App ahead of the first call."""
+        import aiohttp
+
+        if not self.configured:
+            return False
+        try:
+            async with self._session_for(self.base_url).head(self.base_url):
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"MCP warm-up request failed: {str(e)}")
+            return False
+
+    async def close(self):
+        """Close all pooled sessions."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            await session.close()
+
+    def stats(self):
+        """Return connection pool, retry and circuit breaker statistics."""
+        with self._lock:
+            counters = dict(self._counters)
+            hosts = list(self._sessions)
+        pools = {host: {"max_connections": self.pool_maxsize} for host in hosts}
+        return {**counters, "pools": pools, "circuit_breaker": self.breaker.stats()}
@@ -0,0 +1,112 @@
+"""
+In-process latency histograms exposed in Prometheus text format.
+
+Stages of a chat turn (model calls, tool calls, message building,
+serialization) are timed with ``Histogram.time()`` and aggregated per label
+set; ``MetricsRegistry.render()`` produces the /api/metrics payload.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Default latency buckets in seconds, from local work to slow model calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    """Cumulative latency histogram with a fixed set of label names."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        Initialize the Histogram.
+
+        Args:
+            name: Metric name (e.g., 'pichat_model_call_duration_seconds')
+            help_text: Description shown in the HELP line
+            label_names: Names of the labels every observation must provide
+            buckets: Upper bounds of the histogram buckets in seconds
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        """Record one observation (in seconds) for the given label values."""
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager that observes the duration of its block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        """Return the histogram in Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: {"buckets": list(s["buckets"]), "sum": s["sum"], "count": s["count"]}
+                      for key, s in self._series.items()}
+        for key in sorted(series):
+            values = series[key]
+            label_pairs = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(label_pairs + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(label_pairs + [('le', '+Inf')])} {values['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(label_pairs)} {values['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(label_pairs)} {values['count']}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """Named collection of histograms rendered together at /api/metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        """Return the histogram with this name, creating it on first use."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(name, help_text, label_names, buckets)
+            return histogram
+
+    def render(self):
+        """Return all histograms in Prometheus text exposition format."""
+        with self._lock:
+            histograms = list(self._histograms.values())
+        return "\n".join(histogram.render() for histogram in histograms) + "\n"
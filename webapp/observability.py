@@ -0,0 +1,282 @@
+"""
+Non-blocking observability for the chat request path.
+
+Log records and telemetry events are put on bounded queues and handed to
+the exporters (console, Azure Monitor, Application Insights) by background
+threads, so a slow exporter endpoint never adds latency to a chat turn.
+When a queue is full the record is dropped and counted instead. Log
+messages are redacted and truncated before they are queued, and events are
+sampled per event type and exported in batches.
+"""
+
+import atexit
+import logging
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+# "api_key=...", '"password": "..."', "Authorization: Bearer ..." and similar
+SECRET_PATTERN = re.compile(
+    r"(?i)\b(api[_-]?key|x-functions-key|password|secret|token|authorization)"
+    r"([\"']?\s*[:=]\s*[\"']?)(bearer\s+)?[^\s\"',&;}]+"
+)
+# Function keys passed in the query string
+QUERY_KEY_PATTERN = re.compile(r"(?i)([?&](?:code|key|sig)=)[^&\s\"']+")
+
+_SENTINEL = object()
+
+
+def redact(text, max_length=None):
+    """Mask secrets in a string and truncate it to ``max_length`` characters."""
+    text = SECRET_PATTERN.sub(r"\1\2[REDACTED]", text)
+    text = QUERY_KEY_PATTERN.sub(r"\1[REDACTED]", text)
+    if max_length and len(text) > max_length:
+        text = f"{text[:max_length]}... [truncated {len(text) - max_length} chars]"
+    return text
+
+
+def parse_sample_rates(value):
+    """Parse 'event=rate,...' (e.g. 'chat_request=0.1') into a dict of rates between 0 and 1."""
+    rates = {}
+    for item in (value or "").split(","):
+        name, sep, rate = item.partition("=")
+        if not sep or not name.strip():
+            continue
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class LogPipeline(logging.Handler):
+    """Logging handler that queues records for a background thread to export."""
+
+    def __init__(self, queue_size=10000, max_message_length=1000):
+        """
+        Initialize the LogPipeline.
+
+        Args:
+            queue_size: Records held for export before new ones are dropped
+            max_message_length: Longer log messages are truncated (0 disables)
+        """
+        super().__init__()
+        self.max_message_length = max_message_length
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._handlers = []
+        self._lock = threading.Lock()
+        self._counters = {"queued": 0, "exported": 0, "dropped": 0, "export_errors": 0}
+        self._thread = threading.Thread(target=self._run, name="log-export", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_handler(self, handler, logger_names=None):
+        """
+        Export records through ``handler``, optionally only those from the
+        named loggers (and their children).
+        """
+        with self._lock:
+            self._handlers.append((handler, tuple(logger_names) if logger_names else None))
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def emit(self, record):
+        try:
+            # Format in the caller so the record no longer references request data
+            record.msg = redact(record.getMessage(), self.max_message_length)
+            record.args = None
+            self._queue.put_nowait(record)
+            self._count("queued")
+        except queue.Full:
+            self._count("dropped")
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is _SENTINEL:
+                return
+            with self._lock:
+                handlers = list(self._handlers)
+            for handler, logger_names in handlers:
+                if logger_names and not any(
+                    record.name == name or record.name.startswith(name + ".") for name in logger_names
+                ):
+                    continue
+                if record.levelno < handler.level:
+                    continue
+                try:
+                    handler.handle(record)
+                    self._count("exported")
+                except Exception:
+                    self._count("export_errors")
+
+    def close(self, timeout=5.0):
+        """Export the records still queued (waiting at most ``timeout`` seconds)."""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(_SENTINEL, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        super().close()
+
+    def stats(self):
+        """Return queued/exported/dropped counts and the current queue depth."""
+        with self._lock:
+            return {**self._counters, "queue_depth": self._queue.qsize()}
+
+
+def configure_logging(level=logging.INFO, queue_size=10000, max_message_length=1000):
+    """
+    Route all logging through a LogPipeline with a console handler, replacing
+    logging.basicConfig(). Returns the pipeline so exporters can be added.
+    """
+    pipeline = LogPipeline(queue_size=queue_size, max_message_length=max_message_length)
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    pipeline.add_handler(console)
+
+    root = logging.getLogger()
+    root.handlers = [pipeline]
+    root.setLevel(level)
+    return pipeline
+
+
+class EventBatcher:
+    """
+    Drop-in front for an Application Insights TelemetryClient.
+
+    track_event() and track_exception() only sample and enqueue; a background
+    thread forwards the events to the client and flushes it in batches.
+    """
+
+    def __init__(self, client, sample_rates=None, default_rate=1.0, batch_size=50,
+                 flush_interval=5.0, queue_size=1000, max_property_length=1000):
+        """
+        Initialize the EventBatcher.
+
+        Args:
+            client: TelemetryClient the events are exported through
+            sample_rates: Fraction of events kept per event name ('exception' for exceptions)
+            default_rate: Fraction kept for event names not in ``sample_rates``
+            batch_size: Events forwarded before the client is flushed
+            flush_interval: Seconds after which pending events are flushed anyway
+            queue_size: Events held for export before new ones are dropped
+            max_property_length: Longer string properties are truncated
+        """
+        self.client = client
+        self.sample_rates = sample_rates or {}
+        self.default_rate = default_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_property_length = max_property_length
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._counters = {"queued": 0, "sampled_out": 0, "dropped": 0, "exported": 0,
+                          "batches": 0, "export_errors": 0}
+        self._thread = threading.Thread(target=self._run, name="event-export", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _sample(self, name):
+        """Return the sample rate if the event is kept, or None if it is sampled out."""
+        rate = self.sample_rates.get(name, self.default_rate)
+        if rate < 1.0 and random.random() >= rate:
+            self._count("sampled_out")
+            return None
+        return rate
+
+    def _properties(self, properties, rate):
+        properties = {
+            key: redact(value, self.max_property_length) if isinstance(value, str) else value
+            for key, value in (properties or {}).items()
+        }
+        if rate < 1.0:
+            # Lets dashboards scale sampled counts back up
+            properties["sample_rate"] = rate
+        return properties
+
+    def _enqueue(self, item):
+        try:
+            self._queue.put_nowait(item)
+            self._count("queued")
+        except queue.Full:
+            self._count("dropped")
+
+    def track_event(self, name, properties=None, measurements=None):
+        """Queue a custom event for export (subject to sampling)."""
+        rate = self._sample(name)
+        if rate is not None:
+            self._enqueue(("event", name, self._properties(properties, rate), measurements))
+
+    def track_exception(self, type=None, value=None, tb=None, properties=None, measurements=None):
+        """Queue the given (or currently handled) exception for export (subject to sampling)."""
+        rate = self._sample("exception")
+        if rate is None:
+            return
+        if type is None:
+            type, value, tb = sys.exc_info()
+        self._enqueue(("exception", (type, value, tb), self._properties(properties, rate), measurements))
+
+    def _export(self, item):
+        kind, payload, properties, measurements = item
+        if kind == "event":
+            self.client.track_event(payload, properties, measurements)
+        else:
+            self.client.track_exception(*payload, properties=properties, measurements=measurements)
+
+    def _flush(self, pending):
+        try:
+            self.client.flush()
+            self._count("batches")
+        except Exception:
+            self._count("export_errors", pending)
+
+    def _run(self):
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is _SENTINEL:
+                if pending:
+                    self._flush(pending)
+                return
+            if item is not None:
+                try:
+                    self._export(item)
+                    pending += 1
+                    self._count("exported")
+                except Exception:
+                    self._count("export_errors")
+            if pending and (pending >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval):
+                self._flush(pending)
+                pending = 0
+                last_flush = time.monotonic()
+
+    def close(self, timeout=5.0):
+        """Export and flush the events still queued (waiting at most ``timeout`` seconds)."""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(_SENTINEL, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Return queued/exported/sampled/dropped counts and the current queue depth."""
+        with self._lock:
+            return {**self._counters, "queue_depth": self._queue.qsize()}
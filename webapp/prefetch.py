@@ -0,0 +1,203 @@
+"""
+Speculative get_telemetry prefetch.
+
+For a typical telemetry question the chat turn runs model call, tool call,
+model call in sequence. When the user message clearly names one sensor and a
+time window, the likely get_telemetry call is started while the first model
+call is still running. If the model then requests the same call (same sensor,
+window within a tolerance), the prefetched result is used and the tool call
+costs only whatever part of the fetch had not yet finished.
+
+Every prefetch the model does not use is a wasted round-trip to the Pi, so
+prefetches are capped in two ways: a bound on how many are in flight at once,
+and a waste budget over the most recent predictions. While the waste ratio is
+over budget, predictions are still checked against the model's calls
+("shadow" mode) without fetching, so prefetching resumes once they match
+again.
+"""
+
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from fast_path import find_sensors, normalize, parse_window, telemetry_args
+from telemetry_cache import parse_iso8601
+
+# Words that make "now" an explicit window; without one of these (or "last
+# hour", "today", ...) the message does not clearly name a time range
+NOW_PATTERN = re.compile(r"\b(?:now|current|currently|latest)\b")
+
+
+class Speculation:
+    """A prediction for one chat turn, with its prefetch if one was started."""
+
+    def __init__(self, prefetcher, args, handle=None):
+        self.prefetcher = prefetcher
+        self.args = args
+        self.handle = handle
+        self.shadow = handle is None
+        self.started = time.perf_counter()
+        self.finished = None
+        self.matched = False
+        self._done = False
+
+    def _fetch_done(self, handle):
+        self.finished = time.perf_counter()
+        # Retrieve the outcome so an unused failed prefetch is not reported as unhandled
+        if not handle.cancelled():
+            handle.exception()
+        self.prefetcher._prefetch_done()
+
+    def claim(self, function_name, function_args):
+        """
+        Return the prefetch handle (a Future or Task) if the model's call is
+        the predicted one and it has not been used yet, otherwise None.
+        """
+        if self.matched or not self.prefetcher.matches(self.args, function_name, function_args):
+            return None
+        self.matched = True
+        if self.shadow:
+            return None
+        # Time the fetch had already been running alongside the model call
+        overlap = (self.finished or time.perf_counter()) - self.started
+        self.prefetcher._record_claim(overlap)
+        return self.handle
+
+    def finish(self):
+        """Record the outcome once the chat turn is over (idempotent)."""
+        if not self._done:
+            self._done = True
+            self.prefetcher._record_outcome(self)
+
+
+class SpeculativePrefetcher:
+    """Predicts and starts get_telemetry calls from the user message, within a waste budget."""
+
+    def __init__(self, enabled=False, default_window_minutes=15, max_in_flight=4,
+                 max_waste_ratio=0.5, waste_window=50, min_samples=10, match_tolerance_seconds=120):
+        """
+        Initialize the SpeculativePrefetcher.
+
+        Args:
+            enabled: Whether messages are checked at all
+            default_window_minutes: Window predicted for "now"/"current" questions
+            max_in_flight: Prefetches allowed to run at once (per process)
+            max_waste_ratio: Share of recent predictions allowed to go unused before prefetching pauses
+            waste_window: Number of recent predictions the waste ratio is computed over
+            min_samples: Predictions needed before the waste budget is enforced
+            match_tolerance_seconds: How far the model's start/end dates may be from the prediction
+        """
+        self.enabled = enabled
+        self.default_window = timedelta(minutes=default_window_minutes)
+        self.max_in_flight = max_in_flight
+        self.max_waste_ratio = max_waste_ratio
+        self.min_samples = min_samples
+        self.match_tolerance = timedelta(seconds=match_tolerance_seconds)
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=waste_window)
+        self._in_flight = 0
+        self._saved_seconds = 0.0
+        self._counters = {"predicted": 0, "started": 0, "hits": 0, "wasted": 0,
+                          "skipped_in_flight": 0, "skipped_over_budget": 0,
+                          "shadow_hits": 0, "shadow_misses": 0}
+
+    def predict(self, message, now=None):
+        """Return the get_telemetry arguments the message most likely leads to, or None."""
+        if not self.enabled or not isinstance(message, str):
+            return None
+        now = now or datetime.now(timezone.utc)
+        text = normalize(message)
+        parsed = parse_window(text, now, self.default_window)
+        if parsed is None:
+            return None
+        start, window, rest = parsed
+        if window == "right now" and not NOW_PATTERN.search(text):
+            return None
+        sensors, _ = find_sensors(rest.split())
+        if len(sensors) != 1:
+            return None
+        return telemetry_args(sensors.pop(), start, now)
+
+    def matches(self, args, function_name, function_args):
+        """Whether a tool call requested by the model is the predicted get_telemetry call."""
+        if function_name != "get_telemetry" or not isinstance(function_args, dict):
+            return False
+        if str(function_args.get("sensor_key", "")).strip().lower() != args["sensor_key"].lower():
+            return False
+        # The prefetch asked for the raw readings
+        if function_args.get("max_points") is not None or function_args.get("resolution") is not None:
+            return False
+        try:
+            for field in ("start_date", "end_date"):
+                delta = parse_iso8601(function_args.get(field) or "") - parse_iso8601(args[field])
+                if abs(delta) > self.match_tolerance:
+                    return False
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def _waste_ratio_locked(self):
+        if not self._recent:
+            return 0.0
+        return self._recent.count(False) / len(self._recent)
+
+    def start(self, message, submit):
+        """
+        Predict the call for ``message`` and start it with ``submit(args)``,
+        which returns a Future (or asyncio Task). Returns a Speculation to
+        pass to the tool loop and finish() afterwards, or None.
+        """
+        args = self.predict(message)
+        if args is None:
+            return None
+        with self._lock:
+            self._counters["predicted"] += 1
+            if len(self._recent) >= self.min_samples and self._waste_ratio_locked() > self.max_waste_ratio:
+                self._counters["skipped_over_budget"] += 1
+                return Speculation(self, args)
+            if self._in_flight >= self.max_in_flight:
+                self._counters["skipped_in_flight"] += 1
+                return None
+            self._in_flight += 1
+            self._counters["started"] += 1
+        speculation = Speculation(self, args)
+        try:
+            speculation.handle = submit(args)
+        except Exception:
+            self._prefetch_done()
+            raise
+        speculation.shadow = False
+        speculation.handle.add_done_callback(speculation._fetch_done)
+        return speculation
+
+    def _prefetch_done(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _record_claim(self, overlap):
+        with self._lock:
+            self._saved_seconds += overlap
+
+    def _record_outcome(self, speculation):
+        with self._lock:
+            self._recent.append(speculation.matched)
+            if speculation.shadow:
+                self._counters["shadow_hits" if speculation.matched else "shadow_misses"] += 1
+            else:
+                self._counters["hits" if speculation.matched else "wasted"] += 1
+
+    def stats(self):
+        """Return prediction outcomes, the recent waste ratio and the time saved by prefetching."""
+        with self._lock:
+            started = self._counters["started"]
+            return {
+                **self._counters,
+                "enabled": self.enabled,
+                "in_flight": self._in_flight,
+                "recent_waste_ratio": round(self._waste_ratio_locked(), 3),
+                "paused": len(self._recent) >= self.min_samples and self._waste_ratio_locked() > self.max_waste_ratio,
+                "hit_rate": round(self._counters["hits"] / started, 3) if started else 0.0,
+                "seconds_saved": round(self._saved_seconds, 3),
+            }
@@ -0,0 +1,287 @@
+"""
+Shaping of MCP tool results before they go back into the model context.
+
+Long numeric series (lists of numbers, ``[time, value]`` pairs or lists of
+records with a time field) are downsampled to a bounded number of points,
+either with min/max/mean buckets or with LTTB, and annotated with summary
+statistics. The serialized result is then capped at a token budget, so the
+prompt size stays flat as the queried telemetry window grows: series are
+shrunk to their summaries if need be, and a result still over the budget
+keeps only the whole fields (or leading items) that fit.
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Record fields recognised as the time axis of a series
+TIME_FIELDS = ("timestamp", "time", "ts", "t", "date", "datetime")
+
+# Smallest series length the token-budget loop will shrink to before
+# replacing series by their summaries
+MIN_POINTS = 10
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _time_value(value, index):
+    """Return a numeric x-axis value for a timestamp, falling back to the index."""
+    if _is_number(value):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    return float(index)
+
+
+def _record_fields(record):
+    """Return the (time_field, value_field) of a series record, or None."""
+    time_field = next((field for field in TIME_FIELDS if field in record), None)
+    if time_field is None:
+        return None
+    value_field = next((k for k, v in record.items() if k != time_field and _is_number(v)), None)
+    return (time_field, value_field) if value_field else None
+
+
+def _series_fields(records):
+    """Return the (time_field, value_field) of the first record that has them, or None."""
+    return next((fields for fields in map(_record_fields, records) if fields), None)
+
+
+def _series_kind(items):
+    """Classify a list as 'numbers', 'pairs' or 'records' (or None if it is not a series)."""
+    if all(_is_number(item) for item in items):
+        return "numbers"
+    if all(isinstance(item, (list, tuple)) and len(item) == 2 and _is_number(item[1]) for item in items):
+        return "pairs"
+    if all(isinstance(item, dict) for item in items) and _series_fields(items):
+        return "records"
+    return None
+
+
+def summarize(values):
+    """Return count/min/max/mean/first/last for a list of numbers."""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "min": min(values),
+        "max": max(values),
+        "mean": round(sum(values) / len(values), 4),
+        "first": values[0],
+        "last": values[-1],
+    }
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    ``points`` is a list of ``(x, y)`` tuples; returns the indices of the
+    ``threshold`` points that best preserve the visual shape of the series.
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    selected = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        next_bucket = points[next_start:next_end] or [points[-1]]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = points[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+def bucket_ranges(n, buckets):
+    """Split ``range(n)`` into ``buckets`` contiguous (start, end) ranges of near-equal size."""
+    buckets = max(1, min(buckets, n))
+    return [(n * i // buckets, n * (i + 1) // buckets) for i in range(buckets)]
+
+
+class ResultShaper:
+    """Downsamples long series in tool results and caps them at a token budget."""
+
+    def __init__(self, token_budget=2000, max_points=100, method="buckets"):
+        """
+        Initialize the ResultShaper.
+
+        Args:
+            token_budget: Approximate token budget for one serialized tool result
+            max_points: Series longer than this are downsampled
+            method: 'buckets' (min/max/mean per bucket) or 'lttb'
+        """
+        self.token_budget = token_budget
+        self.max_points = max(MIN_POINTS, max_points)
+        self.method = method if method in ("buckets", "lttb") else "buckets"
+        self._lock = threading.Lock()
+        self._counters = {"results": 0, "series_downsampled": 0, "truncated": 0,
+                          "chars_in": 0, "chars_out": 0}
+
+    def _downsample(self, items, kind, max_points):
+        """
+        Return the downsampled representation of a series with summary statistics
+        (the summary only when ``max_points`` is 0). Records whose value is
+        missing or not a number are left out of the summary and the points.
+        """
+        if kind == "numbers":
+            indices = list(range(len(items)))
+            times, values = [float(i) for i in indices], list(items)
+        elif kind == "pairs":
+            indices = list(range(len(items)))
+            times = [_time_value(item[0], i) for i, item in enumerate(items)]
+            values = [item[1] for item in items]
+        else:
+            time_field, value_field = _series_fields(items)
+            indices = [i for i, item in enumerate(items) if _is_number(item.get(value_field))]
+            times = [_time_value(items[i].get(time_field), i) for i in indices]
+            values = [items[i][value_field] for i in indices]
+
+        shaped = {"summary": summarize(values), "original_points": len(items), "method": self.method}
+        if len(indices) < len(items):
+            shaped["non_numeric_points"] = len(items) - len(indices)
+        if max_points == 0:
+            return shaped
+        if not values:
+            shaped["points"] = []
+            return shaped
+
+        if self.method == "lttb":
+            selected = lttb(list(zip(times, values)), max_points)
+            shaped["points"] = [items[indices[i]] for i in selected]
+            return shaped
+
+        points = []
+        for start, end in bucket_ranges(len(values), max_points):
+            bucket_values = values[start:end]
+            first, last = items[indices[start]], items[indices[end - 1]]
+            point = {
+                "min": min(bucket_values),
+                "max": max(bucket_values),
+                "mean": round(sum(bucket_values) / len(bucket_values), 4),
+                "count": end - start,
+            }
+            if kind == "numbers":
+                point["index"] = start
+            elif kind == "pairs":
+                point["start"], point["end"] = first[0], last[0]
+            else:
+                point["start"], point["end"] = first.get(time_field), last.get(time_field)
+            points.append(point)
+        shaped["points"] = points
+        return shaped
+
+    def _shape_value(self, value, max_points, downsampled):
+        """Recursively downsample every long series in a JSON value, appending each to ``downsampled``."""
+        if isinstance(value, dict):
+            return {key: self._shape_value(item, max_points, downsampled) for key, item in value.items()}
+        if isinstance(value, list):
+            kind = _series_kind(value) if len(value) > max_points else None
+            if kind is not None:
+                downsampled.append(len(value))
+                return self._downsample(value, kind, max_points)
+            return [self._shape_value(item, max_points, downsampled) for item in value]
+        return value
+
+    @staticmethod
+    def _truncate(value, original_chars, max_chars):
+        """
+        Serialize as much of ``value`` as fits in ``max_chars``, wrapped with a
+        truncation marker. Whole fields of a dict (or leading items of a list)
+        are kept or dropped; a string is never cut.
+        """
+        wrapper = {"truncated": True, "original_chars": original_chars}
+        if isinstance(value, dict):
+            entries = [(key, len(json.dumps(key)) + 2 + len(json.dumps(item))) for key, item in value.items()]
+        elif isinstance(value, list):
+            entries = [(index, len(json.dumps(item))) for index, item in enumerate(value)]
+        else:
+            return json.dumps(wrapper)
+
+        # Room for the wrapper, an empty partial result and the count of dropped entries
+        used = len(json.dumps({**wrapper, "partial_result": [], "omitted": len(entries)}))
+        kept = []
+        for key, size in entries:
+            if used + size + (2 if kept else 0) > max_chars:
+                if isinstance(value, list):
+                    break
+                # Smaller fields further on may still fit
+                continue
+            kept.append(key)
+            used += size + (2 if len(kept) > 1 else 0)
+
+        while True:
+            if isinstance(value, dict):
+                partial = {key: value[key] for key in kept}
+            else:
+                partial = value[:len(kept)]
+            shaped = json.dumps({**wrapper, "partial_result": partial, "omitted": len(entries) - len(kept)})
+            if len(shaped) <= max_chars:
+                return shaped
+            if not kept:
+                return json.dumps(wrapper)
+            kept.pop()
+
+    def shape(self, result):
+        """Return the tool result serialized for a ToolMessage, within the token budget."""
+        original = json.dumps(result)
+        max_chars = self.token_budget * 4
+        value, shaped = result, original
+        downsampled = []
+
+        # A series longer than max_points needs at least two characters per item
+        if len(original) > 2 * self.max_points:
+            max_points = self.max_points
+            try:
+                while True:
+                    downsampled = []
+                    value = self._shape_value(result, max_points, downsampled)
+                    shaped = json.dumps(value)
+                    if len(shaped) <= max_chars or max_points == 0:
+                        break
+                    # Shrink series further until the result fits the budget, down to their summaries
+                    max_points = max(MIN_POINTS, max_points // 2) if max_points > MIN_POINTS else 0
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Could not shape tool result: {str(e)}")
+                value, shaped = result, original
+
+        truncated = len(shaped) > max_chars
+        if truncated:
+            shaped = self._truncate(value, len(original), max_chars)
+
+        with self._lock:
+            self._counters["results"] += 1
+            self._counters["series_downsampled"] += len(downsampled)
+            self._counters["truncated"] += int(truncated)
+            self._counters["chars_in"] += len(original)
+            self._counters["chars_out"] += len(shaped)
+        return shaped
+
+    def stats(self):
+        """Return shaping counters (characters in/out of the model context)."""
+        with self._lock:
+            return dict(self._counters)
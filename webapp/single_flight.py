@@ -0,0 +1,89 @@
+"""
+Single-flight request coalescing.
+
+Concurrent calls with the same key share one execution of the underlying
+function: the first caller runs it and every caller that arrives while it
+is in flight receives the same result (or exception).
+"""
+
+import asyncio
+import threading
+
+
+class _InFlightCall:
+    """A call in progress that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls, for threads and for asyncio tasks."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self._counters = {"calls": 0, "executed": 0, "merged": 0}
+
+    def do(self, key, fn):
+        """Run ``fn()`` once for all threads calling with ``key`` at the same time."""
+        with self._lock:
+            self._counters["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlightCall()
+                self._counters["executed"] += 1
+            else:
+                self._counters["merged"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def ado(self, key, fn):
+        """
+        Await ``fn()`` once for all tasks calling with ``key`` at the same time.
+
+        The shared call runs as its own task, so a caller that is cancelled
+        (e.g. by a timeout) does not cancel it for the others.
+        """
+        with self._lock:
+            self._counters["calls"] += 1
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = asyncio.ensure_future(fn())
+                task.add_done_callback(lambda _: self._forget_task(key, task))
+                self._counters["executed"] += 1
+            else:
+                self._counters["merged"] += 1
+        return await asyncio.shield(task)
+
+    def _forget_task(self, key, task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+
+    def stats(self):
+        """Return how many calls were executed and how many were merged into them."""
+        with self._lock:
+            return {
+                **self._counters,
+                "in_flight": len(self._calls) + len(self._tasks),
+            }
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Startup (cold start) benchmark for the web app entry points.
+
+Each run starts a fresh Python process, as a new gunicorn/uvicorn worker
+would after a scale-out, and measures:
+
+- import_ms: importing app.py (or asgi_app.py)
+- first_health_ms: the first GET /api/health
+- warm_up_ms: warm_up(), when --warm-up is given
+- first_chat_ms: the first POST /api/chat, against the fake model and
+  Function App from load_test.py
+- time_to_first_request_ms: from process launch to the first chat response
+
+Medians over --runs runs are printed as JSON.
+
+Usage:
+    python startup_benchmark.py --runs 5
+    python startup_benchmark.py --app asgi --warm-up
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FIRST_MESSAGE = "What is the temperature? (startup)"
+
+
+def run_child(app_name, warm_up, launched):
+    """Measure one cold start inside this (fresh) process and print the timings."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import load_test
+
+    function_server, function_url = load_test.start_fake_function_app(0, 0)
+    os.environ.update({
+        "FUNCTION_APP_URL": function_url,
+        "FUNCTION_APP_KEY": "startup-benchmark",
+        "AZURE_OPENAI_ENDPOINT": "https://startup-benchmark.invalid",
+        "AZURE_OPENAI_API_KEY": "startup-benchmark",
+        "CONVERSATION_STORE": "memory",
+        "FAST_PATH_ENABLED": "false",
+    })
+    os.environ.pop("APPLICATIONINSIGHTS_CONNECTION_STRING", None)
+    timings = {}
+
+    started = time.perf_counter()
+    if app_name == "asgi":
+        import asgi_app as module
+    else:
+        import app as module
+    timings["import_ms"] = (time.perf_counter() - started) * 1000
+
+    # Replace the model with the scripted stand-in; it still goes through get_client()
+    if app_name == "asgi":
+        module.client = load_test.FakeAsyncChatCompletionsClient("single_tool", 0, 0, 0)
+    else:
+        module.client = load_test.FakeChatCompletionsClient("single_tool", 0, 0, 0)
+    body = {"message": FIRST_MESSAGE}
+
+    if app_name == "asgi":
+        async def requests_in_order():
+            test_client = module.app.test_client()
+            started = time.perf_counter()
+            health = await test_client.get("/api/health")
+            timings["first_health_ms"] = (time.perf_counter() - started) * 1000
+            if warm_up:
+                started = time.perf_counter()
+                await module.warm_up()
+                timings["warm_up_ms"] = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            chat = await test_client.post("/api/chat", json=body)
+            timings["first_chat_ms"] = (time.perf_counter() - started) * 1000
+            await module.mcp_client.close()
+            return health.status_code, chat.status_code
+
+        status_codes = asyncio.run(requests_in_order())
+    else:
+        test_client = module.app.test_client()
+        started = time.perf_counter()
+        health = test_client.get("/api/health")
+        timings["first_health_ms"] = (time.perf_counter() - started) * 1000
+        if warm_up:
+            started = time.perf_counter()
+            module.warm_up()
+            timings["warm_up_ms"] = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        chat = test_client.post("/api/chat", json=body)
+        timings["first_chat_ms"] = (time.perf_counter() - started) * 1000
+        status_codes = health.status_code, chat.status_code
+
+    timings["time_to_first_request_ms"] = (time.time() - launched) * 1000
+    timings["status_codes"] = list(status_codes)
+    function_server.shutdown()
+    print(json.dumps(timings))
+
+
+def summarize(runs):
+    keys = [key for key in runs[0] if key.endswith("_ms")]
+    summary = {key: round(statistics.median(run[key] for run in runs), 1) for key in keys}
+    summary["max_time_to_first_request_ms"] = round(max(run["time_to_first_request_ms"] for run in runs), 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark for the web app")
+    parser.add_argument("--app", choices=["flask", "asgi", "both"], default="both", help="Entry point to measure")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per entry point")
+    parser.add_argument("--warm-up", action="store_true", help="Call warm_up() before the first chat request")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--launched", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.warm_up, args.launched)
+        return 0
+
+    report = {"runs": args.runs, "warm_up": args.warm_up}
+    for app_name in (["flask", "asgi"] if args.app == "both" else [args.app]):
+        runs = []
+        for _ in range(args.runs):
+            command = [sys.executable, os.path.abspath(__file__), "--child", app_name, "--launched", str(time.time())]
+            if args.warm_up:
+                command.append("--warm-up")
+            completed = subprocess.run(command, capture_output=True, text=True, check=True)
+            run = json.loads(completed.stdout.strip().splitlines()[-1])
+            if run["status_codes"] != [200, 200]:
+                print(f"{app_name}: unexpected status codes {run['status_codes']}", file=sys.stderr)
+                return 1
+            runs.append(run)
+        report[app_name] = summarize(runs)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
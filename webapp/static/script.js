@@ -1,8 +1,5 @@
-// Configuration
-const MAX_HISTORY_MESSAGES = 20;
-
-// Conversation history to maintain context
-let conversationHistory = [];
+// Conversation id assigned by the server; history is kept server-side
+let conversationId = null;
 
 // Handle Enter key press in textarea
 document.getElementById('user-input').addEventListener('keydown', function(event) {
@@ -37,7 +34,7 @@ async function sendMessage() {
     input.value = '';
     
     try {
-        // Send request to backend
+        // Send request to backend, asking for a streamed response
         const response = await fetch('/api/chat', {
             method: 'POST',
             headers: {
@@ -45,7 +42,8 @@ async function sendMessage() {
             },
             body: JSON.stringify({
                 message: message,
-                history: conversationHistory
+                conversation_id: conversationId,
+                stream: true
             })
         });
         
@@ -54,25 +52,23 @@ async function sendMessage() {
             throw new Error(errorData.error || 'Failed to get response');
         }
         
-        const data = await response.json();
-        
-        // Add assistant response to chat
-        addMessage('assistant', data.response);
+        // Render the assistant response token by token as it arrives
+        const assistantMessage = addMessage('assistant', '');
+        let assistantText = '';
         
-        // Update conversation history
-        conversationHistory.push({
-            role: 'user',
-            content: message
-        });
-        conversationHistory.push({
-            role: 'assistant',
-            content: data.response
+        await readEventStream(response, function(event, data) {
+            if (event === 'token') {
+                assistantText += data.content;
+                updateMessage(assistantMessage, 'assistant', assistantText);
+            } else if (event === 'done') {
+                conversationId = data.conversation_id;
+            } else if (event === 'tool_call') {
+                setMessageStatus(assistantMessage, `Calling ${data.name}…`);
+            } else if (event === 'error') {
+                throw new Error(data.error);
+            }
         });
-        
-        // Keep history manageable
-        if (conversationHistory.length > MAX_HISTORY_MESSAGES) {
-            conversationHistory = conversationHistory.slice(-MAX_HISTORY_MESSAGES);
-        }
+        setMessageStatus(assistantMessage, '');
         
     } catch (error) {
         console.error('Error:', error);
@@ -87,7 +83,42 @@ async function sendMessage() {
     }
 }
 
-// Add a message to the chat display
+// Read a Server-Sent Events response body, calling onEvent(event, data) per frame
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        
+        // Frames are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let event = 'message';
+            let data = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) {
+                    event = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            }
+            if (data) {
+                onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+}
+
+// Add a message to the chat display and return its element
 function addMessage(role, content) {
     const chatMessages = document.getElementById('chat-messages');
     const messageDiv = document.createElement('div');
@@ -95,6 +126,21 @@ function addMessage(role, content) {
     
     const contentDiv = document.createElement('div');
     contentDiv.className = 'message-content';
+    messageDiv.appendChild(contentDiv);
+    
+    const statusDiv = document.createElement('div');
+    statusDiv.className = 'message-status';
+    messageDiv.appendChild(statusDiv);
+    
+    chatMessages.appendChild(messageDiv);
+    updateMessage(messageDiv, role, content);
+    
+    return messageDiv;
+}
+
+// Replace the content of a message element
+function updateMessage(messageDiv, role, content) {
+    const contentDiv = messageDiv.querySelector('.message-content');
     
     // Format the message
     const roleLabel = role === 'user' ? 'You' : 'Assistant';
@@ -108,13 +154,18 @@ function addMessage(role, content) {
     
     contentDiv.innerHTML = `<strong>${roleLabel}:</strong> ${formattedContent}`;
     
-    messageDiv.appendChild(contentDiv);
-    chatMessages.appendChild(messageDiv);
-    
     // Scroll to bottom
+    const chatMessages = document.getElementById('chat-messages');
     chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
+// Show a progress note (e.g. a running tool call) under a message
+function setMessageStatus(messageDiv, text) {
+    const statusDiv = messageDiv.querySelector('.message-status');
+    statusDiv.textContent = text;
+    statusDiv.style.display = text ? 'block' : 'none';
+}
+
 // Add an error message to the chat display
 function addErrorMessage(errorText) {
     const chatMessages = document.getElementById('chat-messages');
@@ -0,0 +1,157 @@
+"""
+TTL/LRU cache for get_telemetry results.
+
+Entries are keyed on the sensor and the requested window rounded to a
+configurable granularity, expire after a per-sensor TTL and are evicted
+least-recently-used once the cache is full. Windows that end in the future
+are still "live" and always go to the backend.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def parse_iso8601(value):
+    """Parse an ISO 8601 timestamp (naive values are treated as UTC)."""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def parse_sensor_ttls(value):
+    """Parse a 'Sensor=seconds,Sensor=seconds' string into a {sensor: ttl} dict."""
+    ttls = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            sensor, ttl = item.split("=", 1)
+            ttls[sensor.strip().lower()] = float(ttl)
+    return ttls
+
+
+class TelemetryCache:
+    """Bounded cache of get_telemetry results with per-sensor TTLs."""
+
+    def __init__(self, granularity_seconds=60, default_ttl=60.0, sensor_ttls=None, max_entries=1024):
+        """
+        Initialize the TelemetryCache.
+
+        Args:
+            granularity_seconds: Start/end dates are rounded down to this many seconds
+            default_ttl: Seconds an entry lives for sensors without their own TTL (0 disables caching)
+            sensor_ttls: Dictionary of lower-case sensor key to TTL in seconds
+            max_entries: Entries kept before the least recently used is evicted
+        """
+        self.granularity_seconds = max(1, int(granularity_seconds))
+        self.default_ttl = default_ttl
+        self.sensor_ttls = {key.lower(): ttl for key, ttl in (sensor_ttls or {}).items()}
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "bypassed": 0, "evictions": 0}
+
+    def _round(self, timestamp):
+        return int(timestamp.timestamp()) // self.granularity_seconds * self.granularity_seconds
+
+    def _key(self, arguments):
+        """
+        Return the cache key and TTL for a get_telemetry call, or (None, 0)
+        when the call must bypass the cache.
+        """
+        # Arguments the model got wrong (not strings, dates not in ISO 8601) are left to the backend
+        sensor_key, start_date, end_date = (arguments.get(name) for name in ("sensor_key", "start_date", "end_date"))
+        if not all(isinstance(value, str) for value in (sensor_key, start_date, end_date)):
+            return None, 0
+        if not all(isinstance(arguments.get(name), (int, float, type(None))) for name in ("max_points", "resolution")):
+            return None, 0
+        sensor_key = sensor_key.lower()
+        ttl = self.sensor_ttls.get(sensor_key, self.default_ttl)
+        if not sensor_key or ttl <= 0:
+            return None, 0
+        try:
+            start = parse_iso8601(start_date)
+            end = parse_iso8601(end_date)
+        except ValueError:
+            return None, 0
+
+        # A window that has not ended yet can still receive new readings
+        if end > datetime.now(timezone.utc):
+            return None, 0
+
+        # Aggregated and raw results of the same window are different entries
+        return (sensor_key, self._round(start), self._round(end),
+                arguments.get("max_points"), arguments.get("resolution")), ttl
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _lookup(self, arguments):
+        """
+        Look up a get_telemetry call.
+
+        Returns ``(key, ttl, hit, result)``; ``key`` is None when the call
+        bypasses the cache.
+        """
+        key, ttl = self._key(arguments)
+        if key is None:
+            self._count("bypassed")
+            return None, 0, False, None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return key, ttl, True, entry[1]
+            self._counters["misses"] += 1
+        return key, ttl, False, None
+
+    def _store(self, key, ttl, result):
+        """Store a fetched result unless it is an error."""
+        if key is None or (isinstance(result, dict) and "error" in result):
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def get_or_fetch(self, arguments, fetch):
+        """
+        Return the cached result for a get_telemetry call, calling ``fetch()``
+        on a miss. Error results are never cached.
+        """
+        key, ttl, hit, result = self._lookup(arguments)
+        if hit:
+            return result
+        result = fetch()
+        self._store(key, ttl, result)
+        return result
+
+    async def aget_or_fetch(self, arguments, fetch):
+        """Async variant of get_or_fetch; ``fetch()`` returns an awaitable."""
+        key, ttl, hit, result = self._lookup(arguments)
+        if hit:
+            return result
+        result = await fetch()
+        self._store(key, ttl, result)
+        return result
+
+    def stats(self):
+        """Return hit/miss counters and the current size."""
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_ratio": round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
@@ -3,6 +3,7 @@
 Test script to validate the webapp structure and basic functionality
 """
 
+import json
 import sys
 import os
 from pathlib import Path
@@ -25,6 +26,30 @@ def check_directory_exists(dirpath, description):
         print(f"✗ {description}: {dirpath} NOT FOUND")
         return False
 
+def check_files_identical(first, second, description):
+    """Check that two copies of a file have the same contents"""
+    if not Path(first).exists() or not Path(second).exists():
+        print(f"✗ {description}: {first} or {second} NOT FOUND")
+        return False
+    if Path(first).read_bytes() == Path(second).read_bytes():
+        print(f"✓ {description}: {first} and {second} are identical")
+        return True
+    print(f"✗ {description}: {first} and {second} DIFFER")
+    return False
+
+def check_behaviour(check, description):
+    """Check that a function of the webapp modules returns True without raising"""
+    try:
+        passed = check()
+    except Exception as e:
+        print(f"✗ {description}: raised {type(e).__name__}: {e}")
+        return False
+    if passed:
+        print(f"✓ {description}")
+        return True
+    print(f"✗ {description}: FAILED")
+    return False
+
 def main():
     print("🧪 Testing Pi Chat Web Application Structure")
     print("=" * 50)
@@ -37,11 +62,26 @@ def main():
     # Check core files
     print("\n📁 Checking core files...")
     all_checks_passed &= check_file_exists("app.py", "Main application")
+    all_checks_passed &= check_file_exists("asgi_app.py", "Async (ASGI) application")
+    all_checks_passed &= check_file_exists("chat_common.py", "Shared configuration of both apps")
+    all_checks_passed &= check_file_exists("mcp_client.py", "MCP client")
+    all_checks_passed &= check_file_exists("conversation_store.py", "Conversation store")
+    all_checks_passed &= check_file_exists("telemetry_cache.py", "Telemetry cache")
+    all_checks_passed &= check_file_exists("single_flight.py", "Single-flight coalescing")
+    all_checks_passed &= check_file_exists("result_shaping.py", "Tool result shaping")
     all_checks_passed &= check_file_exists("requirements.txt", "Dependencies")
     all_checks_passed &= check_file_exists("Dockerfile", "Docker configuration")
     all_checks_passed &= check_file_exists(".env.example", "Environment template")
     all_checks_passed &= check_file_exists("README.md", "Documentation")
     all_checks_passed &= check_file_exists("deploy.sh", "Deployment script")
+    all_checks_passed &= check_file_exists("load_test.py", "Load test")
+    all_checks_passed &= check_file_exists("metrics.py", "Latency metrics")
+    all_checks_passed &= check_file_exists("fast_path.py", "Telemetry fast path")
+    all_checks_passed &= check_file_exists("startup_benchmark.py", "Startup benchmark")
+    all_checks_passed &= check_file_exists("gunicorn.conf.py", "Gunicorn configuration")
+    all_checks_passed &= check_file_exists("observability.py", "Observability pipeline")
+    all_checks_passed &= check_file_exists("admission.py", "Admission control")
+    all_checks_passed &= check_file_exists("prefetch.py", "Speculative prefetch")
     
     # Check directories
     print("\n📂 Checking directories...")
@@ -56,13 +96,36 @@ def main():
     
     # Check Python syntax
     print("\n🐍 Validating Python syntax...")
-    try:
-        import py_compile
-        py_compile.compile("app.py", doraise=True)
-        print("✓ app.py syntax is valid")
-    except py_compile.PyCompileError as e:
-        print(f"✗ Python syntax error in app.py: {e}")
-        all_checks_passed = False
+    import py_compile
+    for module in ["app.py", "asgi_app.py", "chat_common.py", "mcp_client.py", "conversation_store.py", "telemetry_cache.py", "single_flight.py", "result_shaping.py", "load_test.py", "metrics.py", "fast_path.py", "startup_benchmark.py", "gunicorn.conf.py", "observability.py", "admission.py", "prefetch.py"]:
+        try:
+            py_compile.compile(module, doraise=True)
+            print(f"✓ {module} syntax is valid")
+        except py_compile.PyCompileError as e:
+            print(f"✗ Python syntax error in {module}: {e}")
+            all_checks_passed = False
+    
+    # Check behaviour of the pure-Python modules
+    print("\n🧩 Checking behaviour...")
+    from fast_path import FastPath
+    from prefetch import SpeculativePrefetcher
+    oversized = "what was the cpu over the last 9999999 days"
+    all_checks_passed &= check_behaviour(
+        lambda: FastPath().match(oversized) is None, "Fast path sends oversized windows to the model")
+    all_checks_passed &= check_behaviour(
+        lambda: SpeculativePrefetcher(enabled=True).predict(oversized) is None, "Prefetch skips oversized windows")
+    all_checks_passed &= check_behaviour(
+        lambda: FastPath().match("cpu last 3 days")[0]["sensor_key"] == "CPU", "Fast path matches a multi-day window")
+    from result_shaping import ResultShaper
+    gappy = [{"timestamp": i, "value": None if i % 3 == 0 else 10.0} for i in range(300)]
+    all_checks_passed &= check_behaviour(
+        lambda: json.loads(ResultShaper(max_points=20).shape(gappy))["summary"]["min"] == 10.0,
+        "Result shaping leaves out missing values")
+    
+    # Check the copies of modules deployed to both the Function App and the Pi
+    print("\n🔗 Checking shared modules...")
+    all_checks_passed &= check_files_identical(
+        "../functions/shared_code/wire_format.py", "../raspberry-pi/wire_format.py", "Wire format copies")
     
     # Check dependencies
     print("\n📦 Checking dependencies...")